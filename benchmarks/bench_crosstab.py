@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Zonal crosstab benchmark
+
+Description: Compares the bincount-based zonal_crosstab in idm.py with the
+np.unique path that dasy_map used to count the pixels of each dasymetric unit
+and each source polygon. The population features are rasterized on the grid of
+the ancillary raster once, then each method is timed on the full arrays and
+the unit counts of both methods are checked against each other. When Numba is
+installed, the NumPy and the fused Numba pixel kernels of window_units, which
+also write the unit codes, are compared as well. By default the Delaware
+sample data in data/ is used.
+"""
+
+import os, sys, time
+from osgeo import gdal, ogr
+import numpy as np
+import argparse as ap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idm
+
+
+def load_arrays(popFeat_path, popKeyField, ancRaster_path):
+    '''
+    Rasterize the polygon index of the population features on the grid of the
+    ancillary raster and read both rasters as arrays.
+    '''
+    ancRaster = gdal.Open(ancRaster_path)
+    popFeatures = ogr.Open(popFeat_path)
+    polyKeys, polys = idm._poly_index(popFeatures.GetLayer(), popKeyField,
+                                      ancRaster.GetProjection())
+    pop_arr = idm._rasterize_window(
+            polys, (0, 0, ancRaster.RasterXSize, ancRaster.RasterYSize),
+            ancRaster.GetGeoTransform())
+    anc_band = ancRaster.GetRasterBand(1)
+    return (pop_arr, anc_band.ReadAsArray(),
+            len(polyKeys), idm._class_count(anc_band))
+
+def unique_path(pop_arr, anc_arr):
+    '''
+    Count the dasymetric units and source polygons the way dasy_map did before
+    zonal_crosstab: Cantor pairing in float64 and two full-array np.unique.
+    '''
+    pop_arr = pop_arr.astype(np.uint64)
+    anc_arr = anc_arr.astype(np.uint64)
+    anc_arr[pop_arr == 0] = 0
+    comb_arr = 0.5 * (pop_arr + anc_arr) * (pop_arr + anc_arr + 1) + anc_arr
+    dasy_un = np.unique(comb_arr, return_counts = True)
+    pop_un = np.unique(pop_arr, return_counts = True)
+    return dasy_un, pop_un
+
+def crosstab_path(pop_arr, anc_arr, nClasses, nPoly):
+    '''
+    Count the dasymetric units with zonal_crosstab and the source polygons
+    with a bincount over the polygon index of each unit.
+    '''
+    unitCodes, counts = idm.zonal_crosstab(pop_arr, anc_arr, nClasses)
+    popCounts = np.bincount((unitCodes // np.uint64(nClasses)).astype(np.intp),
+                            weights = counts, minlength = nPoly + 1)
+    return (unitCodes, counts), popCounts
+
+def kernel_path(pop_arr, anc_arr, nClasses, kernel):
+    '''
+    Write the unit codes of the arrays and count the dasymetric units with
+    the pixel kernel of window_units.
+    '''
+    return idm.window_units(pop_arr, anc_arr.copy(), nClasses, np.uint64,
+                            kernel = kernel)
+
+def best_time(func, repeat, *args):
+    '''
+    Return the best wall time of repeat calls to func and the last result.
+    '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    dataDir = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), "data")
+    parser = ap.ArgumentParser(description='Compare zonal_crosstab with the \
+                               np.unique path on the Delaware sample data.')
+    parser.add_argument('--population_features', type = str,
+                        default = os.path.join(dataDir, "2010_blocks_DE.shp"))
+    parser.add_argument('--population_key_field', type = str,
+                        default = "polyID")
+    parser.add_argument('--ancillary_raster', type = str,
+                        default = os.path.join(dataDir, "nlcd_2011_DE.tif"))
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    pop_arr, anc_arr, nPoly, nClasses = load_arrays(
+            args.population_features, args.population_key_field,
+            args.ancillary_raster)
+    print ("Raster size: {0} x {1} pixels, {2} source polygons".format(
+            pop_arr.shape[1], pop_arr.shape[0], nPoly))
+
+    uniqueTime, (dasy_un, pop_un) = best_time(unique_path, args.repeat,
+                                              pop_arr, anc_arr)
+    crossTime, (units, popCounts) = best_time(crosstab_path, args.repeat,
+                                              pop_arr, anc_arr, nClasses,
+                                              nPoly)
+
+    #Both methods must find the same units and polygons (NoData excluded)
+    nUnits = len(dasy_un[0]) - int(dasy_un[0][0] == 0)
+    nPolys = len(pop_un[0]) - int(pop_un[0][0] == 0)
+    assert nUnits == len(units[0]), "dasymetric unit counts differ"
+    assert nPolys == np.count_nonzero(popCounts[1:]), "polygon counts differ"
+    assert np.array_equal(np.sort(dasy_un[1][dasy_un[0] != 0]),
+                          np.sort(units[1])), \
+        "pixel counts of the dasymetric units differ"
+
+    print ("{0} dasymetric units".format(nUnits))
+    print ("np.unique path:     {0:.3f} s".format(uniqueTime))
+    print ("zonal_crosstab path: {0:.3f} s".format(crossTime))
+    print ("speedup:            {0:.1f}x".format(uniqueTime / crossTime))
+
+    if idm.numba is not None:
+        #Compile the kernel before timing it
+        kernel_path(pop_arr[:1], anc_arr[:1], nClasses, 'numba')
+        numpyTime, numpyUnits = best_time(kernel_path, args.repeat, pop_arr,
+                                          anc_arr, nClasses, 'numpy')
+        numbaTime, numbaUnits = best_time(kernel_path, args.repeat, pop_arr,
+                                          anc_arr, nClasses, 'numba')
+        assert np.array_equal(numpyUnits[0], numbaUnits[0]), \
+            "unit codes of the kernels differ"
+        assert np.array_equal(numpyUnits[1][1], numbaUnits[1][1]), \
+            "pixel counts of the kernels differ"
+        print ("numpy kernel:       {0:.3f} s".format(numpyTime))
+        print ("numba kernel:       {0:.3f} s".format(numbaTime))
+        print ("speedup:            {0:.1f}x".format(numpyTime / numbaTime))
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Scaling benchmark
+
+Description: Runs dasy_map on synthetic inputs at several scales and records
+the wall time, CPU time, peak memory and throughput of each stage of the run,
+taken from the RunReport.json of the best of the repeated runs. Throughput is
+given in pixels of the processed extent per second and in dasymetric units
+per second. The results are appended to a CSV file with one row per scale
+and stage, labelled so that runs of different versions of the toolbox can be
+compared with --compare. The inputs are generated by synthetic.py and kept in
+the data directory for later runs.
+"""
+
+import os, sys, json, time, shutil, tempfile, platform, logging
+import pandas as pd
+import argparse as ap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idm
+import synthetic
+
+#Columns of the results file
+COLUMNS = ["label", "timestamp", "host", "cols", "rows", "pixels",
+           "source_units", "dasy_units", "workers", "tile_size", "stage",
+           "wall_seconds", "cpu_seconds", "worker_cpu_seconds",
+           "peak_rss_mb", "pixels_per_second", "units_per_second"]
+
+
+def parse_scale(scale):
+    '''
+    Return the columns, rows and number of source units of a scale given as
+    COLSxROWS:UNITS, e.g. 4096x4096:20000.
+    '''
+    size, units = scale.split(':')
+    cols, rows = size.lower().split('x')
+    return int(cols), int(rows), int(units)
+
+def run_scale(data_dir, cols, rows, nUnits, repeat = 3, workers = 1,
+              tile_size = 2048, mix = None, seed = 0):
+    '''
+    Run dasy_map repeat times on the synthetic inputs of a scale and return
+    the run report of the fastest run and the number of dasymetric units.
+    '''
+    popFeat_path, ancRaster_path = synthetic.make_inputs(
+            data_dir, cols, rows, nUnits, mix, seed)
+    best = None
+    for i in range(repeat):
+        out_dir = tempfile.mkdtemp(prefix = "idm_bench_")
+        try:
+            idm.dasy_map(popFeat_path, "POP", "polyID", ancRaster_path,
+                         out_dir, tile_size = tile_size, workers = workers,
+                         extent_pad = None)
+            with open(os.path.join(out_dir, "RunReport.json")) as reportFile:
+                report = json.load(reportFile)
+            nDasy = len(idm._read_table(os.path.join(
+                    out_dir, "DasyWorkTable.csv"), ["Value"]))
+        finally:
+            shutil.rmtree(out_dir, ignore_errors = True)
+        if best is None or report["total"]["wall_seconds"] < \
+                best[0]["total"]["wall_seconds"]:
+            best = (report, nDasy)
+    return best
+
+def scale_records(report, nDasy, cols, rows, nUnits, label, workers,
+                  tile_size):
+    '''
+    Return the result rows of a scale: one per stage of the report and one
+    for the whole run.
+    '''
+    common = {"label": label, "timestamp": report["started"],
+              "host": platform.node(), "cols": cols, "rows": rows,
+              "pixels": cols * rows, "source_units": nUnits,
+              "dasy_units": nDasy, "workers": workers,
+              "tile_size": tile_size}
+    records = []
+    for stage in report["stages"] + [dict(report["total"], name = "total")]:
+        record = dict(common, stage = stage["name"])
+        wall = stage["wall_seconds"]
+        record["wall_seconds"] = wall
+        record["cpu_seconds"] = stage["cpu_seconds"]
+        record["worker_cpu_seconds"] = stage["worker_cpu_seconds"]
+        record["peak_rss_mb"] = (round(stage["peak_rss_bytes"] / 2.0**20, 1)
+                                 if stage["peak_rss_bytes"] else None)
+        record["pixels_per_second"] = round(cols * rows / wall) if wall \
+            else None
+        record["units_per_second"] = round(nDasy / wall) if wall else None
+        records.append(record)
+    return records
+
+def compare(results, baseline_path):
+    '''
+    Return the speedup of each scale and stage of results over the last run
+    with the same scale, workers and tile size in the baseline file, leaving
+    out the runs with the label of results.
+    '''
+    baseline = pd.read_csv(baseline_path)
+    baseline = baseline[~baseline["label"].isin(results["label"])]
+    keys = ["cols", "rows", "source_units", "workers", "tile_size", "stage"]
+    baseline = baseline.groupby(keys).last().reset_index()
+    merged = results.merge(baseline[keys + ["label", "wall_seconds",
+                                            "peak_rss_mb"]],
+                           on = keys, suffixes = ("", "_baseline"))
+    merged["speedup"] = (merged["wall_seconds_baseline"] /
+                         merged["wall_seconds"]).round(2)
+    merged["memory_ratio"] = (merged["peak_rss_mb"] /
+                              merged["peak_rss_mb_baseline"]).round(2)
+    return merged[["cols", "rows", "source_units", "stage", "label_baseline",
+                   "wall_seconds_baseline", "wall_seconds", "speedup",
+                   "memory_ratio"]]
+
+if __name__ == '__main__':
+    benchDir = os.path.dirname(os.path.abspath(__file__))
+    parser = ap.ArgumentParser(description='Time the stages of dasy_map on \
+                               synthetic inputs at several scales.')
+    parser.add_argument('--scales', type = str, nargs='+',
+                        default = ["1024x1024:1000", "4096x4096:20000",
+                                   "8192x8192:100000"],
+                        help = "The scales to run as COLSxROWS:UNITS")
+    parser.add_argument('--data_dir', type = str,
+                        default = os.path.join(benchDir, "synthetic_data"),
+                        help = "Where the synthetic inputs are kept")
+    parser.add_argument('--results', type = str,
+                        default = os.path.join(benchDir, "scaling.csv"),
+                        help = "The CSV file the results are appended to")
+    parser.add_argument('--label', type = str,
+                        default = time.strftime("%Y%m%d-%H%M%S"),
+                        help = "The label of this run in the results, e.g. \
+                        a commit or a branch")
+    parser.add_argument('--compare', type = str,
+                        help = "A results file to compare this run with")
+    parser.add_argument('--class_mix', type = str)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--tile_size', type = int, default = 2048)
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING, format = "%(message)s")
+
+    records = []
+    for scale in args.scales:
+        cols, rows, nUnits = parse_scale(scale)
+        report, nDasy = run_scale(args.data_dir, cols, rows, nUnits,
+                                  args.repeat, args.workers, args.tile_size,
+                                  args.class_mix, args.seed)
+        scaleRecords = scale_records(report, nDasy, cols, rows, nUnits,
+                                     args.label, args.workers,
+                                     args.tile_size)
+        total = scaleRecords[-1]
+        print ("{0}: {1:.2f} s, {2:.0f} pixels/s, {3:.0f} units/s, "
+               "{4} MB peak".format(scale, total["wall_seconds"],
+                                    total["pixels_per_second"] or 0,
+                                    total["units_per_second"] or 0,
+                                    total["peak_rss_mb"]))
+        records.extend(scaleRecords)
+
+    results = pd.DataFrame(records, columns = COLUMNS)
+    comparison = compare(results, args.compare) if args.compare else None
+    results.to_csv(args.results, mode = 'a', index = False,
+                   header = not os.path.exists(args.results))
+    print (results[["cols", "rows", "source_units", "stage", "wall_seconds",
+                    "pixels_per_second", "units_per_second",
+                    "peak_rss_mb"]].to_string(index = False))
+    print ("The results were appended to " + args.results)
+    if comparison is not None:
+        print (comparison.to_string(index = False))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Start up benchmark
+
+Description: Times the start up of the idm.py command line, which is paid by
+every invocation of the toolbox: "python idm.py --help" and a bare
+"import idm", each in a fresh interpreter, against the start up of the
+interpreter itself. The best of the repeated runs, less the interpreter start
+up, is checked against an import time budget, and importing idm must not
+import GDAL, NumPy, pandas or the optional modules; these are only imported
+by the stages that use them. The slowest modules imported by idm are listed
+from python -X importtime. Exits with status 1 when a check fails, so that it
+can run in CI.
+"""
+
+import os, sys, time, subprocess
+import argparse as ap
+
+#Modules that importing idm must leave to the stages that use them
+HEAVY_MODULES = ['osgeo', 'numpy', 'pandas', 'geopandas', 'pyarrow', 'numba']
+
+packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best_time(command, repeat):
+    '''
+    Run command repeat times and return the best wall time in seconds.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(command, cwd = packageDir,
+                              stdout = subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def heavy_imports():
+    '''
+    Return the heavy modules that are imported by importing idm.
+    '''
+    output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, idm; print(",".join('
+             'name for name in {0!r} if name in sys.modules))'.format(
+                     HEAVY_MODULES)], cwd = packageDir)
+    return [name for name in output.decode('utf-8').strip().split(',')
+            if name]
+
+def import_times(code):
+    '''
+    Return the cumulative import time in seconds of each module imported by 
+    running code, from python -X importtime.
+    '''
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             cwd = packageDir, stdout = subprocess.DEVNULL,
+                             stderr = subprocess.PIPE)
+    imports = {}
+    for line in process.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            imports[fields[2].strip()] = int(fields[1]) / 1e6
+        except ValueError:
+            continue
+    return imports
+
+def slowest_imports(count = 10):
+    '''
+    Return the count modules imported by idm, and not by the start up of the
+    interpreter, with the longest cumulative import time in seconds, or an 
+    empty list where python does not support -X importtime.
+    '''
+    if sys.version_info < (3, 7):
+        return []
+    startup = import_times('pass')
+    imports = [(seconds, name) for name, seconds in 
+               import_times('import idm').items() if name not in startup]
+    return sorted(imports, reverse = True)[:count]
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(description='Time the start up of the idm.py \
+                               command line against an import time budget.')
+    parser.add_argument('--budget', type = float, default = 0.15,
+                        help = "The import time budget in seconds: the time \
+                        of idm.py --help beyond the start up of the \
+                        interpreter - default = 0.15")
+    parser.add_argument('--repeat', type = int, default = 10)
+    args = parser.parse_args()
+
+    pythonTime = best_time([sys.executable, '-c', 'pass'], args.repeat)
+    importTime = best_time([sys.executable, '-c', 'import idm'], args.repeat)
+    helpTime = best_time([sys.executable, 'idm.py', '--help'], args.repeat)
+    print ("python start up:    {0:.3f} s".format(pythonTime))
+    print ("import idm:         {0:.3f} s (+{1:.3f} s)".format(
+            importTime, importTime - pythonTime))
+    print ("idm.py --help:      {0:.3f} s (+{1:.3f} s)".format(
+            helpTime, helpTime - pythonTime))
+    for seconds, name in slowest_imports():
+        print ("  {0:.3f} s  {1}".format(seconds, name))
+
+    failed = False
+    heavy = heavy_imports()
+    if heavy:
+        print ("import idm imports " + ", ".join(heavy))
+        failed = True
+    if helpTime - pythonTime > args.budget:
+        print ("idm.py --help is over the budget of {0:.3f} s".format(
+                args.budget))
+        failed = True
+    print ("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Table stage equivalence check
+
+Description: Checks the sparse table engine of idm.py (dasy_tables) against
+the DataFrame table stage that dasy_map used before it, which is kept here as
+baseline_tables: the joins of the population counts, a pass over the
+dasymetric DataFrame for each inhabited class and a groupby filter for the
+area weighting. Both run on the same random dasymetric units and population
+counts, with source polygons missing from the counts and duplicate keys, as
+the parts of multipart features have, and DasyWorkTable, PopTable and
+SamplingSummaryTable must agree to within a relative tolerance. Several count
+fields at once are checked against the baseline run for each field. The
+density lookup tables of density_lut are checked for one and several count
+fields, dense and sorted, with the NumPy and, when Numba is installed, the
+Numba kernel, against the DataFrame join that mapped the unit codes to
+densities. The parameter sweep, which evaluates many settings at once, is
+checked against the table stage run for each setting. Needs NumPy and pandas
+only. Exits with status 1 when a check fails, so that it can run in CI.
+"""
+
+import os, sys
+import numpy as np
+import pandas as pd
+import argparse as ap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idm
+
+#Ancillary classes of the random dasymetric units, as in the NLCD
+CLASSES = [0, 11, 21, 22, 23, 24, 41, 42, 52, 71, 81, 82, 90, 95]
+NODATA = -999
+
+
+def baseline_tables(dasy_df, pop_df, popCounts, popCountField, presetData,
+                    popAreaMin = 1, sampleMin = 3, percent = 0.95):
+    '''
+    The table stage of dasy_map before the sparse table engine, without its
+    messages. Takes the DataFrames of idm._unit_tables and popCounts, a
+    Series named popCountField indexed by the population key field, and
+    returns the dasymetric DataFrame, the population DataFrame and the
+    sampling summary DataFrame. POP_EST starts as a float column, so that
+    newer versions of pandas do not refuse the float estimates.
+    '''
+    dasy_df = dasy_df.copy()
+    pop_df = pop_df.copy()
+    #Set variables for DataFrame columns
+    popIDField = 'polyID'
+    ancCatName = 'ancID'
+    dasyAreaField = 'Count'
+
+    #Make lists to use later
+    #All ancillary categories in study area
+    inAncCatList = list(np.unique(dasy_df[ancCatName]).astype(int))
+    
+    '''            
+    This list will be populated with ancillary categories that are not sampled 
+    and do not have preset class densities.
+    '''
+    unSampledList = []
+    
+    '''
+    Uninhabited classes: ancially classes where people do not live. Classes with
+    a preset class density of 0
+    '''
+    unInhabList = [int(presetCat) for presetCat,presetVal in presetData.items()
+                    if float(presetVal) == 0]
+    
+    #Ancillary classes where people can live
+    InhabList = [cat for cat in inAncCatList if cat not in unInhabList]
+    
+    '''
+    Join the census population counts to the dasymetric DataFrame and calculate 
+    population density for the polygon. 
+    '''
+    pop_df.index = pop_df["Value"]
+    
+    '''
+    Join population counts from popCounts to the dasymetric DataFrame and the 
+    population DataFrame. Rename the field to "POP_COUNT" in the dasymetric 
+    DataFrame.
+    '''
+    dasy_df = dasy_df.join(popCounts, 
+                           on = popIDField).rename(
+                                   columns = {popCountField: "POP_COUNT"}
+                                   )
+    pop_df = pop_df.join(popCounts)
+
+    '''
+    Group the dasymetric units that are associated with inhabitable classes by 
+    the census polygon ID and take the sum of the dasymetric area in each 
+    group. Rename the column as "POP_AREA".
+    POP_AREA = sum(pixels) for inhabitable classes
+    '''
+    popAreaSum = dasy_df[
+            dasy_df[ancCatName].isin(InhabList)
+            ].groupby(popIDField)[dasyAreaField].sum().rename("POP_AREA")
+
+    '''
+    Transfer "POP_AREA" from popAreaSum to the dasymetric DataFrame and the 
+    population DataFrame.
+    '''      
+    dasy_df["POP_AREA"] = dasy_df.join(popAreaSum, on = popIDField)["POP_AREA"]
+    pop_df = pop_df.join(popAreaSum).fillna(0)
+
+    '''
+    Calculate population density for census polygons where poulated area is 
+    greater than 0.
+    '''
+    pop_densMask = pop_df["POP_AREA"] > 0
+    pop_df.loc[pop_densMask, "POP_DENS"] = pop_df.loc[
+            pop_densMask, popCountField] / pop_df.loc[pop_densMask, "POP_AREA"]
+    #replace NaN with 0
+    pop_df = pop_df.fillna(0)
+    
+    '''
+    Calculate representative population density for ancillary classes that have 
+    enough representative samples in the study area.
+    '''
+    #Create column for the ancillary class that a polygon is representative of 
+    pop_df["REP_CAT"] = 0
+
+    '''
+    For each inhabitable ancillary class, collect polygon IDs of census 
+    polygons that meet the user-define criteria for being representative of an 
+    ancillary class.
+    '''        
+    for inAncCat in InhabList:
+        repUnits_mask = (
+                dasy_df["POP_AREA"] > float(popAreaMin)
+                ) & (
+                        dasy_df[ancCatName] == inAncCat
+                        )
+        repUnits = dasy_df.loc[
+                repUnits_mask, [
+                        dasyAreaField, popIDField, ancCatName, "POP_AREA"
+                        ]
+                ]
+        repUnits["PERCENT"] = repUnits[dasyAreaField] / repUnits["POP_AREA"]                
+        repUnits = list(
+                repUnits[repUnits["PERCENT"] >= float(percent)][popIDField]
+                )
+                
+        if len(repUnits) >= float(sampleMin):
+            pop_df.loc[pop_df['Value'].isin(repUnits), "REP_CAT"] = inAncCat
+            
+            '''
+            #If ancillary category has no representative polygons and it does 
+            not have a preset class density, then add it to the list of 
+            unsampled classes.
+            '''
+        elif str(inAncCat) not in list(presetData):
+            unSampledList.append(int(inAncCat))
+            
+    #Calculate statistics and make sampling summary table
+    
+    '''
+    Create a mask for rows in the dasymetric DataFrame where REP_CAT =! 0. 
+    We only want to create summaries for these dasymetric rows because they are 
+    associated with representative polygons.
+    '''
+    rep_mask = pop_df["REP_CAT"] != 0
+
+    '''
+    Calculate sum of census population counts and sum of populated area for 
+    each sampled ancillary class.
+    '''
+    classDens_df = pop_df[rep_mask].groupby("REP_CAT")[
+            [popCountField, 'POP_AREA']
+            ].sum().rename(
+            columns = {popCountField: "SUM_" + popCountField, 
+                       "POP_AREA": "SUM_POP_AREA"}
+            )
+            
+    #Calculate sample density for sampled classes
+    classDens_df["SAMPLEDENS"] = classDens_df[
+            "SUM_" + popCountField
+            ] / classDens_df["SUM_POP_AREA"]
+    classDens_df["METHOD"] = "Sampled"
+    classDens_df["CLASSDENS"] = classDens_df["SAMPLEDENS"]
+                    
+    #Add preset densities to summary table
+    if presetData:
+        for preset_cat in list(presetData):
+            classDens_df.loc[int(preset_cat), "CLASSDENS"] = presetData[
+                    preset_cat
+                    ]
+            classDens_df.loc[int(preset_cat), "METHOD"] = 'Preset'
+            
+    # For all sampled and preset classes, calculate a population estimate.
+    #Get representative population densities from class density DataFrame.
+    dasy_df = dasy_df.join(classDens_df['CLASSDENS'], on = ancCatName).fillna(0)
+    
+    '''
+    #Set mask for dasy_df that will limit ancillary categories to those in the 
+    class density DataFrame.
+    '''
+    popEst_mask = dasy_df[ancCatName].isin(classDens_df.index)
+    
+    '''
+    POP_EST = area of the dasymetric unit 
+    * the representative population density of the ancillary class associated 
+    with the dasymetric unit
+    '''
+    dasy_df["POP_EST"] = 0.0
+    dasy_df.loc[popEst_mask, "POP_EST"] = dasy_df.loc[
+            popEst_mask, dasyAreaField
+            ] * dasy_df.loc[
+                    popEst_mask, 'CLASSDENS'
+                    ]
+    
+    # Intelligent areal weighting for unsampled classes            
+    if unSampledList:
+        '''
+        Calculate representative population densities for unsampled ancillary 
+        classes using IAW
+        '''
+        unsampled_mask = dasy_df[ancCatName].isin(unSampledList)
+        
+        '''
+        Populate remainining area of each dasymetric unit as the area of 
+        dasymetric units associated with unsampled classes and 0 everywhere 
+        else.
+        '''
+        dasy_df["REM_AREA"] = 0
+        dasy_df.loc[unsampled_mask, "REM_AREA"] = dasy_df.loc[
+                unsampled_mask, dasyAreaField
+                ]
+        
+        '''                          
+        For each polygon, sum the remaining area and sum the population that 
+        has already been estimated for sampled/preset classes.
+        '''
+        popEstSum = dasy_df.groupby(popIDField)[
+                ["POP_EST", "REM_AREA"]
+                ].sum()
+        
+        '''
+        Join popEstSum to dasy_df to transfer the sum of population estimates 
+        and the sum of remaining area to the dasymetric DataFrame.
+        '''
+        dasy_df = dasy_df.join(popEstSum["POP_EST"], on = popIDField, 
+                               rsuffix = "poly")
+        dasy_df = dasy_df.join(popEstSum["REM_AREA"], on = popIDField, 
+                               rsuffix = "poly")
+        
+        '''
+        Calcualte a population difference between the census population and the 
+        population estimated for sampled/preset ancillary classes.
+        '''
+        dasy_df["POP_DIFF"] = dasy_df["POP_COUNT"] - dasy_df["POP_ESTpoly"]
+        
+        '''
+        Calculate an initial population estimate for dasymetric units 
+        associated with unsampled ancillary classes and polygons where the 
+        sampled/preset population estimates did not exceed the census 
+        population count. 
+        '''
+        diff_mask = (dasy_df[ancCatName].isin(unSampledList) &
+                     dasy_df['REM_AREApoly'] !=0 )
+        dasy_df.loc[diff_mask, "POP_EST"] = (
+                dasy_df.loc[diff_mask, "POP_DIFF"].clip(0) * 
+                dasy_df.loc[diff_mask, "REM_AREA"] / 
+                dasy_df.loc[diff_mask, "REM_AREApoly"])
+        '''
+        Sum total initial population estimates and remaining area for 
+        dasymetric units used to calculate initial population estimates for 
+        unsampled ancillary classes.
+        '''
+        ancCat_sum = dasy_df[diff_mask].groupby(ancCatName)[
+                ["POP_EST" , "REM_AREA"]
+                ].sum()
+        
+        '''
+        Calculate the representative population density for unsampled classes 
+        using ancCat_sum and update the class density DataFrame.
+        '''
+        for cat in ancCat_sum.index:
+            classDens_df.loc[cat, "CLASSDENS"] = ancCat_sum.loc[cat, 
+                            "POP_EST"] / ancCat_sum.loc[cat, 
+                                           "REM_AREA"]
+            classDens_df.loc[cat, "METHOD"] = "IAW"   
+        
+        '''
+        Add representative population densities for unsampled classes in the 
+        dasymetric DataFrame.
+        '''
+        dasy_df.loc[unsampled_mask, 'CLASSDENS'] = dasy_df.loc[
+                unsampled_mask
+                ].join(classDens_df.loc[
+                        ancCat_sum.index, 'CLASSDENS'
+                        ], 
+                on = ancCatName, rsuffix = "_classDens")['CLASSDENS_classDens']
+        
+        '''
+        Calculate new population estimates using representative population 
+        densities for unsampled classes.
+        POP_EST = dasymetric area * class density
+        '''
+        dasy_df.loc[unsampled_mask, "POP_EST"] = dasy_df.loc[unsampled_mask, 
+                   dasyAreaField] * dasy_df.loc[unsampled_mask, 
+                               'CLASSDENS']
+                               
+        # End of intelligent areal weighting
+             
+    # Perform final calculations to ensure pycnophylactic integrity
+    '''
+    For each dasymetric unit, use the ratio of the estimated population to the 
+    total population estimated for the polygon associated with the dasymetric 
+    unit to redistribute the census population.
+    '''
+
+    '''
+    if the sum of population densities within the source unit is equal to 0
+    set the POP_EST for those to 1 (i.e., area weighting (equation 5))
+    '''
+
+    idx = (dasy_df
+            .groupby(popIDField)
+            .filter(
+                lambda s: s['POP_EST'].sum() == 0 and
+                          s['POP_COUNT'].sum() > 0
+                    ).index
+            )
+
+    dasy_df.loc[idx, 'POP_EST'] = 1
+    
+    #Sum population estimates by polygon.
+    popEstsum = dasy_df.groupby(popIDField)["POP_EST"].sum()
+    
+    dasy_df["TOTALFRACT"] = dasy_df["POP_EST"] / dasy_df.join(popEstsum, 
+           on = popIDField, rsuffix = "SUM")["POP_ESTSUM"]
+    dasy_df["NEW_POP"] = dasy_df["TOTALFRACT"] * dasy_df["POP_COUNT"]
+    dasy_df["NEWDENSITY"] = dasy_df["NEW_POP"] / dasy_df[dasyAreaField]    
+    #Replace nan with 0
+    dasy_df = dasy_df.fillna(0)
+    return dasy_df, pop_df, classDens_df
+
+def make_units(seed, nPolys = 80, nClasses = 256):
+    '''
+    Return random unit codes and pixel counts of the dasymetric units of 
+    nPolys source polygons, each covering one to four classes, with the 
+    population key of each polygon index. Some units are large, so that 
+    some polygons are representative of a class.
+    '''
+    rng = np.random.RandomState(seed)
+    polyKeys = np.array(['k{0:05d}'.format(i) for i in range(nPolys)])
+    unitCodes = []
+    counts = []
+    for polyIdx in range(1, nPolys + 1):
+        for cat in rng.choice(CLASSES, size = rng.randint(1, 5), 
+                              replace = False):
+            unitCodes.append(polyIdx * nClasses + cat)
+            counts.append(rng.randint(1, 200) if rng.rand() > 0.3 
+                          else rng.randint(200, 5000))
+    return (np.array(unitCodes, dtype = np.uint64), np.array(counts), 
+            nClasses, polyKeys)
+
+def make_counts(polyKeys, countFields, seed, missing = 0.1, duplicates = 0):
+    '''
+    Return a DataFrame with a random population count for each count field, 
+    indexed by the population key, as read by idm._read_pop_counts. A 
+    fraction missing of the polygons have no count and duplicates keys 
+    appear a second time with other counts, in a random order.
+    '''
+    rng = np.random.RandomState(seed)
+    counts = pd.DataFrame(
+            dict((field, rng.randint(0, 500, len(polyKeys)) * 
+                  (rng.rand(len(polyKeys)) > 0.1))
+                 for field in countFields), 
+            index = polyKeys, columns = countFields)
+    counts = counts[rng.rand(len(polyKeys)) >= missing]
+    if duplicates:
+        extra = counts.iloc[rng.choice(len(counts), duplicates)]
+        extra = extra + rng.randint(1, 50, extra.shape)
+        counts = pd.concat([counts, extra]).sample(frac = 1, 
+                                                   random_state = seed)
+    return counts
+
+def field_frame(expected, actual, field):
+    '''
+    Return the columns of actual, a table of several count fields, that 
+    correspond to the columns of expected, a baseline table of the count 
+    field field.
+    '''
+    columns = [column if column in actual.columns else column + "_" + field
+               for column in expected.columns]
+    return actual[columns].set_axis(expected.columns, axis = 1)
+
+def check_tables(seed, countFields, presetData, params, duplicates, rtol):
+    '''
+    Run dasy_tables and baseline_tables for each count field on the same 
+    units and counts and raise an AssertionError when a table differs.
+    '''
+    unitCodes, counts, nClasses, polyKeys = make_units(seed)
+    popCounts = make_counts(polyKeys, countFields, seed + 1, 
+                            duplicates = duplicates)
+    popCountField = countFields[0] if len(countFields) == 1 \
+        else countFields
+    dasy_df, pop_df = idm._unit_tables(unitCodes, counts, nClasses, polyKeys)
+    tables = idm.dasy_tables(
+            dasy_df, pop_df, 
+            popCounts[popCountField] if len(countFields) == 1 else popCounts,
+            popCountField, presetData, *params)
+    for field in countFields:
+        dasy_df, pop_df = idm._unit_tables(unitCodes, counts, nClasses, 
+                                           polyKeys)
+        expected = baseline_tables(dasy_df, pop_df, popCounts[field], field,
+                                   presetData, *params)
+        for name, expectedTable, table in zip(
+                ["DasyWorkTable", "PopTable", "SamplingSummaryTable"], 
+                expected, tables):
+            try:
+                pd.testing.assert_frame_equal(
+                        expectedTable, field_frame(expectedTable, table, field),
+                        check_dtype = False, check_index_type = False, 
+                        rtol = rtol, atol = rtol)
+            except AssertionError as e:
+                raise AssertionError("{0} of {1} differs: {2}".format(
+                        name, field, str(e).splitlines()[0]))
+
+def check_sweep(seed, countFields, presetData, duplicates, rtol):
+    '''
+    Evaluate a grid of settings at once with idm._sweep_densities, in small 
+    chunks, and raise an AssertionError when the sampling summary, REP_CAT, 
+    NEW_POP or NEWDENSITY of a setting differs from _class_densities run 
+    for that setting alone.
+    '''
+    unitCodes, counts, nClasses, polyKeys = make_units(seed)
+    popCounts = make_counts(polyKeys, countFields, seed + 1, 
+                            duplicates = duplicates)
+    popCountField = countFields[0] if len(countFields) == 1 \
+        else countFields
+    dasy_df, pop_df = idm._unit_tables(unitCodes, counts, nClasses, polyKeys)
+    dasy_df, pop_df = idm._prepare_tables(
+            dasy_df, pop_df, 
+            popCounts[popCountField] if len(countFields) == 1 else popCounts,
+            popCountField, presetData)
+    settings = [(popAreaMin, sampleMin, percent) 
+                for popAreaMin in (0, 1, 50) for sampleMin in (1, 3) 
+                for percent in (0.5, 0.95)]
+    for setting, classDens_df, repCat, newPop, newDensity in \
+            idm._sweep_densities(dasy_df, pop_df, popCountField, presetData,
+                                 settings, chunk_cells = 5 * len(dasy_df)):
+        setDasy_df, setPop_df, expected = idm._class_densities(
+                dasy_df, pop_df, popCountField, presetData, 
+                *settings[setting])
+        try:
+            pd.testing.assert_frame_equal(expected, classDens_df, 
+                                          check_index_type = False, 
+                                          rtol = rtol, atol = rtol)
+        except AssertionError as e:
+            raise AssertionError("SamplingSummaryTable of setting {0} "
+                                 "differs: {1}".format(
+                                         setting, str(e).splitlines()[0]))
+        if not np.array_equal(setPop_df["REP_CAT"].values, repCat):
+            raise AssertionError("REP_CAT of setting {0} differs".format(
+                    setting))
+        for i, field in enumerate(countFields):
+            for column, values in (("NEW_POP", newPop), 
+                                   ("NEWDENSITY", newDensity)):
+                if not np.allclose(setDasy_df[idm._field_column(
+                        column, field, popCountField)].values, 
+                        values[:, i], rtol = rtol, atol = rtol):
+                    raise AssertionError("{0} of {1} in setting {2} "
+                                         "differs".format(column, field, 
+                                                          setting))
+
+def check_lut(seed, nFields, spacing, kernel):
+    '''
+    Look up random unit codes, including NoData and codes that are not in 
+    the table, in a lookup table of nFields count fields made by density_lut 
+    and raise an AssertionError when it differs from a join of the unit codes 
+    to the densities. Units spacing codes apart need a sorted table when 
+    spacing is large.
+    '''
+    rng = np.random.RandomState(seed)
+    unitCodes = np.unique(rng.randint(1, 5000, 300)).astype(np.uint64) * \
+        np.uint64(spacing)
+    densities = rng.rand(len(unitCodes), nFields).astype(np.float32) * 100
+    comb_arr = rng.choice(np.concatenate(
+            [unitCodes, [0, 1, unitCodes.max() + np.uint64(1)]]), 
+            size = (30, 40)).astype(np.uint64)
+    comb_arr[rng.rand(*comb_arr.shape) < 0.05] = unitCodes.max() * \
+        np.uint64(2)
+    lut = idm.density_lut(unitCodes, densities if nFields > 1 
+                          else densities[:, 0], NODATA)
+    dens_arr = idm.lookup_density(lut, comb_arr, NODATA, kernel)
+    for i in range(nFields):
+        dasy_lut = pd.DataFrame({"NEWDENSITY": densities[:, i]}, 
+                                index = unitCodes)
+        expected = pd.DataFrame(np.ravel(comb_arr)).join(
+                dasy_lut, on = 0)['NEWDENSITY'].fillna(NODATA).values
+        actual = dens_arr[..., i] if nFields > 1 else dens_arr
+        if not np.array_equal(np.ravel(actual), expected):
+            raise AssertionError("density of field {0} differs".format(i))
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(description='Check the sparse table engine \
+                               and the density lookup tables of idm.py \
+                               against the DataFrame code they replace.')
+    parser.add_argument('--cases', type = int, default = 50,
+                        help = "The number of random cases of each check \
+                        - default = 50")
+    parser.add_argument('--rtol', type = float, default = 1e-9,
+                        help = "The relative tolerance of the table values \
+                        - default = 1e-9")
+    args = parser.parse_args()
+
+    presets = idm._preset_data()
+    checks = [("one count field", ["POP"], presets, 0),
+              ("duplicate keys", ["POP"], presets, 5),
+              ("preset class", ["POP"], dict(presets, **{"90": 0.02}), 0),
+              ("several count fields", ["POP", "HU"], presets, 0),
+              ("several count fields, duplicate keys", ["POP", "HU"], 
+               presets, 5)]
+    failed = False
+    for name, countFields, presetData, duplicates in checks:
+        errors = []
+        for seed in range(args.cases):
+            rng = np.random.RandomState(seed + 1000)
+            params = (int(rng.choice([0, 1, 5, 50])), 
+                      int(rng.choice([1, 2, 3, 6])), 
+                      float(rng.choice([0.3, 0.5, 0.6, 0.95])))
+            try:
+                check_tables(seed, countFields, presetData, params, 
+                             duplicates, args.rtol)
+            except Exception as e:
+                errors.append("seed {0}, {1}: {2}: {3}".format(
+                        seed, params, type(e).__name__, e))
+        print ("{0:40s} {1}".format(name, "FAILED" if errors else "OK"))
+        for error in errors[:5]:
+            print ("  " + error)
+        failed = failed or bool(errors)
+
+    for name, countFields, duplicates in [
+            ("parameter sweep", ["POP"], 0), 
+            ("parameter sweep, several count fields", ["POP", "HU"], 5)]:
+        errors = []
+        for seed in range(args.cases):
+            try:
+                check_sweep(seed, countFields, presets, duplicates, 
+                            args.rtol)
+            except Exception as e:
+                errors.append("seed {0}: {1}: {2}".format(
+                        seed, type(e).__name__, e))
+        print ("{0:40s} {1}".format(name, "FAILED" if errors else "OK"))
+        for error in errors[:5]:
+            print ("  " + error)
+        failed = failed or bool(errors)
+
+    kernels = ['numpy'] + (['numba'] if idm.numba is not None else [])
+    for kernel in kernels:
+        for nFields in (1, 3):
+            for lutName, spacing in (("dense", 1), ("sorted", 2**20)):
+                name = "{0} LUT, {1} field(s), {2}".format(lutName, nFields, 
+                                                           kernel)
+                errors = []
+                for seed in range(args.cases):
+                    try:
+                        check_lut(seed, nFields, spacing, kernel)
+                    except Exception as e:
+                        errors.append("seed {0}: {1}: {2}".format(
+                                seed, type(e).__name__, e))
+                print ("{0:40s} {1}".format(name, 
+                                            "FAILED" if errors else "OK"))
+                for error in errors[:5]:
+                    print ("  " + error)
+                failed = failed or bool(errors)
+    print ("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
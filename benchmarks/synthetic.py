@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Synthetic inputs for the benchmarks
+
+Description: Generates inputs of any size for dasy_map: a categorical land
+cover raster with a chosen size and class mix, and a mosaic of N source
+polygons with population counts that covers it. The land cover is made of
+square patches of one class with some pixel noise, so that source polygons
+cover several classes and some are homogeneous. The polygons are the cells of
+a grid whose inner vertices are moved at random, so they tile the raster
+without gaps or overlaps. Both are written one block at a time and are
+reproducible from the seed.
+"""
+
+import os, math, hashlib
+from osgeo import gdal, ogr, osr
+import numpy as np
+import argparse as ap
+
+#Class mix of the land cover, roughly that of the NLCD in the eastern US
+DEFAULT_MIX = {11: 0.05, 21: 0.08, 22: 0.06, 23: 0.03, 24: 0.01, 41: 0.25,
+               52: 0.05, 71: 0.05, 81: 0.12, 82: 0.15, 90: 0.10, 95: 0.05}
+
+#Albers equal area (NLCD) grid with 30 m pixels
+EPSG = 5070
+PIXEL_SIZE = 30.0
+ORIGIN = (1500000.0, 2000000.0)
+
+
+def parse_mix(mix):
+    '''
+    Return the classes and their probabilities from a dict or a string like
+    "11:0.1,21:0.3,41:0.6". The fractions are scaled to sum to 1.
+    '''
+    if isinstance(mix, str):
+        mix = dict(item.split(':') for item in mix.split(','))
+    classes = np.array([int(cat) for cat in mix], dtype = np.uint8)
+    fractions = np.array([float(mix[cat]) for cat in mix])
+    if classes.min() == 0 or (fractions < 0).any() or fractions.sum() <= 0:
+        raise ValueError("The class mix needs classes above 0 (the NoData "
+                         "value) and positive fractions")
+    return classes, fractions / fractions.sum()
+
+def make_landcover(path, cols, rows, mix = None, patch = 16, noise = 0.1,
+                   seed = 0, block_rows = 1024):
+    '''
+    Write a cols x rows land cover raster to path. Each patch x patch square
+    gets one class drawn from the class mix and a fraction noise of the
+    pixels get a class drawn independently. 0 is the NoData value.
+    '''
+    classes, fractions = parse_mix(mix or DEFAULT_MIX)
+    rng = np.random.RandomState(seed)
+    patchCols = int(math.ceil(cols / float(patch)))
+    patchRows = int(math.ceil(rows / float(patch)))
+    patches = rng.choice(classes, size = (patchRows, patchCols),
+                         p = fractions)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    rast = gdal.GetDriverByName('GTiff').Create(
+            path, cols, rows, 1, gdal.GDT_Byte,
+            options = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+    rast.SetGeoTransform((ORIGIN[0], PIXEL_SIZE, 0, ORIGIN[1], 0,
+                          -PIXEL_SIZE))
+    rast.SetProjection(srs.ExportToWkt())
+    band = rast.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    block_rows = max(patch, block_rows - block_rows % patch)
+    for yoff in range(0, rows, block_rows):
+        ysize = min(block_rows, rows - yoff)
+        block = np.repeat(np.repeat(
+                patches[yoff // patch:(yoff + ysize - 1) // patch + 1],
+                patch, axis = 0), patch, axis = 1)[:ysize, :cols]
+        noisy = rng.random_sample(block.shape) < noise
+        block[noisy] = rng.choice(classes, size = int(noisy.sum()),
+                                  p = fractions)
+        band.WriteArray(block, 0, yoff)
+    band.ComputeStatistics(False)
+    rast = None
+    return path
+
+def _polygon_wkb(x, y):
+    '''
+    Return the WKB of the quadrilaterals with the corners x, y, arrays of
+    shape (n, 4), as a list of n byte strings.
+    '''
+    n = len(x)
+    wkb = np.zeros(n, dtype = [('order', 'u1'), ('type', '<u4'),
+                               ('rings', '<u4'), ('points', '<u4'),
+                               ('xy', '<f8', (10,))])
+    wkb['order'] = 1
+    wkb['type'] = ogr.wkbPolygon
+    wkb['rings'] = 1
+    wkb['points'] = 5
+    ring = np.empty((n, 5, 2))
+    ring[:, :4, 0] = x
+    ring[:, :4, 1] = y
+    ring[:, 4] = ring[:, 0]
+    wkb['xy'] = ring.reshape(n, 10)
+    size = wkb.dtype.itemsize
+    raw = wkb.tobytes()
+    return [raw[i * size:(i + 1) * size] for i in range(n)]
+
+def make_polygons(path, nUnits, cols, rows, jitter = 0.3, mean_pop = 50,
+                  empty = 0.1, seed = 0, batch = 100000):
+    '''
+    Write nUnits source polygons covering a cols x rows raster of the
+    land cover grid to path, with a polyID key from 1 to nUnits and a POP
+    count. The polygons are the first nUnits cells of a grid of about
+    square cells whose inner vertices are moved by up to jitter cells. The
+    populations follow a log-normal distribution with mean mean_pop and a
+    fraction empty of the polygons are unpopulated.
+    '''
+    rng = np.random.RandomState(seed)
+    nx = max(1, int(round(math.sqrt(nUnits * cols / float(rows)))))
+    ny = int(math.ceil(nUnits / float(nx)))
+    width = cols * PIXEL_SIZE / nx
+    height = rows * PIXEL_SIZE / ny
+    '''
+    Vertices of the grid. Moving the inner vertices by less than half a cell
+    keeps the order of the vertices along both axes, so the cells stay
+    simple polygons that share their edges.
+    '''
+    vx = np.tile(np.arange(nx + 1) * width, (ny + 1, 1))
+    vy = np.tile(-np.arange(ny + 1)[:, None] * height, (1, nx + 1))
+    vx[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (ny - 1, nx - 1)) * width
+    vy[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (ny - 1, nx - 1)) * height
+    vx += ORIGIN[0]
+    vy += ORIGIN[1]
+
+    sigma = 1.0
+    pops = np.round(rng.lognormal(math.log(mean_pop) - sigma ** 2 / 2, sigma,
+                                  nUnits)).astype(np.int64)
+    pops[rng.random_sample(nUnits) < empty] = 0
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    ds = driver.CreateDataSource(path)
+    layer = ds.CreateLayer('units', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('polyID', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('POP', ogr.OFTInteger))
+    layerDefn = layer.GetLayerDefn()
+    for start in range(0, nUnits, batch):
+        idx = np.arange(start, min(start + batch, nUnits))
+        row, col = idx // nx, idx % nx
+        x = np.stack([vx[row, col], vx[row, col + 1], vx[row + 1, col + 1],
+                      vx[row + 1, col]], axis = 1)
+        y = np.stack([vy[row, col], vy[row, col + 1], vy[row + 1, col + 1],
+                      vy[row + 1, col]], axis = 1)
+        wkbs = _polygon_wkb(x, y)
+        layer.StartTransaction()
+        for i, wkb in zip(idx, wkbs):
+            feat = ogr.Feature(layerDefn)
+            feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+            feat.SetField('polyID', int(i + 1))
+            feat.SetField('POP', int(pops[i]))
+            layer.CreateFeature(feat)
+        layer.CommitTransaction()
+    ds = None
+    return path
+
+def make_inputs(data_dir, cols, rows, nUnits, mix = None, seed = 0):
+    '''
+    Write the land cover raster and the source polygons of a scale to
+    data_dir, unless they are there already, and return their paths.
+    '''
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    name = "{0}x{1}_{2}_{3}".format(cols, rows, nUnits, seed)
+    if mix:
+        classes, fractions = parse_mix(mix)
+        name += "_" + hashlib.md5(repr(list(zip(
+                classes.tolist(), fractions.round(6).tolist()))).encode(
+                        'utf-8')).hexdigest()[:8]
+    ancRaster_path = os.path.join(data_dir, "landcover_" + name + ".tif")
+    popFeat_path = os.path.join(data_dir, "units_" + name + ".gpkg")
+    if not os.path.exists(ancRaster_path):
+        make_landcover(ancRaster_path, cols, rows, mix, seed = seed)
+    if not os.path.exists(popFeat_path):
+        make_polygons(popFeat_path, nUnits, cols, rows, seed = seed)
+    return popFeat_path, ancRaster_path
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(description='Generate a synthetic land cover \
+                               raster and source polygons for dasy_map.')
+    parser.add_argument('output_directory', type = str)
+    parser.add_argument('--columns', type = int, default = 4096)
+    parser.add_argument('--rows', type = int, default = 4096)
+    parser.add_argument('--units', type = int, default = 20000,
+                        help = "The number of source polygons")
+    parser.add_argument('--class_mix', type = str,
+                        help = "The classes and their fractions, e.g. \
+                        11:0.1,21:0.3,41:0.6 - default = an NLCD-like mix")
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    popFeat_path, ancRaster_path = make_inputs(
+            args.output_directory, args.columns, args.rows, args.units,
+            args.class_mix, args.seed)
+    print ("Land cover raster: " + ancRaster_path)
+    print ("Source polygons (key polyID, count POP): " + popFeat_path)
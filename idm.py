@@ -18,70 +18,1839 @@ using census polygons where the population estimated for sampled/preset
 ancillary classes did not exceed the census population.
 """
 
-import os, sys, json
-from osgeo import gdal, ogr
-import numpy as np
-import pandas as pd
-import geopandas as gp
+import os, sys, json, hashlib, shutil, tempfile, uuid, time, logging
+import threading, pickle, types, importlib, importlib.util
+import warnings
+import multiprocessing as mp
+from collections import namedtuple, deque, OrderedDict
 import argparse as ap
 
+#Module imported when one of its attributes is first used
+class _LazyModule(types.ModuleType):
+    '''
+    Stand in for the module name until one of its attributes is used, then 
+    import it and take over its attributes. This keeps GDAL, NumPy, pandas 
+    and the optional modules out of the start up of the command line, e.g. 
+    of --help and of argument errors.
+    '''
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
 
-#IDM function
-def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path, 
-              out_dir,  popAreaMin = 1, sampleMin = 3, percent = 0.95, 
-              uninhab_path = False, anc_nd = 0, pop_nd = 0):
+def _lazy_import(name, optional = False):
     '''
-    Prepare population density rasters given population and ancillary data 
-    through intelligent dasymetric mapping. -popFeat_path: The path to the \
-    census polygons with unique identifiers and a count of the population for \
-    each polygon. - popCountField: The field in the population_features that \
-    stores the polygon's populations.- popKeyField: The unique identifier \
-    field for each polygon in population_features. -ancRaster_path: The path \
-    to the land cover raster that is used for dasymetric population mapping. \
-    -out_dir: The directory where all outputs will be saved. \
-    -popAreaMin: The minimum number of raster cells in a source polygon for \
-    it to be considered representative of a class (default = 1). -sampleMin: \
-    The minimum number of source units to ensure a representative sample for \
-    a land cover class (default = 3). -percent: The minimum percent of a \
-    source polygon's area that an ancillary class must cover in order for the \
-    source polygon to be considered representative of that class. Enter as a \
-    decimal (default = 0.95). -uninhab_path: An optional shapefile containing \
-    uninhabited areas. -anc_nd: The NoData value for the ancillary raster \
-    (default = 0). -pop_nd: The NoData value for the population \
-    raster (default = 0)   
+    Return a _LazyModule for the module name, or None when the module is 
+    optional and not installed.
+    '''
+    if optional and importlib.util.find_spec(name) is None:
+        return None
+    return _LazyModule(name)
+
+gdal = _lazy_import('osgeo.gdal')
+ogr = _lazy_import('osgeo.ogr')
+osr = _lazy_import('osgeo.osr')
+np = _lazy_import('numpy')
+pd = _lazy_import('pandas')
+
+#pyarrow is optional; it speeds up reading attributes with GDAL >= 3.8
+pa = _lazy_import('pyarrow', optional = True)
+
+#numba is optional; it compiles the fused pixel kernels
+numba = _lazy_import('numba', optional = True)
+
+#resource is only available on Unix; it gives the peak memory of a run
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#Progress messages of the toolbox
+logger = logging.getLogger("idm")
+
+#Windows for streaming through a raster band
+def _iter_windows(band, tile_size = 2048, extent = None):
+    '''
+    Yield (xoff, yoff, xsize, ysize) windows that cover a raster band in GDAL
+    block order. Windows are whole multiples of the band's natural block size
+    and hold about tile_size * tile_size pixels, so a striped raster is read
+    as full-width strips and a tiled raster as groups of tiles. When extent 
+    is an (xoff, yoff, xsize, ysize) window of the band, only that part of 
+    the band is covered; the windows stay aligned to the blocks of the band 
+    and are clipped to the extent.
+    '''
+    cols = band.XSize
+    rows = band.YSize
+    x0, y0, xsize, ysize = extent or (0, 0, cols, rows)
+    blockX, blockY = band.GetBlockSize()
+    tile_size = max(int(tile_size), 1)
+    if blockX >= cols:
+        winX = cols
+        winY = max(blockY, (tile_size * tile_size // max(xsize, 1)) 
+                   // blockY * blockY)
+    else:
+        winX = max(blockX, tile_size // blockX * blockX)
+        winY = max(blockY, tile_size // blockY * blockY)
+    for yoff in range(y0 // winY * winY, y0 + ysize, winY):
+        for xoff in range(x0 // winX * winX, x0 + xsize, winX):
+            winX0 = max(xoff, x0)
+            winY0 = max(yoff, y0)
+            yield (winX0, winY0, min(xoff + winX, x0 + xsize) - winX0, 
+                   min(yoff + winY, y0 + ysize) - winY0)
+
+#Window of a raster grid that covers a set of envelopes
+def _footprint_window(envelopes, geoTransform, cols, rows, pad = 0):
+    '''
+    Return the (xoff, yoff, xsize, ysize) window of a north-up raster grid 
+    that covers the (minX, maxX, minY, maxY) envelopes, padded by pad pixels 
+    on each side and clipped to the cols and rows of the raster. The window 
+    is snapped outwards to whole pixels of the grid.
     '''
-    #Set config.json file in the script's directory to presetTable
-    if __name__ == '__main__':
-        presetTable = os.path.join(sys.path[0], "config.json")
+    if len(envelopes) == 0:
+        raise ValueError("There are no population features to map")
+    envelopes = np.asarray(envelopes)
+    xs = sorted([(envelopes[:, 0].min() - geoTransform[0]) / geoTransform[1],
+                 (envelopes[:, 1].max() - geoTransform[0]) / geoTransform[1]])
+    ys = sorted([(envelopes[:, 3].max() - geoTransform[3]) / geoTransform[5],
+                 (envelopes[:, 2].min() - geoTransform[3]) / geoTransform[5]])
+    x0 = max(int(np.floor(xs[0])) - pad, 0)
+    x1 = min(int(np.ceil(xs[1])) + pad, cols)
+    y0 = max(int(np.floor(ys[0])) - pad, 0)
+    y1 = min(int(np.ceil(ys[1])) + pad, rows)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("The population features do not overlap the "
+                         "ancillary raster")
+    return x0, y0, x1 - x0, y1 - y0
+
+#Number of ancillary classes used to pack unit codes
+def _class_count(band, anc_nd = 0):
+    '''
+    Return the number of ancillary classes nClasses such that every value of
+    the ancillary raster band and anc_nd is a whole number from 0 to
+    nClasses - 1. Byte and UInt16 rasters use the full range of the data type;
+    other data types are scanned for their minimum and maximum.
+    '''
+    if band.DataType == gdal.GDT_Byte:
+        nClasses = 2**8
+    elif band.DataType == gdal.GDT_UInt16:
+        nClasses = 2**16
     else:
-        presetTable = os.path.join(sys.path[-1], "config.json")
-    
-    print ('population_features path: {0}'.format(popFeat_path))
-    print ('population_count_field: {0}'.format(popCountField))
-    print ('population_key_field: {0}'.format(popKeyField))
-    print ('ancillary_raster: {0}'.format(ancRaster_path))
-    print ('uninhabited_file: {0}'.format(uninhab_path))
-    print ('The minimum populated area of a representative unit is ' + str(popAreaMin))
-    print ('The minimum sample size is ' + str(sampleMin))
-    print ('The percent is ' + str(percent))
-    print ('The NoData value for the population raster is ' + str(pop_nd))
-    print ('The NoData value for the ancillary raster is ' + str(anc_nd))
-
-    #Set file names for outputs
-    popRaster = os.path.join(out_dir, "PopRaster.tif")
-    popWorkTable = os.path.join(out_dir, "PopTable.csv")
-    dasyRaster = os.path.join(out_dir, "DasyRaster.tif")
-    dasyWorkTable = os.path.join(out_dir, "DasyWorkTable.csv")
-    densityRaster = os.path.join(out_dir, "DensityRaster.tif")
+        minVal, maxVal = band.ComputeRasterMinMax(False)
+        if minVal < 0:
+            raise ValueError("Ancillary classes must be positive whole "
+                             "numbers, found " + str(minVal))
+        nClasses = int(maxVal) + 1
+    if anc_nd < 0:
+        raise ValueError("The NoData value for the ancillary raster must be a "
+                         "positive whole number")
+    return max(nClasses, int(anc_nd) + 1)
+
+#Unit codes for a window of the population and ancillary rasters
+def _unit_codes(pop_arr, anc_arr, nClasses, unit_dtype = None):
+    '''
+    Combine a window of the polygon index raster and the ancillary raster into
+    dasymetric unit codes: polygon index * nClasses + ancillary class. Pixels
+    outside of the census polygons (polygon index 0) get the unit code 0.
+    The codes are of type unit_dtype (default = np.uint64).
+    '''
+    unit_dtype = unit_dtype or np.uint64
+    comb_arr = pop_arr.astype(unit_dtype)
+    comb_arr *= unit_dtype(nClasses)
+    comb_arr += anc_arr.astype(unit_dtype)
+    comb_arr[pop_arr == 0] = 0
+    return comb_arr
+
+#Polygon by class crosstab of a window
+def zonal_crosstab(pop_arr, anc_arr, nClasses):
+    '''
+    Count the pixels of each (polygon index, ancillary class) pair in a window
+    of the polygon index raster and the ancillary raster in linear time.
+    Returns the unit codes (polygon index * nClasses + ancillary class) of the
+    pairs found in the window and their pixel counts. Pixels with polygon
+    index 0 are outside of the census polygons and are not counted. Classes
+    and polygon indices are relabeled to the ranges found in the window and
+    counted with np.bincount; windows where the polygon indices are too spread
+    out for a dense histogram fall back to np.unique.
+    '''
+    pop = pop_arr.ravel()
+    anc = anc_arr.ravel()
+    inPoly = pop != 0
+    if not inPoly.all():
+        pop = pop[inPoly]
+        anc = anc[inPoly]
+    if pop.size == 0:
+        return np.zeros(0, dtype = np.uint64), np.zeros(0, dtype = np.int64)
+    anc = anc.astype(np.intp, copy = False)
+
+    #Relabel the ancillary classes found in the window as 0 to nLocal - 1
+    ancPresent = np.flatnonzero(np.bincount(anc, minlength = nClasses))
+    nLocal = ancPresent.size
+    if nLocal < nClasses:
+        classLut = np.zeros(nClasses, dtype = np.intp)
+        classLut[ancPresent] = np.arange(nLocal)
+        anc = classLut[anc]
+
+    popMin = int(pop.min())
+    popSpan = int(pop.max()) - popMin + 1
+    nBins = popSpan * nLocal
+    if nBins <= max(4 * pop.size, 2**16):
+        local = (pop - popMin).astype(np.intp)
+        local *= nLocal
+        local += anc
+        counts = np.bincount(local, minlength = nBins)
+        found = np.flatnonzero(counts)
+        popIdx = (found // nLocal + popMin).astype(np.uint64)
+        unitCodes = popIdx * np.uint64(nClasses) + ancPresent[
+                found % nLocal].astype(np.uint64)
+        return unitCodes, counts[found]
+
+    unitCodes = pop.astype(np.uint64) * np.uint64(nClasses) + ancPresent[
+            anc].astype(np.uint64)
+    return np.unique(unitCodes, return_counts = True)
+
+#Merge the crosstabs of several windows
+def merge_crosstabs(crosstabs):
+    '''
+    Merge a list of (unitCodes, counts) pairs returned by zonal_crosstab for
+    each window into sorted unique unit codes and their total pixel counts.
+    Units that cross window boundaries are summed.
+    '''
+    unitCodes = np.concatenate([np.zeros(0, dtype = np.uint64)] +
+                               [codes for codes, counts in crosstabs])
+    counts = np.concatenate([np.zeros(0, dtype = np.int64)] +
+                            [counts for codes, counts in crosstabs])
+    unitCodes, inverse = np.unique(unitCodes, return_inverse = True)
+    counts = np.bincount(inverse.ravel(), weights = counts,
+                         minlength = unitCodes.size).astype(np.int64)
+    return unitCodes, counts
+
+#Dasymetric and population DataFrames from unit counts
+def _unit_tables(unitCodes, counts, nClasses, polyKeys):
+    '''
+    Make the dasymetric DataFrame (Value, Count, ancID, polyID) and the
+    population DataFrame (Value, POLY_IDX, Count) from the unit codes and
+    pixel counts of the dasymetric units. The polygon index of each unit is
+    mapped back to the population key field with polyKeys.
+    '''
+    polyIdx = (unitCodes // np.uint64(nClasses)).astype(np.int64)
+    dasy_df = pd.DataFrame({
+            "Value": unitCodes,
+            "Count": counts,
+            "ancID": (unitCodes % np.uint64(nClasses)).astype(np.int64),
+            "polyID": polyKeys[polyIdx - 1]
+            }, columns = ["Value", "Count", "ancID", "polyID"])
+
+    popCounts = np.bincount(polyIdx, weights = counts,
+                            minlength = len(polyKeys) + 1).astype(np.int64)
+    popIdx = np.flatnonzero(popCounts)
+    pop_df = pd.DataFrame({
+            "Value": polyKeys[popIdx - 1],
+            "POLY_IDX": popIdx,
+            "Count": popCounts[popIdx]
+            }, columns = ["Value", "POLY_IDX", "Count"])
+    return dasy_df, pop_df
+
+#Lookup table from unit codes to population density
+def density_lut(unitCodes, densities, nodata = -999):
+    '''
+    Build a lookup table that maps dasymetric unit codes to population density.
+    When the largest unit code is small enough the table is a dense float32
+    array indexed by unit code; otherwise it is a pair of sorted unit codes and
+    their densities for a binary search. Unit codes that are not in the table,
+    including the NoData unit code 0, map to nodata. densities can have a 
+    column for each of several count fields.
+    '''
+    unitCodes = np.asarray(unitCodes, dtype = np.uint64)
+    densities = np.asarray(densities, dtype = np.float32)
+    maxCode = int(unitCodes.max()) if unitCodes.size else 0
+    if maxCode + 1 <= max(2**24, 16 * unitCodes.size):
+        lutDens = np.full((maxCode + 1,) + densities.shape[1:], nodata, 
+                          dtype = np.float32)
+        lutDens[unitCodes] = densities
+        return None, lutDens
+    order = np.argsort(unitCodes)
+    return unitCodes[order], densities[order]
+
+#Population density of each pixel in a window of unit codes
+def lookup_density(lut, comb_arr, nodata = -999, kernel = 'numpy'):
+    '''
+    Map a window of dasymetric unit codes to a float32 array of population
+    density using a lookup table made by density_lut. With several count 
+    fields the last axis of the array holds the density of each field. The 
+    "numba" kernel looks up a dense table in one loop over the pixels.
+    '''
+    lutCodes, lutDens = lut
+    if lutCodes is None and kernel == 'numba':
+        dens_arr = np.empty(comb_arr.shape + lutDens.shape[1:], 
+                            dtype = np.float32)
+        _jit(_fused_lookup)(np.ascontiguousarray(comb_arr).reshape(-1), 
+                            lutDens.reshape(lutDens.shape[0], -1), 
+                            np.float32(nodata), 
+                            dens_arr.reshape(comb_arr.size, -1))
+        return dens_arr
+    if lutCodes is None:
+        if comb_arr.dtype == np.uint64:
+            #take only accepts indices that fit in a signed integer
+            comb_arr = np.minimum(comb_arr, 
+                                  np.uint64(lutDens.shape[0])).astype(np.intp)
+        dens_arr = lutDens.take(comb_arr, axis = 0, mode = 'clip')
+        outside = comb_arr >= lutDens.shape[0]
+        if outside.any():
+            dens_arr[outside] = nodata
+        return dens_arr
+    comb_arr = comb_arr.astype(lutCodes.dtype, copy = False)
+    pos = np.searchsorted(lutCodes, comb_arr)
+    np.minimum(pos, max(lutCodes.size - 1, 0), out = pos)
+    dens_arr = lutDens.take(pos, axis = 0, mode = 'clip')
+    dens_arr[lutCodes.take(pos, mode = 'clip') != comb_arr] = nodata
+    return dens_arr
+
+#Pixel counts and population of the target zones in a window
+def zone_sums(zone_arr, dens_arr, nodata = -999):
+    '''
+    Return an array with a row for each zone index from 0 to the largest 
+    index in zone_arr, holding the number of pixels of the zone in the 
+    window and, for each band of dens_arr, the sum of the population 
+    density of its pixels. The density is the population of a pixel, so 
+    the sums are the (fractional) populations of the zones. Pixels with the 
+    nodata density add nothing to the population; zone 0 is outside of all 
+    zones.
+    '''
+    zones = zone_arr.ravel()
+    dens = dens_arr.reshape(zones.size, -1)
+    inZone = np.flatnonzero(zones)
+    zones = zones[inZone].astype(np.intp)
+    nZones = int(zones.max()) + 1 if zones.size else 1
+    sums = np.zeros((nZones, 1 + dens.shape[1]))
+    sums[:, 0] = np.bincount(zones, minlength = nZones)
+    for band in range(dens.shape[1]):
+        bandDens = dens[inZone, band].astype(np.float64)
+        bandDens[(bandDens == nodata) | np.isnan(bandDens)] = 0
+        sums[:, band + 1] = np.bincount(zones, weights = bandDens, 
+                                        minlength = nZones)
+    return sums
+
+#Pixel counts and population of the target zones of a layer in a window
+def _zone_window_sums(polys, window, geoTransform, dens_arr, nodata = -999):
+    '''
+    Return the zone_sums of the zones of a PolygonSet, with the zone index 
+    as burn value, in a window of the grid described by geoTransform. 
+    Zones can overlap, e.g. service buffers or flood zones, and every zone 
+    gets all the pixels whose centers it covers. The zones are rasterized 
+    together, which is exact where no two features cover the same pixel. 
+    Otherwise they are rasterized again in groups of zones whose envelopes 
+    do not overlap (_envelope_groups) and the sums of the groups are added 
+    up; row 0 then holds the pixels outside of all zones of each group.
+    '''
+    if _rasterize_window(polys, window, geoTransform, 
+                         coverage = True).max() <= 1:
+        return zone_sums(_rasterize_window(polys, window, geoTransform), 
+                         dens_arr, nodata)
+    sel = _window_polygons(polys, window, geoTransform)
+    nBands = 1 if dens_arr.ndim == 2 else dens_arr.shape[2]
+    sums = np.zeros((int(polys.values[sel].max()) + 1, 1 + nBands))
+    for group in _envelope_groups(polys.envelopes[sel], polys.values[sel]):
+        groupSums = zone_sums(_rasterize_window(polys, window, geoTransform, 
+                                                subset = sel[group]), 
+                              dens_arr, nodata)
+        sums[:len(groupSums)] += groupSums
+    return sums
+
+#Pixel kernels: "auto" uses the fused Numba kernels when Numba is installed
+KERNELS = ('auto', 'numpy', 'numba')
+
+def _check_kernel(kernel):
+    '''
+    Return the pixel kernel used for kernel, "numba" or "numpy".
+    '''
+    if kernel not in KERNELS:
+        raise ValueError("The kernel must be one of " + ", ".join(KERNELS))
+    if kernel == 'numba' and numba is None:
+        raise ImportError("numba is required for the numba kernel")
+    if kernel == 'auto':
+        return 'numpy' if numba is None else 'numba'
+    return kernel
+
+#Fused unit codes and crosstab of the flattened arrays of a window
+def _fused_units(pop, anc, uninhab, anc_nd, nClasses, maxBins, comb):
+    '''
+    Loop over the pixels of a window once to give the pixels in uninhabited 
+    areas (uninhab != 0; an empty array when there are none) the class 
+    anc_nd in anc and to find the polygon indices and classes in the window, 
+    and once more to write the unit code of each pixel to comb and count 
+    the pixels of each unit in a dense histogram of those polygons and 
+    classes. Returns the unit codes and pixel counts as zonal_crosstab, and 
+    whether the histogram had at most maxBins bins; otherwise the counts are 
+    empty and only comb is written.
+    '''
+    n = pop.size
+    hasUninhab = uninhab.size > 0
+    present = np.zeros(nClasses, dtype = np.bool_)
+    popMin = np.int64(2**62)
+    popMax = np.int64(0)
+    for i in range(n):
+        if hasUninhab and uninhab[i] != 0:
+            anc[i] = anc_nd
+        p = np.int64(pop[i])
+        if p != 0:
+            present[np.int64(anc[i])] = True
+            popMin = min(popMin, p)
+            popMax = max(popMax, p)
+    
+    #Relabel the classes found in the window as 0 to nLocal - 1
+    classLut = np.zeros(nClasses, dtype = np.int64)
+    classes = np.zeros(nClasses, dtype = np.int64)
+    nLocal = 0
+    for c in range(nClasses):
+        if present[c]:
+            classLut[c] = nLocal
+            classes[nLocal] = c
+            nLocal += 1
+    nBins = (popMax - popMin + 1) * nLocal if popMax > 0 else 0
+    dense = nBins <= maxBins
+    counts = np.zeros(nBins if dense else 0, dtype = np.int64)
+    for i in range(n):
+        p = np.int64(pop[i])
+        if p == 0:
+            comb[i] = 0
+        else:
+            a = np.int64(anc[i])
+            comb[i] = p * nClasses + a
+            if dense:
+                counts[(p - popMin) * nLocal + classLut[a]] += 1
+    
+    nFound = 0
+    for j in range(counts.size):
+        if counts[j] != 0:
+            nFound += 1
+    unitCodes = np.zeros(nFound, dtype = np.uint64)
+    unitCounts = np.zeros(nFound, dtype = np.int64)
+    k = 0
+    for j in range(counts.size):
+        if counts[j] != 0:
+            unitCodes[k] = (j // nLocal + popMin) * nClasses + \
+                classes[j % nLocal]
+            unitCounts[k] = counts[j]
+            k += 1
+    return unitCodes, unitCounts, dense
+
+#Fused lookup of the population density of the flattened unit codes
+def _fused_lookup(comb, lutDens, nodata, dens):
+    '''
+    Write the row of lutDens (unit codes by count fields) of each unit code 
+    in comb to dens, or nodata for unit codes beyond the table.
+    '''
+    size = lutDens.shape[0]
+    for i in range(comb.size):
+        c = np.int64(comb[i])
+        if c >= 0 and c < size:
+            for j in range(lutDens.shape[1]):
+                dens[i, j] = lutDens[c, j]
+        else:
+            for j in range(lutDens.shape[1]):
+                dens[i, j] = nodata
+
+#Kernels compiled with Numba, by Python function
+_JIT = {}
+
+def _jit(func):
+    '''
+    Return func compiled with Numba, compiling it when it is first used so 
+    that Numba is only imported by runs that use the numba kernel.
+    '''
+    if func not in _JIT:
+        _JIT[func] = numba.njit(nogil = True, cache = True)(func)
+    return _JIT[func]
+
+#Unit codes and crosstab of a window with a pixel kernel
+def window_units(pop_arr, anc_arr, nClasses, unit_dtype = None,
+                 uninhab_arr = None, anc_nd = 0, kernel = 'numpy'):
+    '''
+    Give the pixels in uninhabited areas (uninhab_arr != 0) the class anc_nd 
+    in anc_arr, in place, and return the unit codes of the window as 
+    _unit_codes and its crosstab as zonal_crosstab. The "numba" kernel does 
+    this in two fused loops over the pixels instead of a pass over the 
+    whole window, with a temporary array, for each step. It writes to 
+    anc_arr through a flat view, so other arrays use the NumPy kernel.
+    '''
+    unit_dtype = unit_dtype or np.uint64
+    if kernel != 'numba' or not anc_arr.flags.c_contiguous:
+        if uninhab_arr is not None:
+            anc_arr[uninhab_arr != 0] = anc_nd
+        return (_unit_codes(pop_arr, anc_arr, nClasses, unit_dtype),
+                zonal_crosstab(pop_arr, anc_arr, nClasses))
+    comb_arr = np.empty(pop_arr.shape, dtype = unit_dtype)
+    uninhab = np.zeros(0, dtype = np.uint8) if uninhab_arr is None else \
+        np.ascontiguousarray(uninhab_arr).reshape(-1)
+    unitCodes, unitCounts, dense = _jit(_fused_units)(
+            np.ascontiguousarray(pop_arr).reshape(-1), anc_arr.reshape(-1), 
+            uninhab, int(anc_nd), int(nClasses), 
+            max(4 * pop_arr.size, 2**16), comb_arr.reshape(-1))
+    if not dense:
+        #Polygon indices too spread out for a dense histogram
+        return comb_arr, zonal_crosstab(pop_arr, anc_arr, nClasses)
+    return comb_arr, (unitCodes, unitCounts)
+
+#Output profiles: how the output rasters are laid out and compressed
+OUTPUT_PROFILES = ('lzw', 'cog')
+
+def _creation_options(profile = 'lzw', gdt = None):
+    '''
+    Return the GTiff creation options of an output raster of data type gdt 
+    (default = GDT_Float32). The "lzw" profile writes striped, 
+    LZW-compressed rasters. The "cog" profile writes 512 x 512 tiles 
+    compressed with ZSTD (or DEFLATE when GDAL is built without ZSTD) and a 
+    predictor, using all CPUs.
+    '''
+    if profile == 'lzw':
+        return ['COMPRESS=LZW']
+    if profile != 'cog':
+        raise ValueError("The output profile must be one of " + 
+                         ", ".join(OUTPUT_PROFILES))
+    optionList = gdal.GetDriverByName('GTiff').GetMetadataItem(
+            'DMD_CREATIONOPTIONLIST') or ''
+    compress = 'ZSTD' if 'ZSTD' in optionList else 'DEFLATE'
+    if gdt is None:
+        gdt = gdal.GDT_Float32
+    predictor = 3 if gdt in (gdal.GDT_Float32, gdal.GDT_Float64) else 2
+    return ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 
+            'COMPRESS=' + compress, 'PREDICTOR={0}'.format(predictor),
+            'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+
+def _create_raster(path, xsize, ysize, gdt, geoTransform, projection,
+                   nodata = None, profile = 'lzw', bands = 1):
+    '''
+    Create a GTiff raster with the creation options of the output profile 
+    and return it. Rasters with more than one band are band interleaved, as 
+    they are written one band at a time.
+    '''
+    options = _creation_options(profile, gdt)
+    if bands > 1:
+        options.append('INTERLEAVE=BAND')
+    rast = gdal.GetDriverByName('GTiff').Create(
+            path, xsize, ysize, bands, gdt, options = options)
+    if rast is None:
+        raise IOError("Unable to create raster " + path)
+    rast.SetGeoTransform(geoTransform)
+    rast.SetProjection(projection)
+    if nodata is not None:
+        for band in range(bands):
+            rast.GetRasterBand(band + 1).SetNoDataValue(nodata)
+    return rast
+
+#Narrowest unsigned integer type for a raster of codes
+def _uint_type(maxValue):
+    '''
+    Return the narrowest GDAL data type and numpy dtype that hold whole 
+    numbers from 0 to maxValue. Values beyond 32 bits are stored as UInt64 
+    when GDAL supports it and as Float64, which is exact up to 2**53, 
+    otherwise.
+    '''
+    for gdt, dtype in ((gdal.GDT_Byte, np.uint8), 
+                       (gdal.GDT_UInt16, np.uint16),
+                       (gdal.GDT_UInt32, np.uint32)):
+        if maxValue <= np.iinfo(dtype).max:
+            return gdt, dtype
+    return getattr(gdal, 'GDT_UInt64', gdal.GDT_Float64), np.uint64
+
+#Formats of the output tables and their file extensions
+TABLE_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+#Check that the tables can be written in table_format
+def _check_table_format(table_format):
+    if table_format not in TABLE_FORMATS:
+        raise ValueError("The table format must be one of " + 
+                         ", ".join(TABLE_FORMATS))
+    if table_format != 'csv' and pa is None:
+        raise ImportError("pyarrow is required to write " + table_format + 
+                          " tables")
+
+#Columns stored as 32-bit types in the Parquet and Feather tables
+_INT32_COLUMNS = ('ancID', 'REP_CAT')
+_FLOAT32_COLUMNS = ('POP_DENS', 'SAMPLEDENS', 'CLASSDENS', 'NEWDENSITY')
+
+def _is_density_column(column):
+    #Density columns, also those of each count field, e.g. NEWDENSITY_POP10
+    return any(column == name or column.startswith(name + "_") 
+               for name in _FLOAT32_COLUMNS)
+
+def _write_table(df, table_path, table_format = 'csv', index = True,
+                 rows_per_group = 2**20):
+    '''
+    Write a table to table_path plus the extension of table_format and 
+    return the path. CSV tables are written as before, always with the index 
+    as the first column, so index only applies to the other formats. Parquet 
+    and Feather tables have typed columns: ancID and REP_CAT as 32-bit 
+    integers and densities as 32-bit floats. Their index is written as a 
+    column when index is True and left out otherwise. All formats are 
+    written rows_per_group rows at a time (one Parquet row group or Arrow 
+    record batch each), so the whole table is never converted at once.
+    '''
+    _check_table_format(table_format)
+    table_path += TABLE_FORMATS[table_format]
+    if table_format == 'csv':
+        df.to_csv(table_path, header = True, chunksize = rows_per_group)
+        return table_path
+    import pyarrow.parquet as pq
     
+    df = df.reset_index() if index else df.reset_index(drop = True)
+    for column in df.columns:
+        if column in _INT32_COLUMNS and df[column].dtype.kind in 'iuf':
+            df[column] = df[column].astype(np.int32)
+        elif _is_density_column(column) and df[column].dtype.kind in 'iuf':
+            df[column] = df[column].astype(np.float32)
+    schema = pa.Schema.from_pandas(df, preserve_index = False)
+    if table_format == 'parquet':
+        writer = pq.ParquetWriter(table_path, schema)
+    else:
+        writer = pa.ipc.new_file(table_path, schema)
+    try:
+        for start in range(0, len(df), rows_per_group):
+            batch = pa.Table.from_pandas(
+                    df.iloc[start:start + rows_per_group], schema = schema, 
+                    preserve_index = False)
+            writer.write_table(batch)
+    finally:
+        writer.close()
+    return table_path
+
+#Read the columns of a table written by _write_table
+def _read_table(table_path, columns = None):
+    '''
+    Read a CSV, Parquet or Feather table, chosen by its file extension.
+    '''
+    extension = os.path.splitext(table_path)[1].lower()
+    if extension == '.parquet':
+        return pd.read_parquet(table_path, columns = columns)
+    if extension == '.feather':
+        return pd.read_feather(table_path, columns = columns)
+    return pd.read_csv(table_path, usecols = columns)
+
+#Population density raster from the dasymetric raster
+def render_density(dasyRaster_path, dasy_table, densityRaster_path,
+                   tile_size = 2048, nodata = -999, workers = 1, 
+                   profile = 'lzw', fields = ('NEWDENSITY',), 
+                   kernel = 'auto', threads = 0, queue_depth = None,
+                   zones = ()):
+    '''
+    Create the population density raster from the dasymetric raster and the
+    dasymetric working table, one window at a time. -dasyRaster_path: The \
+    path to DasyRaster.tif. -dasy_table: A DataFrame or the path to a saved \
+    DasyWorkTable (.csv, .parquet or .feather) with the "Value" and \
+    "NEWDENSITY" of each unit. \
+    -densityRaster_path: The path of the population density raster to \
+    create, or a list with a path for each of the fields. -tile_size: The \
+    approximate width and height in pixels of the windows \
+    (default = 2048). -nodata: The NoData value for the population \
+    density raster (default = -999). -workers: The number of processes that \
+    look up the population density of the windows (default = 1). \
+    -profile: The output profile, "lzw" or "cog". With "cog" the raster is \
+    tiled and gets internal overviews in the cloud optimized GeoTIFF \
+    layout (default = "lzw"). -fields: The density columns of dasy_table \
+    to render. With more than one field and a single densityRaster_path \
+    the raster has a band for each field, in order, named after the field \
+    (default = ("NEWDENSITY",)). -kernel: The pixel kernel, "numpy", \
+    "numba" or "auto" for numba when it is installed (default = "auto"). \
+    -threads: With one worker, the number of threads that read the windows \
+    and look up their densities while this thread compresses and writes \
+    them; 0 does everything in this thread (default = 0). -queue_depth: \
+    The number of windows read ahead of the window being written \
+    (default = twice the number of workers or threads). -zones: Target \
+    zone layers whose population is summed while the raster is rendered, \
+    each given as a path or a (path, key field) pair; without a key field \
+    the zones are keyed by their FID. Each zone layer is rasterized one \
+    window at a time on the grid of the dasymetric raster and its zones \
+    get the pixels whose centers they cover; features with the same key \
+    form one zone and a pixel covered by overlapping zones counts toward \
+    each of them, so the totals of overlapping zones (e.g. service \
+    buffers) can add up to more than the population. Returns a \
+    DataFrame for each zone layer with the key of each zone, the number of \
+    pixels of the zone in the raster (Count) and its population for each \
+    field (e.g. NEW_POP for NEWDENSITY). The pass resumes from the windows \
+    saved by the active checkpoint, if any.
+    '''
+    kernel = _check_kernel(kernel)
+    fields = list(fields)
+    if not isinstance(dasy_table, pd.DataFrame):
+        dasy_table = _read_table(dasy_table, ['Value'] + fields)
+    if len(fields) == 1:
+        lut = density_lut(dasy_table['Value'], dasy_table[fields[0]], nodata)
+    else:
+        lut = density_lut(dasy_table['Value'], dasy_table[fields].values, 
+                          nodata)
+
+    dasyRast = gdal.Open(dasyRaster_path)
+    dasyRast_b1 = dasyRast.GetRasterBand(1)
+    '''
+    The fields are written to the bands of one raster, or to one raster each 
+    when a list of paths is given. A cloud optimized GeoTIFF has its 
+    overviews before the full resolution tiles, so it is copied from a tiled 
+    raster whose overviews have been built.
+    '''
+    if isinstance(densityRaster_path, str):
+        outputs = [(densityRaster_path, len(fields))]
+    else:
+        outputs = [(path, 1) for path in densityRaster_path]
+        if len(outputs) != len(fields):
+            raise ValueError("There must be one density raster for each "
+                             "field")
+    densPaths = [os.path.splitext(path)[0] + ".tmp.tif" if profile == 'cog' 
+                 else path for path, nBands in outputs]
+
+    '''
+    Resume the pass when the checkpoint of an interrupted run has saved 
+    some of its windows, with the sums of the target zones so far, and the 
+    rasters are still there.
+    '''
+    windows = list(_iter_windows(dasyRast_b1, tile_size))
+    checkpoint = _Checkpoint.active
+    passName = "density_" + os.path.splitext(
+            os.path.basename(outputs[0][0]))[0]
+    progress = None
+    if checkpoint is not None and all(os.path.isfile(densPath) 
+                                      for densPath in densPaths):
+        progress = checkpoint.windows(passName, len(windows))
+    nDone = progress["windows"] if progress else 0
+
+    densRasts = []
+    densBands = []
+    for (path, nBands), densPath in zip(outputs, densPaths):
+        densRast = _output_raster(densPath, progress is not None, 
+                                  dasyRast.RasterXSize, 
+                                  dasyRast.RasterYSize, gdal.GDT_Float32,
+                                  dasyRast.GetGeoTransform(), 
+                                  dasyRast.GetProjection(), nodata, profile,
+                                  nBands)
+        densRasts.append((path, densPath, densRast))
+        densBands.extend(densRast.GetRasterBand(band + 1) 
+                         for band in range(nBands))
+    if len(fields) > 1:
+        for band, field in zip(densBands, fields):
+            band.SetDescription(field)
+
+    #Target zones in the projection of the dasymetric raster
+    zoneKeys = []
+    zonePolys = []
+    for zone in zones:
+        zonePath, zoneKeyField = (zone, None) if isinstance(zone, str) \
+            else zone
+        zoneDs = ogr.Open(zonePath)
+        if zoneDs is None:
+            raise IOError("Unable to open target zones " + zonePath)
+        keys, polys = _poly_index(zoneDs.GetLayer(), zoneKeyField, 
+                                  dasyRast.GetProjection(), None)
+        zoneDs = None
+        zoneKeys.append((zoneKeyField or "FID", keys))
+        zonePolys.append(polys)
+    zoneTotals = [np.zeros((len(keys) + 1, 1 + len(fields))) 
+                  for keyField, keys in zoneKeys]
+    if progress:
+        zoneTotals = progress["zones"]
+
+    '''
+    A raster in /vsimem/ can only be read by this process and by worker 
+    processes forked from it.
+    '''
+    if dasyRaster_path.startswith('/vsimem/') and \
+            mp.get_start_method() != 'fork':
+        workers = 1
+    state = {'dasy_path': dasyRaster_path, 'lut': lut, 'nodata': nodata,
+             'kernel': kernel, 'zones': zonePolys, 
+             'geoTransform': dasyRast.GetGeoTransform()}
+    for i, (window, dens_arr, sums) in enumerate(
+            _map_windows(_density_window, windows[nDone:], state, workers, 
+                         threads, queue_depth), nDone + 1):
+        _lap()
+        for totals, zoneSum in zip(zoneTotals, sums):
+            totals[:len(zoneSum)] += zoneSum
+        if dens_arr.ndim == 2:
+            densBands[0].WriteArray(dens_arr, window[0], window[1])
+        else:
+            for band, densBand in enumerate(densBands):
+                densBand.WriteArray(np.ascontiguousarray(dens_arr[..., band]),
+                                    window[0], window[1])
+        _lap('write')
+        if checkpoint is not None and checkpoint.due(i, len(windows)):
+            checkpoint.save_windows(passName, i, len(windows), 
+                                    [densRast for path, densPath, densRast 
+                                     in densRasts], {"zones": zoneTotals})
+    dasyRast = None
+    densBands = None
+
+    while densRasts:
+        path, densPath, densRast = densRasts.pop(0)
+        if profile == 'cog':
+            levels = []
+            while max(densRast.RasterXSize, densRast.RasterYSize) // \
+                    (2 ** (len(levels) + 1)) >= 256:
+                levels.append(2 ** (len(levels) + 1))
+            _lap()
+            if levels:
+                densRast.BuildOverviews('AVERAGE', levels)
+            _lap('overviews')
+            cogRast = gdal.GetDriverByName('GTiff').CreateCopy(
+                    path, densRast, 
+                    options = _creation_options(profile, gdal.GDT_Float32) + 
+                    ['COPY_SRC_OVERVIEWS=YES'])
+            cogRast = None
+            densRast = None
+            gdal.GetDriverByName('GTiff').Delete(densPath)
+            _lap('cog_copy')
+        _lap()
+        densRast = None
+        _lap('write')
+
+    zoneTables = []
+    for (keyField, keys), totals in zip(zoneKeys, zoneTotals):
+        zone_df = pd.DataFrame({keyField: keys, 
+                                'Count': totals[1:, 0].astype(np.int64)})
+        for band, field in enumerate(fields):
+            if field.startswith("NEWDENSITY"):
+                field = "NEW_POP" + field[len("NEWDENSITY"):]
+            zone_df[field] = totals[1:, band + 1]
+        zoneTables.append(zone_df)
+    return zoneTables
+
+#Polygons stored as one WKB buffer with their envelopes and burn values
+PolygonSet = namedtuple('PolygonSet', ['wkb', 'offsets', 'envelopes',
+                                       'values', 'projection'])
+
+#Coordinate transformation from a layer to the ancillary raster
+def _coord_transform(layer, projection):
+    '''
+    Return a transformation from the coordinate system of the layer to the
+    projection (WKT) of the ancillary raster, or None if they are the same or
+    either one is unknown.
+    '''
+    layerSRS = layer.GetSpatialRef()
+    if layerSRS is None or not projection:
+        return None
+    layerSRS = layerSRS.Clone()
+    rastSRS = osr.SpatialReference()
+    rastSRS.ImportFromWkt(projection)
+    if layerSRS.IsSame(rastSRS):
+        return None
+    for srs in (layerSRS, rastSRS):
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(layerSRS, rastSRS)
+
+#Pack geometries into a PolygonSet
+def _polygon_set(wkbs, envelopes, values, projection):
+    '''
+    Pack a list of WKB geometries, their (minX, maxX, minY, maxY) envelopes
+    and burn values into a PolygonSet. The geometries are held in a single
+    buffer so that worker processes can share them.
+    '''
+    offsets = np.zeros(len(wkbs) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(wkb) for wkb in wkbs])
+    return PolygonSet(np.frombuffer(b''.join(wkbs), dtype = np.uint8),
+                      offsets,
+                      np.array(envelopes, dtype = np.float64).reshape(-1, 4),
+                      np.asarray(values, dtype = np.uint32),
+                      projection)
+
+#Dense polygon index for the population features
+def _poly_index(popLayer, popKeyField, projection, pop_nd = 0):
+    '''
+    Assign each unique value of popKeyField, or of the FID when popKeyField 
+    is None, a dense polygon index from 1 to N. Features with a missing key 
+    or a key equal to pop_nd are left out. Returns
+    an array of the sorted unique keys, where polyKeys[i - 1] is the key of
+    polygon index i, and a PolygonSet of the population features in the
+    projection of the ancillary raster with the polygon index as burn value.
+    '''
+    keys = []
+    wkbs = []
+    envelopes = []
+    transform = _coord_transform(popLayer, projection)
+    popLayer.ResetReading()
+    for feat in popLayer:
+        key = feat.GetFID() if popKeyField is None \
+            else feat.GetField(popKeyField)
+        geom = feat.GetGeometryRef()
+        if key is None or key == pop_nd or geom is None:
+            continue
+        if transform is not None:
+            geom = geom.Clone()
+            geom.Transform(transform)
+        keys.append(key)
+        wkbs.append(geom.ExportToWkb())
+        envelopes.append(geom.GetEnvelope())
+    popLayer.ResetReading()
+    polyKeys, polyIdx = np.unique(np.array(keys), return_inverse = True)
+    return polyKeys, _polygon_set(wkbs, envelopes, polyIdx + 1, projection)
+
+#Uninhabited areas as a PolygonSet
+def _uninhab_polys(uninhabLayer, projection):
+    '''
+    Return a PolygonSet of the uninhabited areas in the projection of the
+    ancillary raster, with a burn value of 1.
+    '''
+    wkbs = []
+    envelopes = []
+    transform = _coord_transform(uninhabLayer, projection)
+    uninhabLayer.ResetReading()
+    for feat in uninhabLayer:
+        geom = feat.GetGeometryRef()
+        if geom is None:
+            continue
+        if transform is not None:
+            geom = geom.Clone()
+            geom.Transform(transform)
+        wkbs.append(geom.ExportToWkb())
+        envelopes.append(geom.GetEnvelope())
+    uninhabLayer.ResetReading()
+    return _polygon_set(wkbs, envelopes, np.ones(len(wkbs)), projection)
+
+#Rasterize the polygons that overlap a window
+def _rasterize_window(polys, window, geoTransform, gdt = None, 
+                      subset = None, coverage = False):
+    '''
+    Rasterize the burn values of a PolygonSet into an in-memory raster covering
+    a (xoff, yoff, xsize, ysize) window of the grid described by geoTransform
+    and return it as an array of the GDAL type gdt (default = GDT_UInt32). 
+    Only polygons whose envelope overlaps the window, and that are in the 
+    indices subset if it is given, are rasterized; pixels outside of all 
+    polygons are 0. With coverage, each pixel gets the number of polygons 
+    that cover it instead of a burn value.
+    '''
+    if gdt is None:
+        gdt = gdal.GDT_UInt32
+    xoff, yoff, xsize, ysize = window
+    ulx = geoTransform[0] + xoff * geoTransform[1]
+    uly = geoTransform[3] + yoff * geoTransform[5]
+    sel = _window_polygons(polys, window, geoTransform)
+    if subset is not None:
+        sel = np.intersect1d(sel, subset)
+
+    rast = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdt)
+    rast.SetGeoTransform((ulx, geoTransform[1], 0, uly, 0, geoTransform[5]))
+    rast.SetProjection(polys.projection)
+    if sel.size:
+        srs = None
+        if polys.projection:
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(polys.projection)
+        mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+        winLayer = mem_ds.CreateLayer('window', srs, ogr.wkbUnknown)
+        winLayer.CreateField(ogr.FieldDefn('BURN', ogr.OFTInteger))
+        for i in sel:
+            feat = ogr.Feature(winLayer.GetLayerDefn())
+            feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(
+                    polys.wkb[polys.offsets[i]:polys.offsets[i + 1]].tobytes()))
+            feat.SetField('BURN', int(polys.values[i]))
+            winLayer.CreateFeature(feat)
+        if coverage:
+            gdal.RasterizeLayer(rast, [1], winLayer, burn_values = [1], 
+                                options = ["MERGE_ALG=ADD"])
+        else:
+            gdal.RasterizeLayer(rast, [1], winLayer, 
+                                options = ["ATTRIBUTE=BURN"])
+        mem_ds = None
+    return rast.GetRasterBand(1).ReadAsArray()
+
+#Polygons of a PolygonSet whose envelope overlaps a window
+def _window_polygons(polys, window, geoTransform):
+    '''
+    Return the indices of the polygons of a PolygonSet whose envelope 
+    overlaps a (xoff, yoff, xsize, ysize) window of the grid described by 
+    geoTransform.
+    '''
+    xoff, yoff, xsize, ysize = window
+    ulx = geoTransform[0] + xoff * geoTransform[1]
+    uly = geoTransform[3] + yoff * geoTransform[5]
+    lrx = ulx + xsize * geoTransform[1]
+    lry = uly + ysize * geoTransform[5]
+    env = polys.envelopes
+    return np.flatnonzero((env[:, 0] <= max(ulx, lrx)) &
+                          (env[:, 1] >= min(ulx, lrx)) &
+                          (env[:, 2] <= max(uly, lry)) &
+                          (env[:, 3] >= min(uly, lry)))
+
+#Groups of polygons whose envelopes do not overlap
+def _envelope_groups(envelopes, values):
+    '''
+    Split polygons with (minX, maxX, minY, maxY) envelopes into groups in 
+    which the envelopes of polygons with different values do not overlap, 
+    so that the polygons of a group can be rasterized together without 
+    one hiding another. Polygons with the same value are kept in the same 
+    group. Returns a list of arrays of polygon indices.
+    '''
+    keys, inverse = np.unique(values, return_inverse = True)
+    keyEnv = np.empty((len(keys), 4))
+    keyEnv[:, [0, 2]] = np.inf
+    keyEnv[:, [1, 3]] = -np.inf
+    for i in (0, 2):
+        np.minimum.at(keyEnv[:, i], inverse, envelopes[:, i])
+        np.maximum.at(keyEnv[:, i + 1], inverse, envelopes[:, i + 1])
+    
+    '''
+    Greedy colouring: each key takes the first group that none of the keys 
+    before it with an overlapping envelope belongs to.
+    '''
+    group = np.zeros(len(keys), dtype = np.int64)
+    for i in range(1, len(keys)):
+        overlap = (keyEnv[:i, 0] <= keyEnv[i, 1]) & \
+            (keyEnv[:i, 1] >= keyEnv[i, 0]) & \
+            (keyEnv[:i, 2] <= keyEnv[i, 3]) & \
+            (keyEnv[:i, 3] >= keyEnv[i, 2])
+        taken = np.zeros(i + 1, dtype = bool)
+        taken[group[:i][overlap]] = True
+        group[i] = np.argmin(taken)
+    return [np.flatnonzero(group[inverse] == g) 
+            for g in range(int(group.max()) + 1 if len(keys) else 0)]
+
+#Wall time and CPU time of the steps of the window functions in this process
+_STEPS = {}
+_STEPS_LOCK = threading.Lock()
+#Start of the current lap of each thread
+_LAP = threading.local()
+#Bytes read and written by worker processes during the current stage
+_WORKER_IO = [0, 0]
+
+def _lap(step = None):
+    '''
+    Add the wall time and CPU time since the previous lap to step, or only 
+    start a new lap when step is None.
+    '''
+    now = (time.perf_counter(), getattr(_LAP, 'clock', time.process_time)())
+    if step is not None:
+        start = getattr(_LAP, 'start', now)
+        _add_steps({step: (now[0] - start[0], now[1] - start[1])})
+    _LAP.start = now
+
+def _add_steps(steps):
+    with _STEPS_LOCK:
+        for step, (wall, cpu) in steps.items():
+            totalWall, totalCpu = _STEPS.get(step, (0.0, 0.0))
+            _STEPS[step] = (totalWall + wall, totalCpu + cpu)
+
+def _io_bytes():
+    '''
+    Return the bytes read and written by this process so far, or None where 
+    they are not available. These are the rchar and wchar counters of 
+    /proc/self/io, so reads served from the page cache are included.
+    '''
+    try:
+        with open('/proc/self/io') as ioFile:
+            counters = dict(line.split(':', 1) for line in ioFile)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def _peak_rss():
+    '''
+    Return the peak resident memory in bytes of this process and of the 
+    largest finished worker process, or None where they are not available. 
+    On Linux the peak of this process is measured since the last 
+    _reset_peak_rss; elsewhere it is the peak since the process started.
+    '''
+    peak = None
+    try:
+        with open('/proc/self/status') as statusFile:
+            for line in statusFile:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    workerPeak = None
+    if resource is not None:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        if peak is None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        workerPeak = resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss * scale or None
+    return peak, workerPeak
+
+def _reset_peak_rss():
+    #Linux resets the peak resident memory of a process on request
+    try:
+        with open('/proc/self/clear_refs', 'w') as refsFile:
+            refsFile.write('5')
+    except (IOError, OSError):
+        pass
+
+#Wall time, CPU time, memory and I/O of the stages of a run
+class _RunReport(object):
+    '''
+    Record the stages of a run of the toolbox. A stage lasts from _stage(name) 
+    until the next stage starts or the report is closed. For each stage the 
+    report holds the wall time, the CPU time of this process and of the 
+    worker processes that finished in the stage, the peak resident memory, 
+    the bytes read and written, and the time of the steps of the window 
+    functions, summed over all windows (and so over all workers).
+    '''
+    active = None
+
+    def __init__(self, arguments):
+        self.report = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "status": "Running", "error": None, 
+                       "arguments": arguments, "stages": []}
+        self._begin = self._usage()
+        self._stage = None
+        _RunReport.active = self
+
+    @staticmethod
+    def _usage():
+        times = os.times()
+        return {"wall": time.perf_counter(), "cpu": times[0] + times[1], 
+                "worker_cpu": times[2] + times[3], "io": _io_bytes()}
+
+    def start(self, name):
+        self.stop()
+        _STEPS.clear()
+        _WORKER_IO[:] = [0, 0]
+        _reset_peak_rss()
+        self._stage = (name, self._usage())
+
+    def stop(self):
+        if self._stage is None:
+            return
+        name, begin = self._stage
+        end = self._usage()
+        peak, workerPeak = _peak_rss()
+        record = {"name": name, 
+                  "wall_seconds": round(end["wall"] - begin["wall"], 6),
+                  "cpu_seconds": round(end["cpu"] - begin["cpu"], 6),
+                  "worker_cpu_seconds": round(end["worker_cpu"] - 
+                                              begin["worker_cpu"], 6),
+                  "peak_rss_bytes": peak, "peak_worker_rss_bytes": workerPeak,
+                  "bytes_read": None, "bytes_written": None, "steps": {}}
+        if begin["io"] is not None and end["io"] is not None:
+            record["bytes_read"] = end["io"][0] - begin["io"][0] + \
+                _WORKER_IO[0]
+            record["bytes_written"] = end["io"][1] - begin["io"][1] + \
+                _WORKER_IO[1]
+        for step, (wall, cpu) in _STEPS.items():
+            record["steps"][step] = {"wall_seconds": round(wall, 6),
+                                     "cpu_seconds": round(cpu, 6)}
+        self._stage = None
+        self.report["stages"].append(record)
+        logger.debug("Stage %s: %.3f s", name, record["wall_seconds"])
+
+    def close(self, path = None, error = None):
+        '''
+        Stop the last stage, add the totals of the run and write the report 
+        to path as JSON if a path is given. Returns the report.
+        '''
+        self.stop()
+        if _RunReport.active is self:
+            _RunReport.active = None
+        end = self._usage()
+        stages = self.report["stages"]
+        peaks = [stage["peak_rss_bytes"] for stage in stages 
+                 if stage["peak_rss_bytes"] is not None]
+        self.report["status"] = "Failed" if error else "Done"
+        self.report["error"] = error
+        self.report["total"] = {
+                "wall_seconds": round(end["wall"] - self._begin["wall"], 6),
+                "cpu_seconds": round(end["cpu"] - self._begin["cpu"], 6),
+                "worker_cpu_seconds": round(end["worker_cpu"] - 
+                                            self._begin["worker_cpu"], 6),
+                "peak_rss_bytes": max(peaks) if peaks else None,
+                "peak_worker_rss_bytes": _peak_rss()[1],
+                "bytes_read": sum(stage["bytes_read"] or 0 
+                                  for stage in stages),
+                "bytes_written": sum(stage["bytes_written"] or 0 
+                                     for stage in stages)}
+        if path:
+            with open(path, 'w') as reportFile:
+                json.dump(self.report, reportFile, indent = 2, default = str)
+        return self.report
+
+def _stage(name, message = None):
+    '''
+    Log message and start the stage name of the run report being recorded, 
+    if any.
+    '''
+    if message:
+        logger.info(message)
+    if _RunReport.active is not None:
+        _RunReport.active.start(name)
+
+#State of the worker processes used by the windowed passes
+_WORKER = {}
+#Rasters read by the window functions, opened in each thread that reads them
+_RASTERS = threading.local()
+
+def _init_worker(state):
+    '''
+    Set the state used by the window functions in this process and open the
+    rasters they read in this thread.
+    '''
+    _WORKER.clear()
+    _WORKER.update(state)
+    _open_window_rasters()
+
+def _open_window_rasters(cached = True):
+    '''
+    Open the rasters read by the window functions in this thread: "anc_path" 
+    of the worker state for _dasy_window and "dasy_path" for 
+    _density_window. GDAL datasets must not be shared between threads, so 
+    the ancillary raster kept open by _open_raster is only used when cached 
+    is True. Otherwise the thread takes one of the ancillary datasets left by 
+    the pipeline threads of earlier runs with _take_raster, and 
+    _close_window_rasters gives it back.
+    '''
+    _RASTERS.__dict__.clear()
+    if 'anc_path' in _WORKER:
+        if cached:
+            _RASTERS.anc_ds = _open_raster(_WORKER['anc_path'])
+        else:
+            _RASTERS.anc_key, _RASTERS.anc_ds = \
+                _take_raster(_WORKER['anc_path'])
+        _RASTERS.anc_band = _RASTERS.anc_ds.GetRasterBand(1)
+    if 'dasy_path' in _WORKER:
+        _RASTERS.dasy_ds = gdal.Open(_WORKER['dasy_path'])
+        _RASTERS.dasy_band = _RASTERS.dasy_ds.GetRasterBand(1)
+
+def _close_window_rasters():
+    '''
+    Close the rasters opened by _open_window_rasters in this thread, giving 
+    back the ancillary dataset taken with _take_raster.
+    '''
+    if getattr(_RASTERS, 'anc_key', None) is not None:
+        _give_raster(_RASTERS.anc_key, _RASTERS.anc_ds)
+    _RASTERS.__dict__.clear()
+
+#Apply a window function to each window, in parallel if requested
+def _map_windows(func, windows, state, workers = 1, threads = 0, 
+                 queue_depth = None):
+    '''
+    Apply func to each window and yield the results in window order. With
+    more than one worker the windows are processed by a pool of worker
+    processes that are each set up with _init_worker(state), using all CPUs
+    when workers is less than 1. Otherwise they are processed in this 
+    process, by threads pipeline threads while the caller writes the 
+    results, or by the caller itself when threads is 0. At most queue_depth 
+    windows (default = twice the number of workers or threads) are read 
+    and processed ahead of the window being written. The time the caller 
+    waits for the next window is added to the step "stall_compute".
+    '''
+    if workers < 1:
+        workers = mp.cpu_count()
+    if queue_depth is None:
+        queue_depth = 2 * max(workers, threads, 1)
+    queue_depth = max(int(queue_depth), 1)
+    if workers > 1:
+        pool = mp.Pool(workers, _init_worker, (state,))
+        pending = deque()
+        windows = iter(windows)
+        try:
+            while True:
+                while len(pending) < queue_depth:
+                    window = next(windows, None)
+                    if window is None:
+                        break
+                    pending.append(pool.apply_async(_timed_window, 
+                                                    ((func, window),)))
+                if not pending:
+                    break
+                wait = time.perf_counter()
+                result, steps, ioBytes = pending.popleft().get()
+                steps['stall_compute'] = (time.perf_counter() - wait, 0.0)
+                _add_steps(steps)
+                _WORKER_IO[0] += ioBytes[0]
+                _WORKER_IO[1] += ioBytes[1]
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    elif threads > 0:
+        _WORKER.clear()
+        _WORKER.update(state)
+        pipeline = _pipeline_windows(func, list(windows), threads, 
+                                     queue_depth)
+        try:
+            for result in pipeline:
+                yield result
+        finally:
+            pipeline.close()
+            _WORKER.clear()
+    else:
+        _init_worker(state)
+        try:
+            for window in windows:
+                yield func(window)
+        finally:
+            _WORKER.clear()
+            _RASTERS.__dict__.clear()
+
+#Apply a window function in a pipeline of threads
+def _pipeline_windows(func, windows, threads, queue_depth):
+    '''
+    Apply func to each window in threads threads and yield the results in 
+    window order. Each thread opens its own datasets, takes the next window 
+    once fewer than queue_depth windows are waiting to be taken by the 
+    caller, reads it and processes it. GDAL, NumPy and the Numba kernels 
+    release the GIL, so reading and decompressing the inputs and the pixel 
+    math overlap with the caller compressing and writing the outputs. The 
+    time the caller waits for a window is added to the step 
+    "stall_compute" and the time the threads wait for the caller to the 
+    step "stall_write".
+    '''
+    tasks = iter(enumerate(windows))
+    taskLock = threading.Lock()
+    slots = threading.Semaphore(queue_depth)
+    done = threading.Condition()
+    results = {}
+    failed = []
+    stop = []
+
+    def run():
+        _LAP.clock = getattr(time, 'thread_time', time.process_time)
+        try:
+            _open_window_rasters(cached = False)
+            while True:
+                wait = time.perf_counter()
+                slots.acquire()
+                with taskLock:
+                    task = None if stop or failed else next(tasks, None)
+                if task is None:
+                    break
+                _add_steps({'stall_write': (time.perf_counter() - wait, 
+                                            0.0)})
+                result = func(task[1])
+                with done:
+                    results[task[0]] = result
+                    done.notify_all()
+        except BaseException as e:
+            with done:
+                failed.append(e)
+                done.notify_all()
+        finally:
+            _close_window_rasters()
+
+    pipeline = [threading.Thread(target = run, name = "idm-window-" + str(i))
+                for i in range(threads)]
+    for thread in pipeline:
+        thread.daemon = True
+        thread.start()
+    try:
+        for i in range(len(windows)):
+            wait = time.perf_counter()
+            with done:
+                while i not in results and not failed:
+                    done.wait()
+                if failed:
+                    raise failed[0]
+                result = results.pop(i)
+            _add_steps({'stall_compute': (time.perf_counter() - wait, 0.0)})
+            slots.release()
+            yield result
+    finally:
+        stop.append(True)
+        for thread in pipeline:
+            slots.release()
+        for thread in pipeline:
+            thread.join()
+
+#Window function run in a worker process, with the time of its steps
+def _timed_window(funcWindow):
+    '''
+    Apply a window function to a window in a worker process and return its 
+    result, the time of its steps and the bytes read and written.
+    '''
+    func, window = funcWindow
+    _STEPS.clear()
+    ioStart = _io_bytes()
+    result = func(window)
+    ioEnd = _io_bytes()
+    ioBytes = (0, 0)
+    if ioStart is not None and ioEnd is not None:
+        ioBytes = (ioEnd[0] - ioStart[0], ioEnd[1] - ioStart[1])
+    return result, dict(_STEPS), ioBytes
+
+#Polygon index, unit codes and crosstab of a window
+def _dasy_window(window):
+    '''
+    Rasterize the polygon index of a window, read the same window of the
+    ancillary raster with the uninhabited areas set to NoData and return the
+    window, the polygon index array, the unit code array, the zonal crosstab
+    of the window and, if requested, the ancillary array.
+    '''
+    _lap()
+    xoff, yoff, xsize, ysize = window
+    anc_arr = _RASTERS.anc_band.ReadAsArray(xoff, yoff, xsize, ysize)
+    _lap('read_ancillary')
+    '''
+    Give the pixels in uninhabited areas the NoData value of the ancillary 
+    raster, using a byte mask of the uninhabited areas in the window.
+    '''
+    uninhab_arr = None
+    if _WORKER.get('uninhab') is not None:
+        uninhab_arr = _rasterize_window(_WORKER['uninhab'], window,
+                                        _WORKER['geoTransform'], 
+                                        gdal.GDT_Byte)
+        _lap('uninhabited_burn')
+    pop_arr = _rasterize_window(_WORKER['polys'], window,
+                                _WORKER['geoTransform'])
+    _lap('rasterize')
+    comb_arr, crosstab = window_units(pop_arr, anc_arr, _WORKER['nClasses'],
+                                      _WORKER['unit_dtype'], uninhab_arr, 
+                                      _WORKER['anc_nd'], 
+                                      _WORKER.get('kernel', 'numpy'))
+    _lap('crosstab')
+    return (window, pop_arr, comb_arr, crosstab,
+            anc_arr if _WORKER.get('return_anc') else None)
+
+#Population density of a window of the dasymetric raster
+def _density_window(window):
+    '''
+    Read a window of the dasymetric raster and return the window, its
+    population density array and the zone_sums of each target zone layer.
+    '''
+    _lap()
+    xoff, yoff, xsize, ysize = window
+    comb_arr = _RASTERS.dasy_band.ReadAsArray(xoff, yoff, xsize, ysize)
+    if comb_arr.dtype.kind == 'f':
+        comb_arr = comb_arr.astype(np.uint64)
+    _lap('read_dasymetric')
+    dens_arr = lookup_density(_WORKER['lut'], comb_arr, _WORKER['nodata'],
+                              _WORKER.get('kernel', 'numpy'))
+    _lap('lookup')
+    sums = [_zone_window_sums(polys, window, _WORKER['geoTransform'], 
+                              dens_arr, _WORKER['nodata'])
+            for polys in _WORKER.get('zones', ())]
+    if sums:
+        _lap('zone_sums')
+    return window, dens_arr, sums
+
+#Datasets and preset tables kept between runs in this process, the least
+#recently used first
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+#Maximum number of entries of _CACHE
+_CACHE_ENTRIES = 32
+
+def _cache_entry(kind, path, load):
+    '''
+    Return the entry of _CACHE for the file path, loading it with load() if 
+    the file is not cached or has been modified since it was cached. Entries 
+    are keyed by (kind, process id, path, modification time): a forked 
+    worker process inherits the datasets of its parent, which must not be 
+    read by both processes, so it drops them and loads its own. The entries 
+    of other versions of the file are evicted when it is loaded again and 
+    the least recently used entries once there are more than _CACHE_ENTRIES.
+    '''
+    pid = os.getpid()
+    path = os.path.abspath(path)
+    key = (kind, pid, path, os.path.getmtime(path))
+    with _CACHE_LOCK:
+        if key in _CACHE:
+            _CACHE.move_to_end(key)
+            return key, _CACHE[key]
+        for oldKey in [oldKey for oldKey in _CACHE if oldKey[1] != pid or 
+                       (oldKey[2] == path and oldKey[3] != key[3])]:
+            del _CACHE[oldKey]
+        _CACHE[key] = load()
+        while len(_CACHE) > _CACHE_ENTRIES:
+            _CACHE.popitem(last = False)
+        return key, _CACHE[key]
+
+def _read_raster(path):
+    '''
+    Open a raster read-only, raising an IOError if it cannot be opened.
+    '''
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IOError("Unable to open raster " + path)
+    return ds
+
+def _open_raster(path):
+    '''
+    Open a raster read-only, reusing the dataset opened by an earlier run in
+    this process as long as the file has not been modified since.
+    '''
+    return _cache_entry('raster', path, lambda: _read_raster(path))[1]
+
+def _take_raster(path):
+    '''
+    Open a raster read-only for one thread and return its _CACHE key and 
+    dataset, taking a dataset given back with _give_raster by a thread of an 
+    earlier run as long as the file has not been modified since.
+    '''
+    key, idle = _cache_entry('idle', path, list)
+    with _CACHE_LOCK:
+        if idle:
+            return key, idle.pop()
+    return key, _read_raster(path)
+
+def _give_raster(key, ds):
+    '''
+    Give back a dataset taken with _take_raster, for the threads of later 
+    runs. It is closed instead if its entry has been evicted.
+    '''
+    with _CACHE_LOCK:
+        if key in _CACHE:
+            _CACHE[key].append(ds)
+
+def _load_presets(presetTable):
+    '''
+    Load the preset class densities from a config.json file, reusing the
+    presets loaded by an earlier run in this process as long as the file has
+    not been modified since. Returns a copy that the caller may change.
+    '''
+    def load():
+        with open(presetTable) as presetFile:
+            return json.load(presetFile)
+    return dict(_cache_entry('presets', presetTable, load)[1])
+
+#Preset class densities given as a dict, a JSON file or the default file
+def _preset_data(presets = None):
+    '''
+    Return the preset class densities as a dict of class (a string) to 
+    density. presets is a dict of the same form, the path to a JSON file such 
+    as config.json, or None for the config.json file next to this script.
+    '''
+    if presets is None:
+        presets = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                               "config.json")
+    if isinstance(presets, dict):
+        return dict((str(cat), float(dens)) for cat, dens in presets.items())
+    return _load_presets(presets)
+
+#Version of the cached units; change it when their format changes
+_UNIT_CACHE_VERSION = 1
+
+#Files of a dataset described by name, size and modification time
+def _file_fingerprint(path):
+    '''
+    Return the name, size and modification time of each file that makes up
+    a raster or vector dataset (e.g., all parts of a shapefile).
+    '''
+    ds = gdal.OpenEx(path)
+    fileList = ds.GetFileList() if ds is not None else None
+    ds = None
+    if not fileList:
+        fileList = [path]
+    fingerprint = []
+    for filePath in sorted(fileList):
+        fileStat = os.stat(filePath)
+        fingerprint.append([os.path.abspath(filePath), fileStat.st_size,
+                            fileStat.st_mtime])
+    return fingerprint
+
+#Cache key of the population raster, dasymetric raster and unit counts
+def _cache_key(popFeat_path, popKeyField, ancRaster_path, uninhab_path,
+               anc_nd, pop_nd, popFilter, uninhab_raster = False, 
+               extent_pad = 0, pop_raster = True, profile = 'lzw',
+               popBounds = None):
+    '''
+    Hash everything that the population raster, the dasymetric raster and the
+    unit counts depend on: the files of the population features, ancillary
+    raster and uninhabited areas, the key field, the filters, the NoData
+    values, which rasters are written and how, and the padding of the 
+    processing extent. The grid is that of the ancillary raster.
+    '''
+    inputs = {
+            "version": _UNIT_CACHE_VERSION,
+            "population_features": _file_fingerprint(popFeat_path),
+            "population_key_field": popKeyField,
+            "population_filter": popFilter,
+            "population_bounds": (list(popBounds) if popBounds is not None
+                                  else None),
+            "ancillary_raster": _file_fingerprint(ancRaster_path),
+            "uninhabited_file": (_file_fingerprint(uninhab_path)
+                                 if uninhab_path else None),
+            "anc_nodata": anc_nd,
+            "pop_nodata": pop_nd,
+            "uninhabited_raster": bool(uninhab_path and uninhab_raster),
+            "extent_padding": extent_pad,
+            "population_raster": bool(pop_raster),
+            "output_profile": profile
+            }
+    return hashlib.sha256(json.dumps(inputs, sort_keys = True).encode(
+            'utf-8')).hexdigest()
+
+#Rasters kept in the cache with the unit counts
+_CACHED_RASTERS = ["PopRaster.tif", "DasyRaster.tif", "uninhab_landcover.tif"]
+
+def _link_or_copy(src, dst):
+    '''
+    Hard link src to dst, or copy it when a link is not possible (e.g., across
+    file systems). An existing dst is replaced.
+    '''
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _cache_fetch(cache_dir, key, out_dir):
+    '''
+    Return the (unitCodes, counts, polyKeys, nClasses) cached under key and
+    place the cached rasters in out_dir, or None if key is not in the cache.
+    '''
+    entry = os.path.join(cache_dir, key)
+    unitFile = os.path.join(entry, "units.npz")
+    if not os.path.isfile(unitFile):
+        return None
+    with np.load(unitFile, allow_pickle = False) as cached:
+        units = (cached["unitCodes"], cached["counts"], cached["polyKeys"],
+                 int(cached["nClasses"]))
+    for rasterName in _CACHED_RASTERS:
+        if os.path.isfile(os.path.join(entry, rasterName)):
+            _link_or_copy(os.path.join(entry, rasterName),
+                          os.path.join(out_dir, rasterName))
+    #Mark the entry as recently used
+    os.utime(entry, None)
+    return units
+
+def _cache_store(cache_dir, key, out_dir, units, cache_size = 20):
+    '''
+    Cache the units returned by _dasymetric_units and the rasters in out_dir
+    under key, then evict the least recently used entries until the cache is
+    no larger than cache_size GB.
+    '''
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmpEntry = tempfile.mkdtemp(prefix = key + ".", dir = cache_dir)
+    unitCodes, counts, polyKeys, nClasses = units
+    np.savez(os.path.join(tmpEntry, "units.npz"), unitCodes = unitCodes,
+             counts = counts, polyKeys = polyKeys, nClasses = nClasses)
+    for rasterName in _CACHED_RASTERS:
+        if os.path.isfile(os.path.join(out_dir, rasterName)):
+            _link_or_copy(os.path.join(out_dir, rasterName),
+                          os.path.join(tmpEntry, rasterName))
+    try:
+        os.rename(tmpEntry, entry)
+    except OSError:
+        #Another run stored the same entry first
+        shutil.rmtree(tmpEntry, ignore_errors = True)
+    _cache_evict(cache_dir, cache_size * 2**30)
+
+def _cache_evict(cache_dir, max_bytes):
+    '''
+    Remove the least recently used cache entries until the files in the cache
+    take up no more than max_bytes.
+    '''
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry) or "." in name:
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, fileName))
+                   for fileName in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+    total = sum(size for used, size, entry in entries)
+    for used, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors = True)
+        total -= size
+
+#Arguments of dasy_map that may change when a run is resumed
+_RESUME_OPTIONS = ('workers', 'threads', 'queue_depth', 'kernel', 
+                   'cache_dir', 'cache_size', 'report', 'cprofile', 
+                   'checkpoint', 'resume')
+
+def _checkpoint_key(arguments, presetData):
+    '''
+    Hash the arguments of a run of dasy_map that its outputs depend on, 
+    with the files of its input datasets and its preset class densities, so 
+    that checkpoints are only resumed by a run of the same inputs and 
+    parameters.
+    '''
+    inputs = dict((name, value) for name, value in arguments.items() 
+                  if name not in _RESUME_OPTIONS)
+    for name in ('popFeat_path', 'ancRaster_path', 'uninhab_path'):
+        if inputs.get(name):
+            inputs[name] = _file_fingerprint(inputs[name])
+    inputs['zones'] = [_file_fingerprint(zone) if isinstance(zone, str) 
+                       else [_file_fingerprint(zone[0]), zone[1]]
+                       for zone in inputs.get('zones') or ()]
+    inputs['presets'] = presetData
+    inputs['version'] = _UNIT_CACHE_VERSION
+    return hashlib.sha256(json.dumps(inputs, sort_keys = True, 
+                                     default = str).encode(
+            'utf-8')).hexdigest()
+
+#Checkpoints of a run, for resuming it after a failure
+class _Checkpoint(object):
+    '''
+    Keep the progress of a run in the Checkpoint directory of its output 
+    directory. The stages of the run save their results when they finish 
+    and the window passes save the number of windows written so far with 
+    their partial results, at most every interval seconds, after flushing 
+    their output rasters. Every file is written under a temporary name and 
+    renamed, so a checkpoint is either complete or missing. The checkpoints 
+    of an earlier run are used when resume is True and the run had the 
+    same key (see _checkpoint_key); otherwise they are removed.
+    '''
+    active = None
+
+    def __init__(self, out_dir, key, resume = False, interval = 60):
+        self.dir = os.path.join(out_dir, "Checkpoint")
+        self.interval = interval
+        self._saved = time.perf_counter()
+        statePath = os.path.join(self.dir, "checkpoint.json")
+        state = None
+        if resume and os.path.isfile(statePath):
+            with open(statePath) as stateFile:
+                state = json.load(stateFile)
+            if state.get("key") != key:
+                logger.warning("The checkpoint in {0} was made with other "
+                               "inputs or parameters; starting over".format(
+                                       self.dir))
+                state = None
+        elif resume:
+            logger.warning("No checkpoint found in {0}; starting "
+                           "over".format(self.dir))
+        if state is None:
+            shutil.rmtree(self.dir, ignore_errors = True)
+            os.makedirs(self.dir)
+            state = {"key": key, "stages": []}
+            self._dump("checkpoint.json", state)
+        elif state["stages"]:
+            logger.info("Resuming after the {0} stage...".format(
+                    state["stages"][-1]))
+        self.state = state
+        _Checkpoint.active = self
+
+    def _dump(self, name, value):
+        path = os.path.join(self.dir, name)
+        with open(path + ".tmp", 'wb') as tmpFile:
+            if name.endswith(".json"):
+                tmpFile.write(json.dumps(value, indent = 2).encode('utf-8'))
+            else:
+                pickle.dump(value, tmpFile, protocol = pickle.HIGHEST_PROTOCOL)
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _load(self, name):
+        path = os.path.join(self.dir, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as pickleFile:
+            return pickle.load(pickleFile)
+
+    def done(self, stage):
+        return stage in self.state["stages"]
+
+    def load(self, stage):
+        return self._load(stage + ".pkl")
+
+    def save(self, stage, value = None):
+        '''
+        Save the result of a finished stage and drop its window progress.
+        '''
+        self._dump(stage + ".pkl", value)
+        self.state["stages"].append(stage)
+        self._dump("checkpoint.json", self.state)
+        if os.path.isfile(os.path.join(self.dir, stage + ".windows.pkl")):
+            os.remove(os.path.join(self.dir, stage + ".windows.pkl"))
+
+    def windows(self, name, nWindows):
+        '''
+        Return the progress saved by the window pass name of nWindows 
+        windows, a dict with the number of windows written and the partial 
+        results of the pass, or None.
+        '''
+        progress = self._load(name + ".windows.pkl")
+        if progress is None or progress["windows_total"] != nWindows:
+            return None
+        logger.info("Resuming after {0} of {1} windows...".format(
+                progress["windows"], nWindows))
+        return progress
+
+    def due(self, nDone, nWindows):
+        return nDone == nWindows or \
+            time.perf_counter() - self._saved >= self.interval
+
+    def save_windows(self, name, nDone, nWindows, datasets, partial):
+        '''
+        Flush the output datasets of the window pass name and save that 
+        its first nDone windows are written, with the dict partial of its 
+        results so far.
+        '''
+        _lap()
+        for ds in datasets:
+            if ds is not None:
+                ds.FlushCache()
+        progress = dict(partial, windows = nDone, windows_total = nWindows)
+        self._dump(name + ".windows.pkl", progress)
+        self._saved = time.perf_counter()
+        _lap('checkpoint')
+
+    def close(self, success):
+        '''
+        Stop using the checkpoints, removing them when the run succeeded.
+        '''
+        if _Checkpoint.active is self:
+            _Checkpoint.active = None
+        if success:
+            shutil.rmtree(self.dir, ignore_errors = True)
+
+#Output raster of a window pass, reopened to resume the pass
+def _output_raster(path, resume, *args, **kwargs):
+    '''
+    Open the raster at path for update when resume is True, to write the 
+    windows left by an interrupted run, or create it with _create_raster.
+    '''
+    if not resume:
+        return _create_raster(path, *args, **kwargs)
+    rast = gdal.Open(path, gdal.GA_Update)
+    if rast is None:
+        raise IOError("Unable to open raster " + path)
+    return rast
+
+#Population raster, dasymetric raster and unit counts
+def _dasymetric_units(popFeat_path, popKeyField, ancRaster_path, out_dir,
+                      uninhab_path = False, anc_nd = 0, pop_nd = 0,
+                      tile_size = 2048, workers = 1, popFilter = None,
+                      dasyRaster = None, uninhab_raster = False, 
+                      extent_pad = 0, pop_raster = True, profile = 'lzw',
+                      popBounds = None, kernel = 'auto', threads = 0,
+                      queue_depth = None):
+    '''
+    Create PopRaster.tif and DasyRaster.tif in out_dir one window at a time
+    and count the pixels of each dasymetric unit. Uninhabited areas are 
+    rasterized one window at a time and given the class anc_nd; they are 
+    only written to uninhab_landcover.tif in out_dir when uninhab_raster is 
+    True. When dasyRaster is given, the dasymetric raster is written there 
+    instead (e.g., to /vsimem/) and the population raster is not written at 
+    all. Unless extent_pad is None, the rasters only cover the footprint of 
+    the population features padded by extent_pad pixels. PopRaster.tif is 
+    not written when pop_raster is False. The rasters are written with the 
+    creation options of the output profile. popFilter and popBounds select 
+    the population features by attribute and by extent. The windows are 
+    counted with the pixel kernel kernel, by threads pipeline threads that 
+    stay at most queue_depth windows ahead of the writes when there is one 
+    worker (see _map_windows). The pass resumes from the windows saved by 
+    the active checkpoint, if any. Returns the sorted unit
+    codes, their pixel counts, the population keys of the polygon indices and
+    the number of ancillary classes used to pack the unit codes.
+    '''
+    popRaster = None
+    if dasyRaster is None:
+        popRaster = os.path.join(out_dir, "PopRaster.tif")
+        dasyRaster = os.path.join(out_dir, "DasyRaster.tif")
+
+    uninhabRaster = os.path.join(out_dir, "uninhab_landcover.tif")
+    outRasters = [dasyRaster]
+    if popRaster and pop_raster:
+        outRasters.append(popRaster)
+    if uninhab_path and uninhab_raster:
+        outRasters.append(uninhabRaster)
+    checkpoint = _Checkpoint.active
+
     """
-    Set driver for raster creation and read in census population features and 
-    ancillary raster
+    Read in census population features and ancillary raster
     """
-    rast_driver = gdal.GetDriverByName('GTiff')
-    ancRaster = gdal.Open(ancRaster_path)
+    ancRaster = _open_raster(ancRaster_path)
     popFeatures = ogr.Open(popFeat_path)
     popLayer = popFeatures.GetLayer()
+    if popFilter:
+        popLayer.SetAttributeFilter(popFilter)
+    if popBounds is not None:
+        popLayer.SetSpatialFilterRect(*[float(v) for v in popBounds])
     
     '''
     Get GeoTransform from ancillary raster: rows, columns, 
@@ -89,125 +1858,244 @@ def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path,
     '''
     rows = ancRaster.RasterYSize
     cols = ancRaster.RasterXSize
-    ulx = ancRaster.GetGeoTransform()[0]
-    uly = ancRaster.GetGeoTransform()[3]
     anc_proj = ancRaster.GetProjection()
     
     """
-    Create population raster from census population features using the 
-    GeoTransform from the ancillary raster. Set pop_nd as the NoData value 
-    for the population raster. 
+    Assign each source unit a dense polygon index from 1 to N that maps back to 
+    the population key field. The polygon index is rasterized one window at a 
+    time while the dasymetric units are created.
     """
-    print ("Creating population raster...")
-    popRast = rast_driver.Create(popRaster, cols, rows, 1, 
-                                gdal.GDT_Float32, options=["COMPRESS=LZW"])
-    popRast.SetGeoTransform((ulx, ancRaster.GetGeoTransform()[1], 0, 
-                             uly, 0, ancRaster.GetGeoTransform()[5]))
-    popRast.SetProjection(anc_proj)
-    popRast.GetRasterBand(1).SetNoDataValue(pop_nd)
-    gdal.RasterizeLayer(popRast, [1], popLayer, 
-                        options = ["ATTRIBUTE=" + popKeyField])
-    popRast = None
+    _stage("read_features", "Reading population features...")
+    polyKeys, polys = _poly_index(popLayer, popKeyField, anc_proj, pop_nd)
+    
+    '''
+    Process only the window of the ancillary raster that covers the population 
+    features. The outputs are written on this sub-grid of the ancillary 
+    raster, with the upper left corner snapped to its pixels.
+    '''
+    extent = (0, 0, cols, rows)
+    if extent_pad is not None:
+        extent = _footprint_window(polys.envelopes, 
+                                   ancRaster.GetGeoTransform(), cols, rows,
+                                   int(extent_pad))
+        logger.info("Processing a {0} x {1} window of the {2} x {3} "
+                    "ancillary raster...".format(extent[2], extent[3], cols, 
+                                                 rows))
+    ulx = ancRaster.GetGeoTransform()[0] + \
+        extent[0] * ancRaster.GetGeoTransform()[1]
+    uly = ancRaster.GetGeoTransform()[3] + \
+        extent[1] * ancRaster.GetGeoTransform()[5]
     
     """
-    Burn the NoData value from the ancillary raster into the pixels that 
-    overlap uninhabited areas
+    Read the uninhabited areas. The NoData value from the ancillary raster is 
+    burned into the pixels that overlap uninhabited areas in each window.
     """
+    uninhab = None
     if uninhab_path:
         uninhab_ds = ogr.Open(uninhab_path)
-        uninhabLayer = uninhab_ds.GetLayer()
-        uninhab_anc = os.path.join(out_dir, "uninhab_landcover.tif")
-        uninhab_rast = rast_driver.CreateCopy(uninhab_anc, 
-                                              gdal.Open(ancRaster_path), 
-                                              options=['COMPRESS=LZW'])
-        gdal.RasterizeLayer(uninhab_rast, [1], uninhabLayer, 
-                            burn_values = [anc_nd])
-        uninhab_rast = None
+        uninhab = _uninhab_polys(uninhab_ds.GetLayer(), anc_proj)
         uninhab_ds = None
-        ancRaster = gdal.Open(uninhab_anc)
-    
-    print ("Creating dasymetric units...")
-    #Read ancillary raster and population raster as array
-    anc_arr = ancRaster.GetRasterBand(1).ReadAsArray().astype(np.uint64)
-    popRast = gdal.Open(popRaster)
-    pop_arr = popRast.GetRasterBand(1).ReadAsArray().astype(np.uint64)
-    
-    """
-    Convert pixel values of ancillary raster that do not overlap with census 
-    polygons to NoData.
-    """
-    anc_arr[pop_arr == pop_nd] = anc_nd
-    
-    """
-    Combine the ancillary raster and the population raster using Cantor's 
-    pairing function to return a unique integer value for a pair(x,y)
-    """
-    comb_arr = 0.5 * (pop_arr + anc_arr) * (pop_arr + anc_arr + 1) + anc_arr 
     
+    _stage("dasymetric_units", 
+           "Creating population raster and dasymetric units...")
+    anc_band = ancRaster.GetRasterBand(1)
+    windows = list(_iter_windows(anc_band, tile_size, extent))
+
+    '''
+    Resume the pass when the checkpoint of an interrupted run has saved 
+    some of its windows and the rasters are still there. Otherwise remove 
+    rasters left by an earlier run before writing new ones: they may be 
+    hard links to cached rasters that must not be overwritten in place.
+    '''
+    progress = None
+    if checkpoint is not None and \
+            all(os.path.isfile(path) for path in outRasters):
+        progress = checkpoint.windows("units", len(windows))
+    if progress is None:
+        for rasterName in _CACHED_RASTERS:
+            if os.path.isfile(os.path.join(out_dir, rasterName)):
+                os.remove(os.path.join(out_dir, rasterName))
+    nDone = progress["windows"] if progress else 0
+    #Rasters whose windows are all written are not opened again
+    writeRasters = nDone < len(windows)
+
+    #Optional copy of the ancillary raster with the uninhabited areas burned in
+    outTransform = (ulx, ancRaster.GetGeoTransform()[1], 0, 
+                    uly, 0, ancRaster.GetGeoTransform()[5])
+    uninhabRast = None
+    if uninhab is not None and uninhab_raster and writeRasters:
+        uninhabRast = _output_raster(
+                uninhabRaster, nDone > 0, extent[2], extent[3], 
+                anc_band.DataType, outTransform, anc_proj,
+                anc_band.GetNoDataValue(), profile)
+
+    '''
+    Each dasymetric unit is coded as polygon index * nClasses + ancillary 
+    class. Use 32-bit unit codes whenever the largest code fits. The 
+    population and dasymetric rasters are stored in the narrowest type that 
+    holds the largest polygon index and unit code.
+    '''
+    nClasses = _class_count(anc_band, anc_nd)
+    if (len(polyKeys) + 1) * nClasses <= 2**32:
+        unit_dtype = np.uint32
+    else:
+        unit_dtype = np.uint64
+    unit_gdt = _uint_type((len(polyKeys) + 1) * nClasses - 1)[0]
+    pop_gdt = _uint_type(len(polyKeys))[0]
+
     """
-    Write the combine array to the dasymetric raster using the GeoTransform 
-    from the ancillary raster
+    Create the population raster and the dasymetric raster on the processing 
+    extent of the ancillary raster. Pixels outside of the census 
+    polygons have a polygon index and a unit code of 0, which is the NoData 
+    value for both rasters.
     """
-    dasyRast = rast_driver.Create(dasyRaster, cols, rows, 1, 
-                            gdal.GDT_Float64, options=['COMPRESS=LZW'])
-    dasyRast.SetGeoTransform((ulx, ancRaster.GetGeoTransform()[1], 0, 
-                              uly, 0, ancRaster.GetGeoTransform()[5]))
-    dasyRast.SetProjection(anc_proj)
-    dasyRast_b1 =dasyRast.GetRasterBand(1)
-    dasyRast_b1.WriteArray(comb_arr)
+    popRast = None
+    if popRaster and pop_raster and writeRasters:
+        popRast = _output_raster(popRaster, nDone > 0, extent[2], extent[3], 
+                                 pop_gdt, outTransform, anc_proj, 0, profile)
+        popRast_b1 = popRast.GetRasterBand(1)
     
-    """
-    Set the NoData value for the dasymetric raster band by running the same 
-    Cantor's pairing function on the NoData values from the population raster 
-    and ancillary raster.
-    """
-    dasy_nd = 0.5 * (pop_nd + anc_nd) * (pop_nd + anc_nd + 1) + anc_nd
-    dasyRast_b1.SetNoDataValue(dasy_nd)
     dasyRast = None
-    
-    """
-    Make the population DataFrame and the dasymetric DataFrame: collect the 
-    unique values and counts, rearrange the array via transpose, convert to 
-    DataFrame, and rename columns.
-    """
-    dasy_ar_un = np.array(np.unique(comb_arr, return_counts = True)).T
-    dasy_df = pd.DataFrame(dasy_ar_un, columns = ("Value", "Count"))
-    
-    pop_ar_un = np.array(np.unique(pop_arr, return_counts = True)).T
-    pop_df = pd.DataFrame(pop_ar_un, columns = ("Value", "Count"))
-    
+    if writeRasters:
+        dasyRast = _output_raster(dasyRaster, nDone > 0, extent[2], 
+                                  extent[3], unit_gdt, outTransform, 
+                                  anc_proj, 0, profile)
+        dasyRast_b1 = dasyRast.GetRasterBand(1)
+
     '''
-    Inverse of Cantor's pairing to get the polygon ID and ancillary class 
-    associated with each dasy unit.
-    w = (sqrt(8 * dasy_df['Value'] + 1) - 1) // 2
+    Stream through the rasters one window at a time so that only a window of
+    each raster is held in memory. For each window the polygon index is 
+    rasterized, combined with the ancillary raster into unit codes and the 
+    pixels of each dasymetric unit are counted, in a pool of worker processes 
+    when workers > 1. The windows are written in order and the counts are 
+    merged once all windows have been processed; units of polygons that cross 
+    window boundaries are summed. Windows are read from the ancillary raster 
+    and written to the outputs offset by the corner of the extent. With a 
+    checkpoint, the counts so far are merged and saved with the number of 
+    windows written from time to time.
     '''
-    num = 8*dasy_df['Value'] + 1
-    dasy_df['w'] = (num.pow(1./2) - 1) // 2
-    dasy_df['t'] = (dasy_df['w'].pow(2) + dasy_df['w']) / 2
-    dasy_df['ancID'] = dasy_df['Value'] - dasy_df['t'] 
-    dasy_df['polyID'] = dasy_df['w'] - dasy_df['ancID']
+    state = {'anc_path': ancRaster.GetDescription(), 'polys': polys,
+             'geoTransform': ancRaster.GetGeoTransform(),
+             'nClasses': nClasses, 'unit_dtype': unit_dtype,
+             'uninhab': uninhab, 'anc_nd': anc_nd,
+             'return_anc': uninhabRast is not None, 
+             'kernel': _check_kernel(kernel)}
+    crosstabs = [progress["crosstab"]] if progress else []
+    for i, (window, pop_arr, comb_arr, crosstab, anc_arr) in enumerate(
+            _map_windows(_dasy_window, windows[nDone:], state, workers, 
+                         threads, queue_depth), nDone + 1):
+        _lap()
+        outX = window[0] - extent[0]
+        outY = window[1] - extent[1]
+        if uninhabRast is not None:
+            uninhabRast.GetRasterBand(1).WriteArray(anc_arr, outX, outY)
+        if popRast is not None:
+            popRast_b1.WriteArray(pop_arr, outX, outY)
+        dasyRast_b1.WriteArray(comb_arr, outX, outY)
+        crosstabs.append(crosstab)
+        _lap('write')
+        if checkpoint is not None and checkpoint.due(i, len(windows)):
+            crosstabs = [merge_crosstabs(crosstabs)]
+            checkpoint.save_windows("units", i, len(windows), 
+                                    [uninhabRast, popRast, dasyRast], 
+                                    {"crosstab": crosstabs[0]})
 
-    #get rid of unnecessary columns and NoData values
-    dasy_df = dasy_df[dasy_df['Value'] != dasy_nd].drop(columns = ['w','t'])
-    pop_df = pop_df[pop_df['Value'] != pop_nd]
+    dasyRast = None
+    popRast = None
+    uninhabRast = None
+    _lap('write')
 
-    #Set variables for DataFrame columns
-    popIDField = 'polyID'
-    ancCatName = 'ancID'
-    dasyAreaField = 'Count'
+    unitCodes, unitCounts = merge_crosstabs(crosstabs)
+    _lap('merge_crosstabs')
+    return unitCodes, unitCounts, polyKeys, nClasses
 
-    #Make lists to use later
-    #All ancillary categories in study area
-    inAncCatList = list(np.unique(dasy_df[ancCatName]).astype(int))
+#Count fields of a run: one field name or a list of them
+def _count_fields(popCountField):
+    if isinstance(popCountField, str):
+        return [popCountField]
+    return list(popCountField)
+
+#Name of a table column of a count field
+def _field_column(column, field, popCountField):
+    '''
+    Return the name of column for the count field field. The columns keep 
+    their names when popCountField is a single field name; with a list of 
+    count fields the field name is appended, e.g. NEWDENSITY_POP10.
+    '''
+    if isinstance(popCountField, str):
+        return column
+    return column + "_" + field
+
+#Population count of each source polygon
+def _read_pop_counts(popFeat_path, popKeyField, popCountField, 
+                     popFilter = None, popBounds = None):
+    '''
+    Read the population count field of the population features as a Series
+    named popCountField and indexed by the population key field, or, when 
+    popCountField is a list of count fields, a DataFrame with a column for 
+    each. popFilter and popBounds select the features as for the units. Only 
+    the key and count columns are read; the geometries are ignored unless 
+    they are needed by popBounds. The selected features are read in layer 
+    order, so missing and duplicate keys are kept as they are for the join.
+    '''
+    countFields = _count_fields(popCountField)
+    readFields = [popKeyField] + countFields
+    popFeatures = ogr.Open(popFeat_path)
+    if popFeatures is None:
+        raise IOError("Unable to open population features " + popFeat_path)
+    popLayer = popFeatures.GetLayer()
+    if popFilter:
+        popLayer.SetAttributeFilter(popFilter)
+    if popBounds is not None:
+        popLayer.SetSpatialFilterRect(*[float(v) for v in popBounds])
+    popDefn = popLayer.GetLayerDefn()
+    fieldNames = [popDefn.GetFieldDefn(i).GetName() 
+                  for i in range(popDefn.GetFieldCount())]
+    for field in readFields:
+        if field not in fieldNames:
+            raise ValueError("The population features have no field " + field)
+    popLayer.SetIgnoredFields(
+            [name for name in fieldNames if name not in readFields] + 
+            (['OGR_GEOMETRY'] if popBounds is None else []) + ['OGR_STYLE'])
     
-    '''            
-    This list will be populated with ancillary categories that are not sampled 
-    and do not have preset class densities.
     '''
-    unSampledList = []
-                
-    #Preset class densities from config.json file
-    presetData = json.load(open(presetTable))
+    Read the columns as Arrow record batches when GDAL and pyarrow support 
+    it, otherwise one feature at a time. Integer columns with missing values 
+    become floats with NaN in both cases.
+    '''
+    if pa is not None and hasattr(popLayer, 'GetArrowStreamAsPyArrow'):
+        stream = popLayer.GetArrowStreamAsPyArrow(['INCLUDE_FID=NO'])
+        popfeat_df = pa.Table.from_batches(
+                list(stream), schema = stream.schema).to_pandas()
+        for field in readFields:
+            if popfeat_df[field].dtype.kind in 'iu':
+                popfeat_df[field] = popfeat_df[field].astype(np.int64)
+    else:
+        fieldIdx = [popDefn.GetFieldIndex(field) for field in readFields]
+        columns = [[] for field in readFields]
+        for feat in popLayer:
+            for column, idx in zip(columns, fieldIdx):
+                column.append(feat.GetField(idx))
+        popfeat_df = pd.DataFrame(dict(
+                (field, pd.Series(column)) 
+                for field, column in zip(readFields, columns)))
+    popFeatures = None
+    
+    if isinstance(popCountField, str):
+        popCounts = popfeat_df[popCountField]
+    else:
+        popCounts = popfeat_df[countFields]
+    popCounts.index = popfeat_df[popKeyField]
+    return popCounts
+
+#Inhabited ancillary classes of the dasymetric units
+def _inhabited_classes(dasy_df, presetData):
+    '''
+    Return the ancillary classes in the dasymetric DataFrame that do not have
+    a preset class density of 0.
+    '''
+    #All ancillary categories in study area
+    inAncCatList = list(np.unique(dasy_df['ancID']).astype(int))
     
     '''
     Uninhabited classes: ancially classes where people do not live. Classes with
@@ -216,35 +2104,53 @@ def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path,
     unInhabList = [int(presetCat) for presetCat,presetVal in presetData.items()
                     if float(presetVal) == 0]
     
+    return [cat for cat in inAncCatList if cat not in unInhabList]
+
+#Populated area and population density of the source polygons
+def _prepare_tables(dasy_df, pop_df, popCounts, popCountField, presetData):
+    '''
+    Join the population counts to the dasymetric and population DataFrames and
+    calculate the populated area of each source polygon and its population
+    density. None of this depends on the sampling parameters, so a parameter
+    sweep prepares the tables once. popCountField can be a list of count 
+    fields, with popCounts a DataFrame of them. Returns the dasymetric and 
+    population DataFrames.
+    '''
+    countFields = _count_fields(popCountField)
+    #Set variables for DataFrame columns
+    popIDField = 'polyID'
+    ancCatName = 'ancID'
+    dasyAreaField = 'Count'
+
     #Ancillary classes where people can live
-    InhabList = [cat for cat in inAncCatList if cat not in unInhabList]
+    InhabList = _inhabited_classes(dasy_df, presetData)
     
     '''
     Join the census population counts to the dasymetric DataFrame and calculate 
     population density for the polygon. 
     '''
-    print ("Calculating populated area...")
-    #Read the source population shapefile with the population count field.
-    popfeat_df = gp.read_file(popFeat_path)
-
+    _stage("populated_area", "Calculating populated area...")
     '''
     Set the polygon ID field provided by the user as an index for the 
-    population features DataFrame and the population DataFrame for joining and 
-    transfering the population count field.
+    population DataFrame for joining and transfering the population count 
+    field.
     '''
-    popfeat_df.index = popfeat_df[popKeyField]
     pop_df.index = pop_df["Value"]
     
     '''
-    Join population counts from popfeat_df to the dasymetric DataFrame and the 
+    Join population counts from popCounts to the dasymetric DataFrame and the 
     population DataFrame. Rename the field to "POP_COUNT" in the dasymetric 
     DataFrame.
     '''
-    dasy_df = dasy_df.join(popfeat_df[popCountField], 
+    dasy_df = dasy_df.join(popCounts, 
                            on = popIDField).rename(
-                                   columns = {popCountField: "POP_COUNT"}
+                                   columns = dict(
+                                           (field, _field_column(
+                                                   "POP_COUNT", field, 
+                                                   popCountField)) 
+                                           for field in countFields)
                                    )
-    pop_df = pop_df.join(popfeat_df[popCountField])
+    pop_df = pop_df.join(popCounts)
 
     '''
     Group the dasymetric units that are associated with inhabitable classes by 
@@ -267,49 +2173,261 @@ def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path,
     Calculate population density for census polygons where poulated area is 
     greater than 0.
     '''
-    print ("Calculating population density...")           
+    logger.info("Calculating population density...")
     pop_densMask = pop_df["POP_AREA"] > 0
-    pop_df.loc[pop_densMask, "POP_DENS"] = pop_df.loc[
-            pop_densMask, popCountField] / pop_df.loc[pop_densMask, "POP_AREA"]
+    for field in countFields:
+        pop_df.loc[pop_densMask, _field_column(
+                "POP_DENS", field, popCountField)] = pop_df.loc[
+                pop_densMask, field] / pop_df.loc[pop_densMask, "POP_AREA"]
     #replace NaN with 0
     pop_df = pop_df.fillna(0)
+    return dasy_df, pop_df
+
+#Sums of the columns of a matrix of count fields by segment
+def _field_sums(index, values, n):
+    '''
+    Return the sums of the rows of values, with a column for each count 
+    field, by index into n segments. Each column is summed with np.bincount 
+    so that the sums are the same as for a single count field.
+    '''
+    return np.column_stack([np.bincount(index, weights = values[:, i], 
+                                        minlength = n) 
+                            for i in range(values.shape[1])])
+
+#Sums of the columns of a matrix by segment, over the entries of a mask
+def _column_sums(index, values, mask, n):
+    '''
+    Return the sums of each column of values by index into n segments, 
+    counting only the entries where mask, which has a column for each column 
+    of values or a single column for all of them, is True. The entries of 
+    all columns are summed with one np.bincount, in row order within a 
+    segment as for a bincount of each column.
+    '''
+    nColumns = values.shape[1]
+    rows, columns = np.nonzero(np.broadcast_to(mask, (len(values), nColumns)))
+    return np.bincount(index[rows] * nColumns + columns, 
+                       weights = values[rows, columns], 
+                       minlength = n * nColumns).reshape(n, nColumns)
+
+#Population estimates with intelligent areal weighting of unsampled classes
+def _iaw_estimates(catDens, catKnown, unsampledCat, anc, poly, area, 
+                   popCount, nPolys):
+    '''
+    Return the class density and the population estimate of each dasymetric 
+    unit, the IAW classes, the IAW class densities and the intermediate IAW 
+    columns. catDens holds the density of each class with a known density 
+    (catKnown) for each column of popCount, which are count fields, 
+    bootstrap replicates or parameter settings. The densities of the 
+    unsampled classes (unsampledCat) are estimated from the population left 
+    in their polygons; they are NaN for classes without an estimate. 
+    catKnown and unsampledCat flag each class for all columns, or are 
+    matrices with a column of flags for each column of catDens when the 
+    columns are different parameter settings; the intermediate IAW columns 
+    are then matrices too.
+    '''
+    nCats = len(catKnown)
+    flagColumns = catKnown.ndim == 2
+    catKnown = catKnown.reshape(nCats, -1)
+    unsampledCat = unsampledCat.reshape(nCats, -1)
+    classDens = catDens[anc]
+    
+    '''
+    POP_EST = area of the dasymetric unit 
+    * the representative population density of the ancillary class associated 
+    with the dasymetric unit
+    '''
+    popEst = np.where(catKnown[anc], area[:, None] * classDens, 0.0)
+    iawCats = np.zeros(0, dtype = np.int64)
+    iawDens = np.full(catDens.shape, np.nan)
+    iawColumns = []
+    if not unsampledCat.any():
+        return classDens, popEst, iawCats, iawDens, iawColumns
+    
+    unsampled_mask = unsampledCat[anc]
+    
+    '''
+    Populate remainining area of each dasymetric unit as the area of 
+    dasymetric units associated with unsampled classes and 0 everywhere 
+    else.
+    '''
+    remArea = np.where(unsampled_mask, area[:, None], 0).astype(np.int64)
+    
+    '''                          
+    For each polygon, sum the remaining area and sum the population that 
+    has already been estimated for sampled/preset classes.
+    '''
+    popEstPoly = _field_sums(poly, popEst, nPolys)[poly]
+    remAreaPoly = _field_sums(poly, remArea, nPolys).astype(np.int64)[poly]
+    
+    '''
+    Calcualte a population difference between the census population and the 
+    population estimated for sampled/preset ancillary classes.
+    '''
+    popDiff = popCount - popEstPoly
+    
+    '''
+    Calculate an initial population estimate for dasymetric units 
+    associated with unsampled ancillary classes and polygons where the 
+    sampled/preset population estimates did not exceed the census 
+    population count. The mask is the bitwise and of the unsampled flag 
+    and the remaining area of the polygon, as in the DataFrame 
+    implementation this replaces, so that the results do not change.
+    '''
+    diff_mask = (unsampled_mask & remAreaPoly) != 0
+    diffUnits = np.broadcast_to(diff_mask, popEst.shape)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        popEst[diffUnits] = (np.clip(popDiff, 0, None) * remArea / 
+                             remAreaPoly)[diffUnits]
+    
+    '''
+    Sum total initial population estimates and remaining area for 
+    dasymetric units used to calculate initial population estimates for 
+    unsampled ancillary classes, and calculate the representative 
+    population density for those classes.
+    '''
+    catPopEst = _column_sums(anc, popEst, diffUnits, nCats)
+    catRemArea = _column_sums(anc, remArea, diff_mask, nCats)
+    iawCats = np.flatnonzero((catRemArea > 0).any(axis = 1))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        iawDens = np.where(catRemArea > 0, catPopEst / catRemArea, np.nan)
+    
+    '''
+    Calculate new population estimates using representative population 
+    densities for unsampled classes.
+    POP_EST = dasymetric area * class density
+    '''
+    classDens = np.where(unsampled_mask, iawDens[anc], classDens)
+    popEst = np.where(unsampled_mask, area[:, None] * classDens, popEst)
+    if not flagColumns:
+        remArea = remArea[:, 0]
+        remAreaPoly = remAreaPoly[:, 0]
+    iawColumns = [("REM_AREA", remArea), ("POP_ESTpoly", popEstPoly),
+                  ("REM_AREApoly", remAreaPoly), ("POP_DIFF", popDiff)]
+    return classDens, popEst, iawCats, iawDens, iawColumns
+
+#Redistribution of the population counts in proportion to the estimates
+def _redistribute(popEst, poly, area, popCount, nPolys):
+    '''
+    Return the distribution ratio, population and population density of 
+    each dasymetric unit for each column of popCount. popEst is set to 1 in 
+    the populated polygons without any population estimate.
+    '''
+    '''
+    if the sum of population densities within the source unit is equal to 0
+    set the POP_EST for those to 1 (i.e., area weighting (equation 5)). 
+    Population estimates of classes without a class density are missing and 
+    do not count towards the sum.
+    '''
+    popEstSum = _field_sums(poly, np.nan_to_num(popEst), nPolys)
+    popCountSum = _field_sums(poly, popCount, nPolys)
+    areaWeight = (popEstSum == 0) & (popCountSum > 0)
+    popEst[areaWeight[poly]] = 1
+    
+    #Sum population estimates by polygon.
+    popEstSum = _field_sums(poly, np.nan_to_num(popEst), nPolys)
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        totalFract = popEst / popEstSum[poly]
+        newPop = totalFract * popCount
+        newDensity = newPop / area[:, None]
+    return totalFract, newPop, newDensity
+
+#Source polygon of each dasymetric unit and population row
+def _polygon_segments(dasy_df, pop_df):
+    '''
+    Return the polygon segment of each row of the dasymetric DataFrame and of 
+    each row of the population DataFrame, and the number of segments. There 
+    is a segment for each polygon ID rather than for each row of the 
+    population DataFrame: population features with the same key (e.g. the 
+    parts of a multipart feature) are joined as several rows with the same 
+    ID, which are summed together as by a groupby of the ID.
+    '''
+    polyIDs = pd.Index(pd.unique(pop_df["Value"].values))
+    poly = polyIDs.get_indexer(dasy_df['polyID'])
+    if (poly < 0).any():
+        raise ValueError("Some dasymetric units belong to polygons that are "
+                         "not in the population DataFrame")
+    return poly, polyIDs.get_indexer(pop_df["Value"]), len(polyIDs)
+
+#Class densities and redistributed population for one parameter setting
+def _class_densities(dasy_df, pop_df, popCountField, presetData,
+                     popAreaMin = 1, sampleMin = 3, percent = 0.95):
+    '''
+    Select representative units, calculate the representative population
+    density of each ancillary class by sampling, presets and intelligent
+    areal weighting, and redistribute the population of each source polygon
+    to its dasymetric units. Takes the DataFrames returned by _prepare_tables
+    and returns the dasymetric DataFrame, the population DataFrame and the
+    sampling summary DataFrame. With a list of count fields every field is 
+    redistributed at once and the tables get a column per field.
+    '''
+    pop_df = pop_df.copy()
+    countFields = _count_fields(popCountField)
+    #Set variables for DataFrame columns
+    popIDField = 'polyID'
+    ancCatName = 'ancID'
+    dasyAreaField = 'Count'
+
+    #Ancillary classes where people can live
+    InhabList = _inhabited_classes(dasy_df, presetData)
+    
+    '''            
+    This list will be populated with ancillary categories that are not sampled 
+    and do not have preset class densities.
+    '''
+    unSampledList = []
+    
+    '''
+    The rows of the dasymetric DataFrame are the non-zero entries of a 
+    polygon by class matrix of pixel counts: row i holds the count of polygon 
+    poly[i] (a polygon ID of the population DataFrame) and class anc[i]. 
+    Sums over the polygons or over the classes are segment sums with 
+    np.bincount, so every step below is a single pass over the dasymetric 
+    units.
+    '''
+    poly, popPoly, nPolys = _polygon_segments(dasy_df, pop_df)
+    anc = dasy_df[ancCatName].values.astype(np.int64)
+    nCats = max(int(anc.max()) + 1 if anc.size else 1,
+                max(InhabList) + 1 if InhabList else 1)
+    area = dasy_df[dasyAreaField].values
+    popArea = dasy_df["POP_AREA"].values.astype(np.float64)
+    '''
+    The representative units, the sampled classes and the classes left to 
+    IAW depend only on areas, so they are the same for every count field. 
+    The counts, estimates and densities are matrices with a column for each 
+    count field.
+    '''
+    popCount = dasy_df[[_field_column("POP_COUNT", field, popCountField) 
+                        for field in countFields]].fillna(0).values.astype(
+                                np.float64)
+    classDensColumns = [_field_column("CLASSDENS", field, popCountField) 
+                        for field in countFields]
     
     '''
     Calculate representative population density for ancillary classes that have 
     enough representative samples in the study area.
     '''
-    print ("Selecting representative units...")
-    #Create column for the ancillary class that a polygon is representative of 
-    pop_df["REP_CAT"] = 0
-
+    _stage("sampling", "Selecting representative units...")
+    '''
+    A dasymetric unit is representative of its class when its polygon has a 
+    populated area greater than popAreaMin and the class covers at least 
+    percent of that area.
     '''
-    For each inhabitable ancillary class, collect polygon IDs of census 
-    polygons that meet the user-define criteria for being representative of an 
-    ancillary class.
-    '''        
+    inhabCat = np.zeros(nCats, dtype = bool)
+    inhabCat[InhabList] = True
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        repUnits_mask = (popArea > float(popAreaMin)) & inhabCat[anc] & (
+                area / popArea >= float(percent))
+    repCounts = np.bincount(anc[repUnits_mask], minlength = nCats)
+    sampledCat = inhabCat & (repCounts >= float(sampleMin))
+    
     for inAncCat in InhabList:
-        repUnits_mask = (
-                dasy_df["POP_AREA"] > float(popAreaMin)
-                ) & (
-                        dasy_df[ancCatName] == inAncCat
-                        )
-        repUnits = dasy_df.loc[
-                repUnits_mask, [
-                        dasyAreaField, popIDField, ancCatName, "POP_AREA"
-                        ]
-                ]
-        repUnits["PERCENT"] = repUnits[dasyAreaField] / repUnits["POP_AREA"]                
-        repUnits = list(
-                repUnits[repUnits["PERCENT"] >= float(percent)][popIDField]
-                )
-                
-        if len(repUnits) >= float(sampleMin):
-            pop_df.loc[pop_df['Value'].isin(repUnits), "REP_CAT"] = inAncCat
-            print ("Class " 
-                   + str(inAncCat) 
-                   + " was sufficiently sampled with " 
-                   + str(len(repUnits)) 
-                   + " representative source units.")
+        if sampledCat[inAncCat]:
+            logger.info("Class " 
+                        + str(inAncCat) 
+                        + " was sufficiently sampled with " 
+                        + str(repCounts[inAncCat]) 
+                        + " representative source units.")
             
             '''
             #If ancillary category has no representative polygons and it does 
@@ -318,22 +2436,33 @@ def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path,
             '''
         elif str(inAncCat) not in list(presetData):
             unSampledList.append(int(inAncCat))
-            print ("Class " 
-                   + str(inAncCat) 
-                   + " was not sufficiently sampled with only " 
-                   + str(len(repUnits)) 
-                   + " representative source units.")
+            logger.info("Class " 
+                        + str(inAncCat) 
+                        + " was not sufficiently sampled with only " 
+                        + str(repCounts[inAncCat]) 
+                        + " representative source units.")
+    
+    '''
+    The representative class (REP_CAT) of a polygon is the sampled class it 
+    is representative of. A polygon can only be representative of more than 
+    one class when percent is 0.5 or less; it then takes the highest class.
+    Every row of the population DataFrame with the polygon ID takes it.
+    '''
+    repUnits_mask &= sampledCat[anc]
+    repCat = np.zeros(nPolys, dtype = np.int64)
+    np.maximum.at(repCat, poly[repUnits_mask], anc[repUnits_mask])
+    pop_df["REP_CAT"] = repCat[popPoly]
             
     #Calculate statistics and make sampling summary table
-    print (
+    logger.info(
             "Calculating representative population density for selected" \
             " classes..."
             )
     
     '''
-    Create a mask for rows in the dasymetric DataFrame where REP_CAT =! 0. 
-    We only want to create summaries for these dasymetric rows because they are 
-    associated with representative polygons.
+    Create a mask for rows in the population DataFrame where REP_CAT =! 0. 
+    We only want to create summaries for these rows because they are 
+    representative polygons.
     '''
     rep_mask = pop_df["REP_CAT"] != 0
 
@@ -342,219 +2471,815 @@ def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path,
     each sampled ancillary class.
     '''
     classDens_df = pop_df[rep_mask].groupby("REP_CAT")[
-            [popCountField, 'POP_AREA']
+            countFields + ['POP_AREA']
             ].sum().rename(
-            columns = {popCountField: "SUM_" + popCountField, 
-                       "POP_AREA": "SUM_POP_AREA"}
+            columns = dict([(field, "SUM_" + field) for field in countFields] 
+                           + [("POP_AREA", "SUM_POP_AREA")])
             )
             
     #Calculate sample density for sampled classes
-    classDens_df["SAMPLEDENS"] = classDens_df[
-            "SUM_" + popCountField
-            ] / classDens_df["SUM_POP_AREA"]
+    for field in countFields:
+        classDens_df[_field_column("SAMPLEDENS", field, popCountField)] = \
+            classDens_df["SUM_" + field] / classDens_df["SUM_POP_AREA"]
     classDens_df["METHOD"] = "Sampled"
-    classDens_df["CLASSDENS"] = classDens_df["SAMPLEDENS"]
+    for field, column in zip(countFields, classDensColumns):
+        classDens_df[column] = classDens_df[
+                _field_column("SAMPLEDENS", field, popCountField)]
                     
     #Add preset densities to summary table
-    if presetTable:
-        print ("Adding preset values to the summary table...")
+    if presetData:
+        logger.info("Adding preset values to the summary table...")
         for preset_cat in list(presetData):
-            classDens_df.loc[int(preset_cat), "CLASSDENS"] = presetData[
-                    preset_cat
-                    ]
+            for column in classDensColumns:
+                classDens_df.loc[int(preset_cat), column] = presetData[
+                        preset_cat
+                        ]
             classDens_df.loc[int(preset_cat), "METHOD"] = 'Preset'
             
     # For all sampled and preset classes, calculate a population estimate.
-    print (
+    logger.info(
             "Calculating population estimate for sampled and preset classes..."
-            )            
-    #Get representative population densities from class density DataFrame.
-    dasy_df = dasy_df.join(classDens_df['CLASSDENS'], on = ancCatName).fillna(0)
+            )
+    #Class density of each ancillary class; 0 for classes without one yet
+    knownCats = classDens_df.index[classDens_df.index < nCats]
+    catKnown = np.zeros(nCats, dtype = bool)
+    catKnown[knownCats] = True
+    catDens = np.zeros((nCats, len(countFields)))
+    catDens[knownCats] = classDens_df.loc[knownCats, 
+                                          classDensColumns].astype(float).values
+    unsampledCat = np.zeros(nCats, dtype = bool)
+    unsampledCat[unSampledList] = True
     
+    # Intelligent areal weighting for unsampled classes            
+    _stage("iaw", 
+           "Performing intelligent areal weighting for unsampled classes...")
+    classDens, popEst, iawCats, iawDens, iawColumns = _iaw_estimates(
+            catDens, catKnown, unsampledCat, anc, poly, area, popCount, 
+            nPolys)
+        
+    #Update the class density DataFrame
+    for cat in iawCats:
+        for i, column in enumerate(classDensColumns):
+            classDens_df.loc[cat, column] = iawDens[cat, i]
+        classDens_df.loc[cat, "METHOD"] = "IAW"   
+             
+    # Perform final calculations to ensure pycnophylactic integrity
+    _stage("redistribution",
+           "Performing final calculations to ensure pycnophylactic" \
+           " integrity...")
+    totalFract, newPop, newDensity = _redistribute(popEst, poly, area, 
+                                                   popCount, nPolys)
     '''
-    #Set mask for dasy_df that will limit ancillary categories to those in the 
-    class density DataFrame.
+    Add the columns of each result, one per count field for the matrices, 
+    in one step.
     '''
-    popEst_mask = dasy_df[ancCatName].isin(classDens_df.index)
+    newColumns = []
+    for column, values in ([("CLASSDENS", classDens), ("POP_EST", popEst)] + 
+                           iawColumns + 
+                           [("TOTALFRACT", totalFract), ("NEW_POP", newPop), 
+                            ("NEWDENSITY", newDensity)]):
+        if values.ndim == 1:
+            newColumns.append((column, values))
+            continue
+        for i, field in enumerate(countFields):
+            newColumns.append((_field_column(column, field, popCountField), 
+                               values[:, i]))
+    dasy_df = dasy_df.fillna(0)
+    dasy_df = pd.concat([
+            dasy_df.drop([column for column, values in newColumns 
+                          if column in dasy_df.columns], axis = 1),
+            pd.DataFrame(dict(newColumns), index = dasy_df.index, 
+                         columns = [column for column, values in newColumns])
+            ], axis = 1)
     
+    #Replace nan with 0
+    dasy_df = dasy_df.fillna(0)
+    return dasy_df, pop_df, classDens_df
+
+#Class densities and redistributed population for many parameter settings
+def _sweep_densities(dasy_df, pop_df, popCountField, presetData, settings,
+                     chunk_cells = 2**24):
     '''
-    POP_EST = area of the dasymetric unit 
-    * the representative population density of the ancillary class associated 
-    with the dasymetric unit
+    Evaluate parameter settings, each a (popAreaMin, sampleMin, percent) 
+    tuple, on the DataFrames returned by _prepare_tables and yield, for each 
+    setting in order, its number, its sampling summary DataFrame and the 
+    REP_CAT of each row of the population DataFrame, NEW_POP and NEWDENSITY 
+    of each dasymetric unit as in _class_densities, with a column for each 
+    count field. The settings are evaluated together, a chunk of them at a 
+    time: the representative units of each setting are a column of a mask 
+    matrix, and the class densities, IAW and redistribution of all the 
+    settings and count fields of a chunk are single passes over matrices 
+    with a column for each, holding at most about chunk_cells values.
     '''
-    dasy_df["POP_EST"] = 0
-    dasy_df.loc[popEst_mask, "POP_EST"] = dasy_df.loc[
-            popEst_mask, dasyAreaField
-            ] * dasy_df.loc[
-                    popEst_mask, 'CLASSDENS'
-                    ]
+    countFields = _count_fields(popCountField)
+    nFields = len(countFields)
+    InhabList = _inhabited_classes(dasy_df, presetData)
+    poly, popPoly, nPolys = _polygon_segments(dasy_df, pop_df)
+    anc = dasy_df['ancID'].values.astype(np.int64)
+    nCats = max(int(anc.max()) + 1 if anc.size else 1,
+                max(InhabList) + 1 if InhabList else 1)
+    area = dasy_df['Count'].values
+    popArea = dasy_df["POP_AREA"].values.astype(np.float64)
+    popCount = dasy_df[[_field_column("POP_COUNT", field, popCountField) 
+                        for field in countFields]].fillna(0).values.astype(
+                                np.float64)
+    classDensColumns = [_field_column("CLASSDENS", field, popCountField) 
+                        for field in countFields]
+    sampleDensColumns = [_field_column("SAMPLEDENS", field, popCountField) 
+                         for field in countFields]
+    sumColumns = ["SUM_" + field for field in countFields] + ["SUM_POP_AREA"]
+    sumTypes = [pop_df[column].dtype 
+                for column in countFields + ["POP_AREA"]]
+    popSums = pop_df[countFields + ["POP_AREA"]].values.astype(np.float64)
     
-    # Intelligent areal weighting for unsampled classes            
-    print ("Performing intelligent areal weighting for unsampled classes...")
-    if unSampledList:
-        '''
-        Calculate representative population densities for unsampled ancillary 
-        classes using IAW
-        '''
-        unsampled_mask = dasy_df[ancCatName].isin(unSampledList)
-        
-        '''
-        Populate remainining area of each dasymetric unit as the area of 
-        dasymetric units associated with unsampled classes and 0 everywhere 
-        else.
-        '''
-        dasy_df["REM_AREA"] = 0
-        dasy_df.loc[unsampled_mask, "REM_AREA"] = dasy_df.loc[
-                unsampled_mask, dasyAreaField
-                ]
-        
-        '''                          
-        For each polygon, sum the remaining area and sum the population that 
-        has already been estimated for sampled/preset classes.
-        '''
-        popEstSum = dasy_df.groupby(popIDField)[
-                ["POP_EST", "REM_AREA"]
-                ].sum()
-        
-        '''
-        Join popEstSum to dasy_df to transfer the sum of population estimates 
-        and the sum of remaining area to the dasymetric DataFrame.
-        '''
-        dasy_df = dasy_df.join(popEstSum["POP_EST"], on = popIDField, 
-                               rsuffix = "poly")
-        dasy_df = dasy_df.join(popEstSum["REM_AREA"], on = popIDField, 
-                               rsuffix = "poly")
-        
-        '''
-        Calcualte a population difference between the census population and the 
-        population estimated for sampled/preset ancillary classes.
-        '''
-        dasy_df["POP_DIFF"] = dasy_df["POP_COUNT"] - dasy_df["POP_ESTpoly"]
+    inhabCat = np.zeros(nCats, dtype = bool)
+    inhabCat[InhabList] = True
+    presetCat = np.zeros(nCats, dtype = bool)
+    presetDens = np.zeros(nCats)
+    for preset_cat in list(presetData):
+        if int(preset_cat) < nCats:
+            presetCat[int(preset_cat)] = True
+            presetDens[int(preset_cat)] = presetData[preset_cat]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        areaShare = area / popArea
+    
+    chunk = max(1, chunk_cells // max(len(anc) * nFields, 1))
+    for first in range(0, len(settings), chunk):
+        block = settings[first:first + chunk]
+        nSettings = len(block)
+        popAreaMin, sampleMin, percent = [
+                np.array([float(setting[i]) for setting in block]) 
+                for i in range(3)]
         
         '''
-        Calculate an initial population estimate for dasymetric units 
-        associated with unsampled ancillary classes and polygons where the 
-        sampled/preset population estimates did not exceed the census 
-        population count. 
-        '''
-        diff_mask = (dasy_df[ancCatName].isin(unSampledList) &
-                     dasy_df['REM_AREApoly'] !=0 )
-        dasy_df.loc[diff_mask, "POP_EST"] = (
-                dasy_df.loc[diff_mask, "POP_DIFF"].clip(0) * 
-                dasy_df.loc[diff_mask, "REM_AREA"] / 
-                dasy_df.loc[diff_mask, "REM_AREApoly"])
+        The representative units of the settings are the columns of a mask 
+        matrix, and the sampled and unsampled classes and the 
+        representative class of each polygon are matrices with a column 
+        for each setting, selected as in _class_densities.
         '''
-        Sum total initial population estimates and remaining area for 
-        dasymetric units used to calculate initial population estimates for 
-        unsampled ancillary classes.
-        '''
-        ancCat_sum = dasy_df[diff_mask].groupby(ancCatName)[
-                ["POP_EST" , "REM_AREA"]
-                ].sum()
+        repUnits_mask = (popArea[:, None] > popAreaMin) & \
+            inhabCat[anc][:, None] & (areaShare[:, None] >= percent)
+        repCounts = _column_sums(anc, np.ones((len(anc), nSettings)), 
+                                 repUnits_mask, nCats)
+        sampledCat = inhabCat[:, None] & (repCounts >= sampleMin)
+        unsampledCat = inhabCat[:, None] & ~sampledCat & ~presetCat[:, None]
+        repUnits_mask &= sampledCat[anc]
+        rows, columns = np.nonzero(repUnits_mask)
+        repCat = np.zeros((nPolys, nSettings), dtype = np.int64)
+        np.maximum.at(repCat, (poly[rows], columns), anc[rows])
+        popRepCat = repCat[popPoly]
         
         '''
-        Calculate the representative population density for unsampled classes 
-        using ancCat_sum and update the class density DataFrame.
+        Sum the counts and populated areas of the representative polygons of 
+        each class in each setting. Classes with representative polygons 
+        have a sampled density, which presets replace.
         '''
-        for cat in ancCat_sum.index:
-            classDens_df.loc[cat, "CLASSDENS"] = ancCat_sum.loc[cat, 
-                            "POP_EST"] / ancCat_sum.loc[cat, 
-                                           "REM_AREA"]
-            classDens_df.loc[cat, "METHOD"] = "IAW"   
+        rows, columns = np.nonzero(popRepCat)
+        catIndex = popRepCat[rows, columns] * nSettings + columns
+        catSums = np.stack([np.bincount(catIndex, weights = popSums[rows, i],
+                                        minlength = nCats * nSettings)
+                            for i in range(nFields + 1)], 
+                           axis = 1).reshape(nCats, nSettings, nFields + 1)
+        catSampled = np.bincount(catIndex, minlength = nCats * nSettings
+                                 ).reshape(nCats, nSettings) > 0
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            sampleDens = catSums[:, :, :nFields] / catSums[:, :, nFields:]
+        catDens = np.where(catSampled[:, :, None], sampleDens, 0.0)
+        catDens[presetCat] = presetDens[presetCat][:, None, None]
+        catKnown = catSampled | presetCat[:, None]
         
         '''
-        Add representative population densities for unsampled classes in the 
-        dasymetric DataFrame.
+        IAW and redistribution of every setting and count field at once, 
+        with the count fields of a setting in consecutive columns.
         '''
-        dasy_df.loc[unsampled_mask, 'CLASSDENS'] = dasy_df.loc[
-                unsampled_mask
-                ].join(classDens_df.loc[
-                        ancCat_sum.index, 'CLASSDENS'
-                        ], 
-                on = ancCatName, rsuffix = "_classDens")['CLASSDENS_classDens']
+        settingCount = np.tile(popCount, (1, nSettings))
+        classDens, popEst, iawCats, iawDens, iawColumns = _iaw_estimates(
+                catDens.reshape(nCats, -1), 
+                np.repeat(catKnown, nFields, axis = 1), 
+                np.repeat(unsampledCat, nFields, axis = 1), 
+                anc, poly, area, settingCount, nPolys)
+        totalFract, newPop, newDensity = _redistribute(
+                popEst, poly, area, settingCount, nPolys)
+        newPop[np.isnan(newPop)] = 0
+        newDensity[np.isnan(newDensity)] = 0
         
-        '''
-        Calculate new population estimates using representative population 
-        densities for unsampled classes.
-        POP_EST = dasymetric area * class density
-        '''
-        dasy_df.loc[unsampled_mask, "POP_EST"] = dasy_df.loc[unsampled_mask, 
-                   dasyAreaField] * dasy_df.loc[unsampled_mask, 
-                               'CLASSDENS']
-                               
-        # End of intelligent areal weighting
-             
-    # Perform final calculations to ensure pycnophylactic integrity
-    print (
-            "Performing final calculations to ensure pycnophylactic" \
-            " integrity..."
-            )
+        for i in range(nSettings):
+            #The sampling summary table of the setting, as in _class_densities
+            cats = np.flatnonzero(catSampled[:, i])
+            classDens_df = pd.DataFrame(
+                    dict([(column, pd.Series(catSums[cats, i, j]).astype(
+                            sumTypes[j]).values) 
+                          for j, column in enumerate(sumColumns)] + 
+                         [(column, sampleDens[cats, i, j]) 
+                          for j, column in enumerate(sampleDensColumns)]),
+                    index = pd.Index(cats, name = "REP_CAT"),
+                    columns = sumColumns + sampleDensColumns)
+            classDens_df["METHOD"] = "Sampled"
+            for column, sampleColumn in zip(classDensColumns, 
+                                            sampleDensColumns):
+                classDens_df[column] = classDens_df[sampleColumn]
+            for preset_cat in list(presetData):
+                for column in classDensColumns:
+                    classDens_df.loc[int(preset_cat), column] = presetData[
+                            preset_cat]
+                classDens_df.loc[int(preset_cat), "METHOD"] = 'Preset'
+            settingDens = iawDens[:, i * nFields:(i + 1) * nFields]
+            for cat in np.flatnonzero(~np.isnan(settingDens[:, 0])):
+                for j, column in enumerate(classDensColumns):
+                    classDens_df.loc[cat, column] = settingDens[cat, j]
+                classDens_df.loc[cat, "METHOD"] = "IAW"
+            columns = slice(i * nFields, (i + 1) * nFields)
+            yield (first + i, classDens_df, popRepCat[:, i], 
+                   newPop[:, columns], newDensity[:, columns])
+
+#Column name of a percentile, e.g. P5 or P97_5
+def _percentile_name(q):
+    return "P" + "{0:g}".format(q).replace(".", "_")
+
+#Bootstrap replicates of the class densities and redistributed population
+def dasy_bootstrap(dasy_df, pop_df, classDens_df, popCountField, presetData,
+                   replicates = 1000, percentiles = (5, 50, 95), seed = None,
+                   chunk_cells = 2**24):
+    '''
+    Estimate the uncertainty of the class densities and of the redistributed 
+    population by resampling the representative units of each sampled class 
+    with replacement. Takes the tables returned by dasy_tables. -replicates: \
+    The number of bootstrap replicates (default = 1000). -percentiles: The \
+    percentiles of the replicates that are returned (default = 5, 50, 95). \
+    -seed: The seed of the random numbers, for reproducible replicates. \
+    -chunk_cells: The largest number of values of a matrix of replicates \
+    held in memory at once (default = 2**24). Returns the class DataFrame, \
+    indexed by REP_CAT, with the METHOD, CLASSDENS and the mean, standard \
+    deviation and percentiles of CLASSDENS over the replicates (e.g. \
+    CLASSDENS_P5), and the unit DataFrame with the Value and the \
+    percentiles of NEW_POP and NEWDENSITY of each dasymetric unit.
+    '''
+    countFields = _count_fields(popCountField)
+    percentiles = [float(q) for q in percentiles]
+    replicates = int(replicates)
+    rng = np.random.RandomState(seed)
+    poly, popPoly, nPolys = _polygon_segments(dasy_df, pop_df)
+    anc = dasy_df['ancID'].values.astype(np.int64)
+    area = dasy_df['Count'].values
+    popCount = dasy_df[[_field_column("POP_COUNT", field, popCountField) 
+                        for field in countFields]].fillna(0).values.astype(
+                                np.float64)
+    InhabList = _inhabited_classes(dasy_df, presetData)
+    nCats = max(int(anc.max()) + 1 if anc.size else 1,
+                max(InhabList) + 1 if InhabList else 1)
+    
+    '''
+    The sampled and preset classes have known densities before IAW; the 
+    other inhabited classes are estimated by IAW, as in _class_densities. 
+    Each replicate draws the representative units of each sampled class 
+    with replacement, which is a multinomial count of each unit, and the 
+    density of the class is the sum of their counts divided by the sum of 
+    their populated areas. Preset densities are the same in all replicates, 
+    including those of preset classes above the ancillary classes, which 
+    have no units and are not in the arrays of the classes.
+    '''
+    method = classDens_df["METHOD"]
+    cats = method.index.values.astype(np.int64)
+    inCats = cats < nCats
+    catKnown = np.zeros(nCats, dtype = bool)
+    catKnown[cats[inCats & (method.values != "IAW")]] = True
+    inhabCat = np.zeros(nCats, dtype = bool)
+    inhabCat[InhabList] = True
+    unsampledCat = inhabCat & ~catKnown
+    classDensColumns = [_field_column("CLASSDENS", field, popCountField) 
+                        for field in countFields]
+    catDens = np.zeros((len(countFields), nCats, replicates))
+    known = inCats.copy()
+    known[inCats] = catKnown[cats[inCats]]
+    catDens[:, cats[known]] = classDens_df.loc[
+            method.index[known], 
+            classDensColumns].astype(float).values.T[:, :, None]
+    repCat = pop_df["REP_CAT"].values
+    repCounts = pop_df[countFields].values.astype(np.float64)
+    repArea = pop_df["POP_AREA"].values.astype(np.float64)
+    for cat in cats[method.values == "Sampled"]:
+        members = np.flatnonzero(repCat == cat)
+        chunk = max(1, chunk_cells // len(members))
+        for start in range(0, replicates, chunk):
+            draws = rng.multinomial(
+                    len(members), np.full(len(members), 1.0 / len(members)),
+                    size = min(chunk, replicates - start)).astype(np.float64)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                catDens[:, cat, start:start + len(draws)] = (
+                        draws.dot(repCounts[members]) / 
+                        draws.dot(repArea[members])[:, None]).T
+    
+    '''
+    The IAW densities of each replicate are estimated from the population 
+    left in the polygons by the replicate's densities, for a chunk of 
+    replicates at a time with a column for each. The final density of a 
+    class is then its known or IAW density, and 0 for the other classes.
+    '''
+    if unsampledCat.any():
+        chunk = max(1, chunk_cells // max(len(anc), 1))
+        for i in range(len(countFields)):
+            for start in range(0, replicates, chunk):
+                stop = min(start + chunk, replicates)
+                iawDens = _iaw_estimates(catDens[i, :, start:stop], catKnown,
+                                         unsampledCat, anc, poly, area, 
+                                         popCount[:, i:i + 1], nPolys)[3]
+                catDens[i, unsampledCat, start:stop] = iawDens[unsampledCat]
+    
+    '''
+    Redistribute the population of the polygons in every replicate at once, 
+    for a chunk of whole polygons at a time, and keep the percentiles of the 
+    population of each dasymetric unit. The population density is the 
+    population divided by the constant area of the unit, so its 
+    percentiles are those of the population divided by the area.
     '''
-    For each dasymetric unit, use the ratio of the estimated population to the 
-    total population estimated for the polygon associated with the dasymetric 
-    unit to redistribute the census population.
+    names = [_percentile_name(q) for q in percentiles]
+    order = np.argsort(poly, kind = 'mergesort')
+    sortedPoly = poly[order]
+    popPct = np.zeros((len(countFields), len(percentiles), len(anc)))
+    chunk = max(1, chunk_cells // max(replicates, 1))
+    start = 0
+    while start < len(anc):
+        stop = min(start + chunk, len(anc))
+        stop = np.searchsorted(sortedPoly, sortedPoly[stop - 1], 
+                               side = 'right')
+        units = order[start:stop]
+        unitPoly = sortedPoly[start:stop] - sortedPoly[start]
+        for i in range(len(countFields)):
+            popEst = area[units][:, None] * catDens[i][anc[units]]
+            newPop = _redistribute(popEst, unitPoly, area[units], 
+                                   popCount[units, i:i + 1], 
+                                   int(unitPoly[-1]) + 1)[1]
+            popPct[i][:, units] = np.percentile(np.nan_to_num(newPop), 
+                                                percentiles, axis = 1)
+        start = stop
+    
+    unitColumns = [("Value", dasy_df['Value'].values)]
+    classColumns = [("METHOD", method.values)]
+    with warnings.catch_warnings():
+        #Classes without an IAW estimate in any replicate are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i, field in enumerate(countFields):
+            fieldDens = np.empty((len(cats), replicates))
+            fieldDens[inCats] = catDens[i][cats[inCats]]
+            fieldDens[~inCats] = classDens_df.loc[
+                    method.index[~inCats], 
+                    classDensColumns[i]].astype(float).values[:, None]
+            classColumns += [
+                    (classDensColumns[i], 
+                     classDens_df.loc[method.index, 
+                                      classDensColumns[i]].values),
+                    (_field_column("CLASSDENS_MEAN", field, popCountField), 
+                     np.nanmean(fieldDens, axis = 1)),
+                    (_field_column("CLASSDENS_SD", field, popCountField),
+                     np.nanstd(fieldDens, axis = 1, 
+                               ddof = 1 if replicates > 1 else 0))]
+            classPct = np.nanpercentile(fieldDens, percentiles, axis = 1)
+            for name, values in zip(names, classPct):
+                classColumns.append((_field_column(
+                        "CLASSDENS_" + name, field, popCountField), values))
+            for name, values in zip(names, popPct[i]):
+                unitColumns.append((_field_column(
+                        "NEW_POP_" + name, field, popCountField), values))
+            for name, values in zip(names, popPct[i]):
+                unitColumns.append((_field_column(
+                        "NEWDENSITY_" + name, field, popCountField), 
+                        values / area))
+    bootClass_df = pd.DataFrame(
+            dict((column, np.asarray(values)) 
+                 for column, values in classColumns),
+            index = pd.Index(cats, name = "REP_CAT"), 
+            columns = [column for column, values in classColumns])
+    bootDasy_df = pd.DataFrame(
+            dict(unitColumns), 
+            columns = [column for column, values in unitColumns])
+    return bootClass_df, bootDasy_df
+
+#IDM table stage
+def dasy_tables(dasy_df, pop_df, popCounts, popCountField, presetData,
+                popAreaMin = 1, sampleMin = 3, percent = 0.95):
     '''
+    Run the table stage of intelligent dasymetric mapping on the dasymetric
+    and population DataFrames. -popCounts: A Series named popCountField with \
+    the population count of each source polygon, indexed by the population \
+    key field. -presetData: The preset class densities as in config.json. \
+    -popAreaMin, -sampleMin, -percent: As for dasy_map. Returns the \
+    dasymetric DataFrame (DasyWorkTable), the population DataFrame \
+    (PopTable) and the sampling summary DataFrame (SamplingSummaryTable).
+    '''
+    dasy_df, pop_df = _prepare_tables(dasy_df, pop_df, popCounts,
+                                      popCountField, presetData)
+    return _class_densities(dasy_df, pop_df, popCountField, presetData,
+                            popAreaMin, sampleMin, percent)
 
+#IDM on in-memory arrays
+def dasy_arrays(anc_arr, poly_arr, popCounts, presetData, popAreaMin = 1, 
+                sampleMin = 3, percent = 0.95, polyKeys = None, 
+                uninhab_arr = None, anc_nd = 0, nodata = -999):
     '''
-    if the sum of population densities within the source unit is equal to 0
-    set the POP_EST for those to 1 (i.e., area weighting (equation 5))
+    Run intelligent dasymetric mapping on arrays that are already in memory, 
+    without reading or writing any files. -anc_arr: An array of ancillary \
+    classes (positive whole numbers). -poly_arr: An array of the same shape \
+    with the polygon index of each pixel, from 1 to N, and 0 outside of the \
+    source polygons. -popCounts: The population counts of the N polygons; \
+    popCounts[i] is the count of polygon index i + 1. -presetData: A dict of \
+    preset class densities, e.g. {"11": 0.0}. -popAreaMin, -sampleMin, \
+    -percent: As for dasy_map. -polyKeys: The N population keys of the \
+    polygon indices used in the tables (default = 1 to N). -uninhab_arr: An \
+    optional boolean array of the same shape that is True in uninhabited \
+    areas, which are given the ancillary class anc_nd. -nodata: The NoData \
+    value of the density array (default = -999). Returns the float32 \
+    population density array, the dasymetric DataFrame, the population \
+    DataFrame and the sampling summary DataFrame.
     '''
+    anc_arr = np.asarray(anc_arr)
+    poly_arr = np.asarray(poly_arr)
+    popCounts = np.asarray(popCounts)
+    if anc_arr.shape != poly_arr.shape:
+        raise ValueError("The ancillary and polygon index arrays must have "
+                         "the same shape")
+    if polyKeys is None:
+        polyKeys = np.arange(1, popCounts.size + 1)
+    polyKeys = np.asarray(polyKeys)
+    if polyKeys.size != popCounts.size:
+        raise ValueError("There must be one population key for each "
+                         "population count")
+    if poly_arr.size and (poly_arr.min() < 0 or 
+                          poly_arr.max() > popCounts.size):
+        raise ValueError("Polygon indices must be from 0 to the number of "
+                         "population counts")
+    if anc_arr.size and anc_arr.min() < 0:
+        raise ValueError("Ancillary classes must be positive whole numbers, "
+                         "found " + str(anc_arr.min()))
+    if uninhab_arr is not None:
+        anc_arr = np.where(uninhab_arr, anc_nd, anc_arr)
+    nClasses = max(int(anc_arr.max()) + 1 if anc_arr.size else 1, 
+                   int(anc_nd) + 1)
 
-    idx = (dasy_df
-            .groupby(popIDField)
-            .filter(
-                lambda s: s['POP_EST'].sum() == 0 and
-                          s['POP_COUNT'].sum() > 0
-                    ).index
-            )
+    #Count the pixels of each dasymetric unit and make the tables
+    unitCodes, unitCounts = zonal_crosstab(poly_arr, anc_arr, nClasses)
+    dasy_df, pop_df = _unit_tables(unitCodes, unitCounts, nClasses, polyKeys)
+    popCountField = "POP"
+    dasy_df, pop_df, classDens_df = dasy_tables(
+            dasy_df, pop_df, pd.Series(popCounts, index = polyKeys, 
+                                       name = popCountField), 
+            popCountField, presetData, popAreaMin, sampleMin, percent)
+
+    #Population density of each pixel
+    lut = density_lut(dasy_df['Value'], dasy_df['NEWDENSITY'], nodata)
+    unit_dtype = np.uint32 if (popCounts.size + 1) * nClasses <= 2**32 \
+        else np.uint64
+    dens_arr = lookup_density(lut, _unit_codes(poly_arr, anc_arr, nClasses, 
+                                               unit_dtype), nodata)
+    return dens_arr, dasy_df, pop_df, classDens_df
+
+#Population raster, dasymetric raster and unit counts from the cache or new
+def _cached_units(popFeat_path, popKeyField, ancRaster_path, out_dir,
+                  uninhab_path = False, anc_nd = 0, pop_nd = 0,
+                  tile_size = 2048, workers = 1, popFilter = None,
+                  cache_dir = None, cache_size = 20, dasyRaster = None,
+                  uninhab_raster = False, extent_pad = 0, pop_raster = True,
+                  profile = 'lzw', popBounds = None, kernel = 'auto',
+                  threads = 0, queue_depth = None):
+    '''
+    Return the units of _dasymetric_units, reusing them from cache_dir when
+    the inputs have not changed since an earlier run and caching new units.
+    The cache is not used when the dasymetric raster is written to dasyRaster
+    instead of out_dir.
+    '''
+    unitKey = None
+    units = None
+    if dasyRaster is not None:
+        cache_dir = None
+    if cache_dir:
+        unitKey = _cache_key(popFeat_path, popKeyField, ancRaster_path, 
+                             uninhab_path, anc_nd, pop_nd, popFilter, 
+                             uninhab_raster, extent_pad, pop_raster, 
+                             profile, popBounds)
+        units = _cache_fetch(cache_dir, unitKey, out_dir)
+        if units is not None:
+            _stage("cache_fetch", "Reusing population raster and dasymetric "
+                   "units from the cache...")
+    if units is None:
+        units = _dasymetric_units(popFeat_path, popKeyField, ancRaster_path, 
+                                  out_dir, uninhab_path, anc_nd, pop_nd, 
+                                  tile_size, workers, popFilter, dasyRaster,
+                                  uninhab_raster, extent_pad, pop_raster,
+                                  profile, popBounds, kernel, threads, 
+                                  queue_depth)
+        if cache_dir:
+            _cache_store(cache_dir, unitKey, out_dir, units, cache_size)
+    return units
 
-    dasy_df.loc[idx, 'POP_EST'] = 1
+#IDM function
+def dasy_map (popFeat_path, popCountField, popKeyField, ancRaster_path, 
+              out_dir,  popAreaMin = 1, sampleMin = 3, percent = 0.95, 
+              uninhab_path = False, anc_nd = 0, pop_nd = 0, tile_size = 2048,
+              workers = 1, popFilter = None, cache_dir = None, cache_size = 20,
+              presets = None, intermediates = True, uninhab_raster = False,
+              extent_pad = 0, pop_raster = True, profile = 'lzw',
+              table_format = 'csv', report = True, cprofile = False,
+              field_rasters = False, popBounds = None, bootstrap = 0,
+              percentiles = (5, 50, 95), bootstrap_seed = None, 
+              kernel = 'auto', threads = 0, queue_depth = None,
+              zones = None, checkpoint = None, resume = False):
+    '''
+    Prepare population density rasters given population and ancillary data 
+    through intelligent dasymetric mapping. -popFeat_path: The path to the \
+    census polygons with unique identifiers and a count of the population for \
+    each polygon. - popCountField: The field in the population_features that \
+    stores the polygon's populations, or a list of count fields (e.g. age \
+    groups or housing units) that are all disaggregated in one run. The \
+    rasters and the dasymetric units are made once; the tables get a column \
+    per field (e.g. NEWDENSITY_POP10) and DensityRaster.tif a band per \
+    field. - popKeyField: The unique identifier \
+    field for each polygon in population_features. -ancRaster_path: The path \
+    to the land cover raster that is used for dasymetric population mapping. \
+    -out_dir: The directory where all outputs will be saved. \
+    -popAreaMin: The minimum number of raster cells in a source polygon for \
+    it to be considered representative of a class (default = 1). -sampleMin: \
+    The minimum number of source units to ensure a representative sample for \
+    a land cover class (default = 3). -percent: The minimum percent of a \
+    source polygon's area that an ancillary class must cover in order for the \
+    source polygon to be considered representative of that class. Enter as a \
+    decimal (default = 0.95). -uninhab_path: An optional shapefile containing \
+    uninhabited areas. -anc_nd: The NoData value for the ancillary raster \
+    (default = 0). -pop_nd: The NoData value of the population key field; \
+    source polygons with this key are left out of the population raster \
+    (default = 0). -tile_size: The approximate width and height in \
+    pixels of the windows used to stream through the rasters. Peak memory \
+    depends on this value rather than on the size of the rasters \
+    (default = 2048). -workers: The number of processes that rasterize, \
+    count and render the windows in parallel; 0 uses all CPUs (default = 1). \
+    -popFilter: An optional attribute filter (an OGR SQL WHERE clause) that \
+    selects the population features of a region from a larger layer. \
+    -cache_dir: An optional directory where the population raster, the \
+    dasymetric raster and the unit counts are cached, so that runs with the \
+    same inputs and only different sampling parameters or presets skip \
+    rasterization and counting. -cache_size: The maximum size of the cache \
+    in GB; the least recently used entries are evicted (default = 20). \
+    -presets: The preset class densities as a dict (e.g. {"11": 0.0}) or the \
+    path to a JSON file; by default the config.json file next to this script \
+    is used. -intermediates: Write PopRaster.tif and DasyRaster.tif to \
+    out_dir. When False, the population raster is not made and the \
+    dasymetric raster is only kept in memory (/vsimem/) until the density \
+    raster has been rendered; the cache is not used (default = True). \
+    -uninhab_raster: Write uninhab_landcover.tif, the ancillary raster with \
+    the uninhabited areas set to anc_nd, to out_dir for checking the \
+    uninhabited areas (default = False). -extent_pad: The number of pixels \
+    added around the footprint of the population features. Only this window \
+    of the ancillary raster is processed and all output rasters cover it; \
+    None processes and writes the full extent of the ancillary raster \
+    (default = 0). -pop_raster: Write PopRaster.tif; DasyRaster.tif is still \
+    written so that the density raster can be re-rendered (default = True). \
+    -profile: The output profile of the rasters. "lzw" writes striped \
+    LZW-compressed rasters; "cog" writes tiled rasters compressed with \
+    ZSTD or DEFLATE and a predictor on all CPUs, and DensityRaster.tif as a \
+    cloud optimized GeoTIFF with internal overviews (default = "lzw"). \
+    -table_format: The format of DasyWorkTable, PopTable and \
+    SamplingSummaryTable: "csv", or "parquet" or "feather" with typed \
+    columns (requires pyarrow) (default = "csv"). -report: Write \
+    RunReport.json to out_dir with the wall time, CPU time, peak memory and \
+    bytes read and written of each stage of the run (default = True). \
+    -cprofile: Profile the run with cProfile and write the statistics to \
+    RunProfile.prof in out_dir, e.g. for snakeviz or pstats \
+    (default = False). -field_rasters: With a list of count fields, write \
+    a single band DensityRaster_<field>.tif for each field instead of one \
+    multi-band DensityRaster.tif (default = False). -popBounds: An optional \
+    area of interest (minx, miny, maxx, maxy) in the coordinates of the \
+    population features; only the features that intersect it are used. \
+    -bootstrap: The number of bootstrap replicates of the class densities; \
+    the representative units of each sampled class are resampled in every \
+    replicate. With replicates, BootstrapClassTable and BootstrapWorkTable \
+    give the percentiles of the class densities and of the population of \
+    each dasymetric unit, and a DensityRaster_P<percentile>.tif is written \
+    for each percentile (default = 0, no replicates). -percentiles: The \
+    percentiles of the replicates (default = 5, 50, 95). -bootstrap_seed: \
+    The seed of the replicates, for reproducible runs (default = None). \
+    -kernel: The pixel kernel that counts the dasymetric units and looks up \
+    the densities: "numpy", "numba" for fused loops compiled with Numba, or \
+    "auto" for numba when it is installed (default = "auto"). -threads: \
+    With one worker, the number of threads that read and process the \
+    windows while the main thread compresses and writes the output \
+    rasters, so that reading, computing and writing overlap; 0 runs the \
+    windows one after another (default = 0). -queue_depth: The number of \
+    windows read and processed ahead of the window being written, which \
+    bounds the memory of the pipeline (default = twice the number of \
+    workers or threads). -zones: Target zone layers (e.g. watersheds or \
+    service areas) to re-total the population into while the density \
+    raster is rendered, as a list of paths or (path, key field) pairs; \
+    zones without a key field are keyed by their FID. A \
+    ZoneTable_<layer name> with the pixel count and the population of \
+    each zone is written for each layer (default = None). -checkpoint: \
+    Save checkpoints of the run in the Checkpoint directory of out_dir: the \
+    results of each stage and, every checkpoint seconds, the windows \
+    written by the window passes. They are removed when the run succeeds \
+    (default = None, no checkpoints). -resume: Resume a failed run with \
+    the same inputs and parameters from its checkpoints; workers, threads \
+    and the other options that do not change the outputs may differ. \
+    Implies checkpoints every 60 seconds unless checkpoint is given \
+    (default = False).
+    '''
+    arguments = dict(locals())
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError("The output profile must be one of " + 
+                         ", ".join(OUTPUT_PROFILES))
+    _check_table_format(table_format)
+    kernel = _check_kernel(kernel)
+    if resume and checkpoint is None:
+        checkpoint = 60
+    if checkpoint is not None and not intermediates:
+        raise ValueError("Checkpoints need the intermediate rasters; the "
+                         "dasymetric raster is only kept in memory without "
+                         "them")
+    #Preset class densities, from config.json file by default
+    presetData = _preset_data(presets)
     
-    #Sum population estimates by polygon.
-    popEstsum = dasy_df.groupby(popIDField)["POP_EST"].sum()
+    logger.info('population_features path: {0}'.format(popFeat_path))
+    logger.info('population_count_field: {0}'.format(popCountField))
+    logger.info('population_key_field: {0}'.format(popKeyField))
+    logger.info('ancillary_raster: {0}'.format(ancRaster_path))
+    logger.info('uninhabited_file: {0}'.format(uninhab_path))
+    logger.info('The minimum populated area of a representative unit is ' + 
+                str(popAreaMin))
+    logger.info('The minimum sample size is ' + str(sampleMin))
+    logger.info('The percent is ' + str(percent))
+    logger.info('The NoData value for the population raster is ' + 
+                str(pop_nd))
+    logger.info('The NoData value for the ancillary raster is ' + 
+                str(anc_nd))
+
+    '''
+    Record the stages of the run for RunReport.json and, if requested, 
+    profile the run. The report is also written when the run fails.
+    '''
+    runReport = _RunReport(arguments) if report else None
+    profiler = None
+    if cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    error = None
+    runCheckpoint = None
+    try:
+        _stage("setup")
+        if checkpoint is not None:
+            runCheckpoint = _Checkpoint(out_dir, _checkpoint_key(
+                    arguments, presetData), resume, checkpoint)
+        #Set file names for outputs, the table extensions are added on export
+        popWorkTable = os.path.join(out_dir, "PopTable")
+        dasyRaster = os.path.join(out_dir, "DasyRaster.tif")
+        if not intermediates:
+            dasyRaster = "/vsimem/{0}/DasyRaster.tif".format(
+                    uuid.uuid4().hex)
+        dasyWorkTable = os.path.join(out_dir, "DasyWorkTable")
+        densityRaster = os.path.join(out_dir, "DensityRaster.tif")
+        countFields = _count_fields(popCountField)
+        if field_rasters and not isinstance(popCountField, str):
+            densityRaster = [os.path.join(
+                    out_dir, "DensityRaster_{0}.tif".format(field))
+                             for field in countFields]
     
-    dasy_df["TOTALFRACT"] = dasy_df["POP_EST"] / dasy_df.join(popEstsum, 
-           on = popIDField, rsuffix = "SUM")["POP_ESTSUM"]
-    dasy_df["NEW_POP"] = dasy_df["TOTALFRACT"] * dasy_df["POP_COUNT"]
-    dasy_df["NEWDENSITY"] = dasy_df["NEW_POP"] / dasy_df[dasyAreaField]
+        """
+        Create the population raster and the dasymetric raster and count the 
+        pixels of each dasymetric unit, or reuse them from the cache when 
+        the inputs have not changed since an earlier run. A resumed run 
+        skips the stages saved by its checkpoint.
+        """
+        if runCheckpoint is not None and runCheckpoint.done("tables"):
+            dasy_df, pop_df, classDens_df = runCheckpoint.load("tables")
+        else:
+            if runCheckpoint is not None and runCheckpoint.done("units"):
+                units = runCheckpoint.load("units")
+            else:
+                units = _cached_units(
+                        popFeat_path, popKeyField, ancRaster_path, out_dir, 
+                        uninhab_path, anc_nd, pop_nd, tile_size, workers, 
+                        popFilter, cache_dir, cache_size, 
+                        None if intermediates else dasyRaster, 
+                        uninhab_raster, extent_pad, pop_raster, profile, 
+                        popBounds, kernel, threads, queue_depth)
+                if runCheckpoint is not None:
+                    runCheckpoint.save("units", units)
+            unitCodes, unitCounts, polyKeys, nClasses = units
+
+            """
+            Make the population DataFrame and the dasymetric DataFrame from 
+            the merged counts of the dasymetric units.
+            """
+            _stage("unit_tables")
+            dasy_df, pop_df = _unit_tables(unitCodes, unitCounts, nClasses, 
+                                           polyKeys)
+
+            #Read the population count of each source polygon.
+            _stage("read_counts", "Reading population counts...")
+            popCounts = _read_pop_counts(popFeat_path, popKeyField, 
+                                         popCountField, popFilter, popBounds)
     
-    #Replace nan with 0
-    dasy_df = dasy_df.fillna(0)
+            dasy_df, pop_df, classDens_df = dasy_tables(
+                    dasy_df, pop_df, popCounts, popCountField, presetData, 
+                    popAreaMin, sampleMin, percent)
     
-    #export dasy table to .csv
-    dasy_df.to_csv(dasyWorkTable, header = True)
+            #export dasy table, with its row numbers in CSV only
+            _stage("write_tables", "Writing the output tables...")
+            _write_table(dasy_df, dasyWorkTable, table_format, index = False)
                
-    #export pop_df to .csv
-    pop_df.fillna(0).to_csv(popWorkTable, header = True)
+            '''
+            export pop_df, its index is the "Value" column and is written in 
+            CSV only. POLY_IDX maps the values of PopRaster.tif back to the 
+            population key field.
+            '''
+            _write_table(pop_df.fillna(0), popWorkTable, table_format, 
+                         index = False)
             
-    #export classDens_df to sampling summary table
-    classDens_df.to_csv(os.path.join(out_dir, "SamplingSummaryTable.csv"), 
-                        header = True)
-    
-    #Create final population density raster.
-    print ("Creating population density raster...")
-    #Create population density array.
-    dasy_lut = dasy_df[['Value', 'NEWDENSITY']].set_index('Value')
-    dasy_lut.loc[dasy_nd, 'NEWDENSITY'] = -999 #NoData value from comb_arr
-    dens_df = pd.DataFrame(np.ravel(comb_arr)).join(dasy_lut, on = 0)
-    dens_ar = np.array(
-            dens_df['NEWDENSITY']
-            ).reshape(
-                    (comb_arr.shape[0], comb_arr.shape[1])
-                    )
-    
-    #Write array to population density raster.
-    densRast = rast_driver.Create(densityRaster, cols, rows, 1, 
-                                  gdal.GDT_Float32, options=['COMPRESS=LZW'])
-    densRast.SetGeoTransform((ulx, ancRaster.GetGeoTransform()[1], 0, 
-                              uly, 0, ancRaster.GetGeoTransform()[5]))
-    densRast.SetProjection(anc_proj)
-    densRast_b1 =densRast.GetRasterBand(1)
-    densRast_b1.WriteArray(dens_ar)
-    densRast_b1.SetNoDataValue(-999)
-    densRast = None
-    
-    print ("All outputs from this tool can be found in " + out_dir)
+            #export classDens_df to sampling summary table, indexed by REP_CAT
+            _write_table(classDens_df, 
+                         os.path.join(out_dir, "SamplingSummaryTable"), 
+                         table_format)
+            if runCheckpoint is not None:
+                runCheckpoint.save("tables", (dasy_df, pop_df, classDens_df))
+        
+        #Percentiles of the class densities and unit populations
+        bandFields = []
+        if bootstrap and runCheckpoint is not None and \
+                runCheckpoint.done("bootstrap"):
+            bootDasy_df = runCheckpoint.load("bootstrap")
+        elif bootstrap:
+            _stage("bootstrap", "Computing {0} bootstrap replicates...".format(
+                    bootstrap))
+            bootClass_df, bootDasy_df = dasy_bootstrap(
+                    dasy_df, pop_df, classDens_df, popCountField, presetData,
+                    bootstrap, percentiles, bootstrap_seed)
+            _write_table(bootClass_df, 
+                         os.path.join(out_dir, "BootstrapClassTable"), 
+                         table_format)
+            _write_table(bootDasy_df, 
+                         os.path.join(out_dir, "BootstrapWorkTable"), 
+                         table_format, index = False)
+            if runCheckpoint is not None:
+                runCheckpoint.save("bootstrap", bootDasy_df)
+        if bootstrap:
+            bandFields = [column for column in bootDasy_df.columns 
+                          if column.startswith("NEWDENSITY_")]
+    
+        #Create final population density raster.
+        try:
+            if runCheckpoint is None or not runCheckpoint.done("density"):
+                _stage("density_write", 
+                       "Creating population density raster...")
+                zoneTables = render_density(
+                        dasyRaster, dasy_df, densityRaster, tile_size,
+                        workers = workers, profile = profile, 
+                        fields = [_field_column("NEWDENSITY", field, 
+                                                popCountField)
+                                  for field in countFields],
+                        kernel = kernel, threads = threads, 
+                        queue_depth = queue_depth, zones = zones or ())
+                if zoneTables:
+                    _stage("zone_tables", "Writing the target zone tables...")
+                    zoneNames = []
+                    for zone, zone_df in zip(zones, zoneTables):
+                        zonePath = zone if isinstance(zone, str) else zone[0]
+                        zoneName = os.path.splitext(
+                                os.path.basename(zonePath.rstrip('/\\')))[0]
+                        if zoneName in zoneNames:
+                            zoneName += "_" + str(len(zoneNames) + 1)
+                        zoneNames.append(zoneName)
+                        _write_table(zone_df, 
+                                     os.path.join(out_dir, 
+                                                  "ZoneTable_" + zoneName), 
+                                     table_format, index = False)
+                if runCheckpoint is not None:
+                    runCheckpoint.save("density")
+            if bandFields:
+                _stage("bootstrap_write", 
+                       "Creating percentile population density rasters...")
+                render_density(dasyRaster, bootDasy_df, 
+                               [os.path.join(out_dir, "DensityRaster" + 
+                                             column[len("NEWDENSITY"):] + 
+                                             ".tif") 
+                                for column in bandFields],
+                               tile_size, workers = workers, 
+                               profile = profile, fields = bandFields,
+                               kernel = kernel, threads = threads, 
+                               queue_depth = queue_depth)
+        finally:
+            if not intermediates:
+                gdal.Unlink(dasyRaster)
+    except BaseException as e:
+        error = "{0}: {1}".format(type(e).__name__, e)
+        raise
+    finally:
+        if runCheckpoint is not None:
+            runCheckpoint.close(error is None)
+        if profiler is not None:
+            profiler.disable()
+            if os.path.isdir(out_dir):
+                profiler.dump_stats(os.path.join(out_dir, "RunProfile.prof"))
+        if runReport is not None:
+            runReport.close(os.path.join(out_dir, "RunReport.json") 
+                            if os.path.isdir(out_dir) else None, error)
+
+    logger.info("All outputs from this tool can be found in " + out_dir)
 
 #------------------------------------------------------------------------------
 #Get arguments to run dasy_pop from command line
@@ -571,7 +3296,8 @@ if __name__ == '__main__':
                         and a count of the population for each polygon')
     parser.add_argument('population_count_field', type = str, 
                         help = "The field in the population_features that \
-                        stores the polygon's populations")
+                        stores the polygon's populations, or several count \
+                        fields separated by commas, e.g. POP10,HU10")
     parser.add_argument('population_key_field', type = str, 
                         help = "The unique identifier field for each polygon \
                         in population_features")
@@ -584,6 +3310,10 @@ if __name__ == '__main__':
     parser.add_argument('--uninhabited_file', type = str, nargs='?', 
                         help = "An optional feature class containing \
                         uninhabited areas")
+    parser.add_argument('--uninhabited_raster', action = 'store_true',
+                        help = "Write uninhab_landcover.tif, the ancillary \
+                        raster with the uninhabited areas set to the \
+                        ancillary NoData value")
     parser.add_argument('--minimum_sampling_area', type = int, 
                         nargs='?',default = 1, 
                         help = "The minimum number of raster cells in a \
@@ -600,20 +3330,139 @@ if __name__ == '__main__':
                         that class. Please enter as a decimal \
                         - default = 0.95")
     parser.add_argument('--pop_nodata', type = int, nargs='?', default = 0, 
-                        help = "The population_features will be converted to \
-                        raster and this will be the NoData value \
-                        - default = 0")
+                        help = "The NoData value of the population key \
+                        field. Source polygons with this key are left out of \
+                        the population raster - default = 0")
     parser.add_argument('--anc_nodata', type = int, nargs='?', default = 0, 
                         help = "The NoData value for the ancillary raster \
-                        - default = 0")   
+                        - default = 0")
+    parser.add_argument('--tile_size', type = int, nargs='?', default = 2048,
+                        help = "The approximate width and height in pixels \
+                        of the windows used to stream through the rasters. \
+                        Peak memory depends on this value rather than on the \
+                        size of the rasters - default = 2048")
+    parser.add_argument('--extent_padding', type = int, nargs='?', default = 0,
+                        help = "The number of pixels added around the \
+                        footprint of the population features. Only this \
+                        window of the ancillary raster is processed and \
+                        written - default = 0")
+    parser.add_argument('--full_extent', action = 'store_true',
+                        help = "Process and write the full extent of the \
+                        ancillary raster instead of the footprint of the \
+                        population features")
+    parser.add_argument('--population_filter', type = str, nargs='?',
+                        help = "An optional attribute filter (an OGR SQL \
+                        WHERE clause) that selects the population features \
+                        to use, e.g. \"STATEFP10 = '10'\"")
+    parser.add_argument('--population_bounds', type = float, nargs = 4,
+                        metavar = ('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help = "An optional area of interest in the \
+                        coordinates of the population features. Only the \
+                        features that intersect it are used")
+    parser.add_argument('--cache_dir', type = str, nargs='?',
+                        help = "An optional directory where the population \
+                        raster, the dasymetric raster and the unit counts \
+                        are cached between runs, e.g. ~/.cache/idm. Nothing \
+                        is cached without it")
+    parser.add_argument('--cache_size', type = float, nargs='?', default = 20,
+                        help = "The maximum size of the cache in GB. The least \
+                        recently used entries are evicted - default = 20")
+    parser.add_argument('--workers', type = int, nargs='?', default = 1,
+                        help = "The number of processes that rasterize, count \
+                        and render the windows in parallel. 0 uses all CPUs \
+                        - default = 1")
+    parser.add_argument('--presets', type = str, nargs='?',
+                        help = "A JSON file of preset class densities \
+                        - default = config.json next to this script")
+    parser.add_argument('--output_profile', type = str, nargs='?', 
+                        default = 'lzw', choices = OUTPUT_PROFILES,
+                        help = "lzw: striped LZW-compressed rasters. cog: \
+                        tiled rasters compressed with ZSTD or DEFLATE and a \
+                        predictor on all CPUs, with DensityRaster.tif as a \
+                        cloud optimized GeoTIFF with overviews \
+                        - default = lzw")
+    parser.add_argument('--no_pop_raster', action = 'store_true',
+                        help = "Do not write PopRaster.tif")
+    parser.add_argument('--table_format', type = str, nargs='?', 
+                        default = 'csv', choices = sorted(TABLE_FORMATS),
+                        help = "The format of the output tables. parquet and \
+                        feather tables have typed columns and need pyarrow \
+                        - default = csv")
+    parser.add_argument('--no_intermediates', action = 'store_true',
+                        help = "Do not write PopRaster.tif and DasyRaster.tif; \
+                        the dasymetric raster is only kept in memory")
+    parser.add_argument('--field_rasters', action = 'store_true',
+                        help = "With several count fields, write a density \
+                        raster for each field instead of one multi-band \
+                        DensityRaster.tif")
+    parser.add_argument('--bootstrap', type = int, nargs='?', default = 0,
+                        help = "The number of bootstrap replicates of the \
+                        class densities. Writes the percentiles of the \
+                        class densities and unit populations and a \
+                        population density raster for each percentile \
+                        - default = 0")
+    parser.add_argument('--percentiles', type = float, nargs='+', 
+                        default = [5, 50, 95],
+                        help = "The percentiles of the bootstrap replicates \
+                        - default = 5 50 95")
+    parser.add_argument('--bootstrap_seed', type = int, nargs='?',
+                        help = "The seed of the bootstrap replicates")
+    parser.add_argument('--kernel', type = str, nargs='?', default = 'auto',
+                        choices = KERNELS,
+                        help = "The pixel kernel: numpy, numba, or auto for \
+                        numba when it is installed - default = auto")
+    parser.add_argument('--threads', type = int, nargs='?', default = 0,
+                        help = "With one worker, the number of threads that \
+                        read and process the windows while the outputs are \
+                        written. 0 runs the windows one after another \
+                        - default = 0")
+    parser.add_argument('--queue_depth', type = int, nargs='?',
+                        help = "The number of windows read and processed \
+                        ahead of the window being written - default = twice \
+                        the number of workers or threads")
+    parser.add_argument('--target_zones', type = str, nargs='+',
+                        action = 'append', metavar = 'PATH [KEY_FIELD]',
+                        help = "A target zone layer and optionally its key \
+                        field (default = the FID). The population is summed \
+                        into its zones while the density raster is \
+                        rendered and written to ZoneTable_<layer name>. \
+                        Repeat for several layers")
+    parser.add_argument('--checkpoint', type = float, nargs='?', const = 60,
+                        metavar = 'SECONDS',
+                        help = "Save checkpoints of the run in the Checkpoint \
+                        directory of the output directory, with the windows \
+                        written so far every SECONDS seconds \
+                        - default = 60 seconds when given")
+    parser.add_argument('--resume', action = 'store_true',
+                        help = "Resume a failed run with the same inputs and \
+                        parameters from its checkpoints")
+    parser.add_argument('--no_report', action = 'store_true',
+                        help = "Do not write RunReport.json, the timings, \
+                        memory and I/O of the stages of the run")
+    parser.add_argument('--cprofile', action = 'store_true',
+                        help = "Profile the run with cProfile and write the \
+                        statistics to RunProfile.prof")
+    parser.add_argument('--log_level', type = str, nargs='?', default = 'INFO',
+                        choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help = "The level of the progress messages \
+                        - default = INFO")
 
     #get args
     args = parser.parse_args()
+    logging.basicConfig(level = args.log_level, format = "%(message)s")
+    for zone in args.target_zones or []:
+        if len(zone) > 2:
+            parser.error("--target_zones takes a path and an optional key "
+                         "field")
+        
+    #Several count fields are separated by commas
+    countFields = args.population_count_field.split(',')
         
     #run function
     dasy_map(
             popFeat_path = args.population_features, 
-            popCountField = args.population_count_field, 
+            popCountField = countFields[0] if len(countFields) == 1 \
+                else countFields, 
             popKeyField = args.population_key_field, 
             ancRaster_path = args.ancillary_raster, 
             popAreaMin = args.minimum_sampling_area, 
@@ -621,6 +3470,32 @@ if __name__ == '__main__':
             percent = args.percent, 
             uninhab_path = args.uninhabited_file,
             out_dir = args.output_directory,
-            anc_nd = args.pop_nodata,
-            pop_nd = args.anc_nodata
+            anc_nd = args.anc_nodata,
+            pop_nd = args.pop_nodata,
+            tile_size = args.tile_size,
+            workers = args.workers,
+            popFilter = args.population_filter,
+            popBounds = args.population_bounds,
+            cache_dir = args.cache_dir,
+            cache_size = args.cache_size,
+            presets = args.presets,
+            intermediates = not args.no_intermediates,
+            uninhab_raster = args.uninhabited_raster,
+            extent_pad = None if args.full_extent else args.extent_padding,
+            pop_raster = not args.no_pop_raster,
+            profile = args.output_profile,
+            table_format = args.table_format,
+            report = not args.no_report,
+            cprofile = args.cprofile,
+            field_rasters = args.field_rasters,
+            bootstrap = args.bootstrap,
+            percentiles = args.percentiles,
+            bootstrap_seed = args.bootstrap_seed,
+            kernel = args.kernel,
+            threads = args.threads,
+            queue_depth = args.queue_depth,
+            zones = [zone[0] if len(zone) == 1 else tuple(zone) 
+                     for zone in args.target_zones or []],
+            checkpoint = args.checkpoint,
+            resume = args.resume
             )
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Batch driver for the open source Intelligent Dasymetric Mapping script
+
+Description: Runs dasy_map from idm.py for many regions (e.g., every state or
+county) against the same ancillary raster. Regions are listed in a CSV
+manifest and scheduled over a pool of worker processes. Each worker keeps the
+ancillary raster and the preset class densities open between the regions it
+runs, writes the outputs of each region to its own directory as soon as the
+region is done and reports its timing. A summary of the timings and failures
+of all regions is written to BatchSummary.csv.
+
+Manifest columns:
+    region - A unique name for the region (required).
+    population_features - The population features of the region. Defaults to
+        the population_features argument.
+    where - An optional OGR SQL WHERE clause that selects the population
+        features of the region, e.g. COUNTYFP10 = '001'.
+    output_directory - Defaults to <output_directory>/<region>.
+"""
+
+import os, time, traceback, logging
+import multiprocessing as mp
+import pandas as pd
+import argparse as ap
+
+import idm
+
+#Progress messages of the batch
+logger = logging.getLogger("idm.batch")
+
+
+#Run dasy_map for a single region
+def _run_region(job):
+    '''
+    Run dasy_map for one region of the manifest and return a summary record
+    with the region, its output directory, status, run time and error.
+    '''
+    record = {"region": job["region"],
+              "output_directory": job["kwargs"]["out_dir"],
+              "status": "Done", "seconds": 0.0, "error": ""}
+    start = time.time()
+    try:
+        if not os.path.isdir(job["kwargs"]["out_dir"]):
+            os.makedirs(job["kwargs"]["out_dir"])
+        idm.dasy_map(**job["kwargs"])
+    except Exception:
+        record["status"] = "Failed"
+        record["error"] = traceback.format_exc().strip().splitlines()[-1]
+    record["seconds"] = round(time.time() - start, 3)
+    return record
+
+#Read the manifest into dasy_map jobs
+def read_manifest(manifest_path, out_root, popFeat_path = None, **kwargs):
+    '''
+    Read a CSV manifest of regions and return one job per region with the
+    keyword arguments for dasy_map. kwargs are the dasy_map arguments shared
+    by all regions.
+    '''
+    manifest = pd.read_csv(manifest_path, dtype = str).fillna("")
+    if "region" not in manifest.columns:
+        raise ValueError("The manifest must have a 'region' column")
+    if manifest["region"].duplicated().any():
+        raise ValueError("Region names in the manifest must be unique")
+
+    jobs = []
+    for row in manifest.to_dict("records"):
+        jobKwargs = dict(kwargs)
+        jobKwargs["popFeat_path"] = row.get("population_features") or \
+            popFeat_path
+        if not jobKwargs["popFeat_path"]:
+            raise ValueError("No population features for region " +
+                             row["region"])
+        jobKwargs["popFilter"] = row.get("where") or None
+        jobKwargs["out_dir"] = row.get("output_directory") or \
+            os.path.join(out_root, row["region"])
+        jobs.append({"region": row["region"], "kwargs": jobKwargs})
+    return jobs
+
+#Batch function
+def dasy_batch(manifest_path, out_root, popCountField, popKeyField,
+               ancRaster_path, popFeat_path = None, workers = 1, 
+               region_workers = 1, **kwargs):
+    '''
+    Run intelligent dasymetric mapping for every region of a manifest.
+    -manifest_path: The CSV manifest of regions. -out_root: The directory \
+    where the outputs of each region and BatchSummary.csv are saved. \
+    -popCountField, -popKeyField, -ancRaster_path: As for dasy_map. \
+    -popFeat_path: The population features used by regions without \
+    population_features in the manifest. -workers: The number of regions run \
+    at the same time; 0 uses all CPUs (default = 1). -region_workers: The \
+    workers of dasy_map for each region (default = 1). The processes of the \
+    batch cannot start worker processes of their own, so it must be 1 when \
+    more than one region is run at the same time. Other keyword arguments \
+    are passed to dasy_map for every region. Returns the summary DataFrame.
+    '''
+    if workers < 1:
+        workers = mp.cpu_count()
+    if workers > 1 and region_workers != 1:
+        raise ValueError("The regions cannot have more than one worker when "
+                         "the batch has more than one worker")
+    jobs = read_manifest(manifest_path, out_root, popFeat_path,
+                         popCountField = popCountField,
+                         popKeyField = popKeyField,
+                         ancRaster_path = ancRaster_path, 
+                         workers = region_workers, **kwargs)
+    if not os.path.isdir(out_root):
+        os.makedirs(out_root)
+    summaryTable = os.path.join(out_root, "BatchSummary.csv")
+    columns = ["region", "output_directory", "status", "seconds", "error"]
+
+    logger.info("Running {0} regions with {1} worker(s)...".format(
+            len(jobs), workers))
+    start = time.time()
+    records = []
+    if workers > 1:
+        pool = mp.Pool(min(workers, max(len(jobs), 1)))
+        results = pool.imap_unordered(_run_region, jobs)
+    else:
+        pool = None
+        results = (_run_region(job) for job in jobs)
+    try:
+        for record in results:
+            records.append(record)
+            logger.info("[{0}/{1}] {2}: {3} in {4} s {5}".format(
+                    len(records), len(jobs), record["region"],
+                    record["status"], record["seconds"], record["error"]))
+            #Keep the summary current so that long batches can be monitored
+            pd.DataFrame(records, columns = columns).to_csv(
+                    summaryTable, index = False)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    summary = pd.DataFrame(records, columns = columns)
+    summary.to_csv(summaryTable, index = False)
+    failed = summary[summary["status"] == "Failed"]
+    logger.info("{0} regions done and {1} failed in {2:.1f} s".format(
+            len(summary) - len(failed), len(failed), time.time() - start))
+    logger.info("The batch summary can be found in " + summaryTable)
+    return summary
+
+#------------------------------------------------------------------------------
+#Get arguments to run dasy_batch from command line
+if __name__ == '__main__':
+    #create ArgumentParser
+    parser = ap.ArgumentParser(description='This script runs intelligent \
+                               dasymetric mapping for every region listed in \
+                               a CSV manifest.')
+
+    #add arguments
+    parser.add_argument('manifest', type = str,
+                        help = "CSV manifest with a 'region' column and \
+                        optional 'population_features', 'where' and \
+                        'output_directory' columns")
+    parser.add_argument('population_count_field', type = str,
+                        help = "The field in the population_features that \
+                        stores the polygon's populations, or several count \
+                        fields separated by commas")
+    parser.add_argument('population_key_field', type = str,
+                        help = "The unique identifier field for each polygon \
+                        in population_features")
+    parser.add_argument('ancillary_raster', type = str,
+                        help = "The land cover raster that is used for \
+                        dasymetric population mapping")
+    parser.add_argument('output_directory', type = str,
+                        help = "The directory where the outputs of each \
+                        region and the batch summary will be saved")
+    parser.add_argument('--population_features', type = str, nargs='?',
+                        help = "The population features used by regions \
+                        without population_features in the manifest")
+    parser.add_argument('--uninhabited_file', type = str, nargs='?',
+                        help = "An optional feature class containing \
+                        uninhabited areas")
+    parser.add_argument('--minimum_sampling_area', type = int, nargs='?',
+                        default = 1)
+    parser.add_argument('--minimum_sample', type = int, nargs='?', default = 3)
+    parser.add_argument('--percent', type = float, nargs='?', default = 0.95)
+    parser.add_argument('--pop_nodata', type = int, nargs='?', default = 0)
+    parser.add_argument('--anc_nodata', type = int, nargs='?', default = 0)
+    parser.add_argument('--tile_size', type = int, nargs='?', default = 2048)
+    parser.add_argument('--extent_padding', type = int, nargs='?', default = 0)
+    parser.add_argument('--full_extent', action = 'store_true')
+    parser.add_argument('--output_profile', type = str, nargs='?',
+                        default = 'lzw', choices = idm.OUTPUT_PROFILES)
+    parser.add_argument('--no_pop_raster', action = 'store_true')
+    parser.add_argument('--no_report', action = 'store_true')
+    parser.add_argument('--field_rasters', action = 'store_true')
+    parser.add_argument('--table_format', type = str, nargs='?',
+                        default = 'csv', choices = sorted(idm.TABLE_FORMATS))
+    parser.add_argument('--cache_dir', type = str, nargs='?')
+    parser.add_argument('--cache_size', type = float, nargs='?', default = 20)
+    parser.add_argument('--presets', type = str, nargs='?',
+                        help = "A JSON file of preset class densities \
+                        - default = config.json next to idm.py")
+    parser.add_argument('--workers', type = int, nargs='?', default = 1,
+                        help = "The number of regions run at the same time. \
+                        0 uses all CPUs - default = 1")
+    parser.add_argument('--region_workers', type = int, nargs='?', 
+                        default = 1,
+                        help = "The number of worker processes of each \
+                        region, as the workers of idm.py. It must be 1 when \
+                        workers is not - default = 1")
+
+    #get args
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+
+    #Several count fields are separated by commas
+    countFields = args.population_count_field.split(',')
+
+    #run function
+    dasy_batch(
+            manifest_path = args.manifest,
+            out_root = args.output_directory,
+            popCountField = countFields[0] if len(countFields) == 1 \
+                else countFields,
+            popKeyField = args.population_key_field,
+            ancRaster_path = args.ancillary_raster,
+            popFeat_path = args.population_features,
+            workers = args.workers,
+            region_workers = args.region_workers,
+            uninhab_path = args.uninhabited_file,
+            popAreaMin = args.minimum_sampling_area,
+            sampleMin = args.minimum_sample,
+            percent = args.percent,
+            pop_nd = args.pop_nodata,
+            anc_nd = args.anc_nodata,
+            tile_size = args.tile_size,
+            extent_pad = None if args.full_extent else args.extent_padding,
+            pop_raster = not args.no_pop_raster,
+            profile = args.output_profile,
+            table_format = args.table_format,
+            report = not args.no_report,
+            field_rasters = args.field_rasters,
+            cache_dir = args.cache_dir,
+            cache_size = args.cache_size,
+            presets = args.presets
+            )
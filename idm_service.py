@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Service mode for the open source Intelligent Dasymetric Mapping script
+
+Description: Runs dasy_map jobs submitted over HTTP, on a port of the local
+host or on a Unix socket, in a pool of long-running worker processes. The
+workers import GDAL, numpy and pandas once and keep the ancillary rasters and
+the preset class densities open between jobs, so that a job only pays for
+the work on its own area of interest. Jobs are run concurrently, one per
+worker. A job is a JSON object with the names of the idm.py command line
+arguments, e.g.
+
+    {"population_features": "./data/2010_blocks_DE.shp",
+     "population_count_field": "POP10",
+     "population_key_field": "polyID",
+     "ancillary_raster": "./data/nlcd_2011_DE.tif",
+     "population_bounds": [1740000, 1990000, 1760000, 2010000],
+     "percent": 0.9,
+     "output_directory": "./output/job1"}
+
+The outputs of a job are written to its output_directory. Without an
+output_directory, only the population density array of the job is kept and
+returned by the service.
+
+Requests:
+    POST /jobs - Submit a job. Returns the id of the job with status 202, or
+        waits for the job and returns its record with ?wait=1.
+    GET /jobs/<id> - The record of a job: its status (Pending, Done or
+        Failed), error, run time in the worker and time since submission.
+        Waits for the job with ?wait=1.
+    GET /jobs/<id>/density - The population density array of a finished job
+        without an output_directory, as a .npy file. The geotransform,
+        projection and NoData value are in the X-IDM-GeoTransform,
+        X-IDM-Projection and X-IDM-NoData headers.
+    GET /health - The number of workers and of pending and finished jobs.
+"""
+
+import os, io, json, time, uuid, shutil, tempfile, threading, traceback
+import logging
+import multiprocessing as mp
+import socketserver
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+from osgeo import gdal
+import numpy as np
+import argparse as ap
+
+import idm
+
+#Progress messages of the service
+logger = logging.getLogger("idm.service")
+
+#Job fields and the dasy_map arguments they set
+JOB_ARGUMENTS = {
+        "population_features": "popFeat_path",
+        "population_count_field": "popCountField",
+        "population_key_field": "popKeyField",
+        "ancillary_raster": "ancRaster_path",
+        "output_directory": "out_dir",
+        "uninhabited_file": "uninhab_path",
+        "uninhabited_raster": "uninhab_raster",
+        "minimum_sampling_area": "popAreaMin",
+        "minimum_sample": "sampleMin",
+        "percent": "percent",
+        "pop_nodata": "pop_nd",
+        "anc_nodata": "anc_nd",
+        "tile_size": "tile_size",
+        "extent_padding": "extent_pad",
+        "population_filter": "popFilter",
+        "population_bounds": "popBounds",
+        "presets": "presets",
+        "output_profile": "profile",
+        "table_format": "table_format",
+        "field_rasters": "field_rasters",
+        "pop_raster": "pop_raster",
+        "intermediates": "intermediates",
+        "report": "report"
+        }
+
+#Job fields without a default
+_REQUIRED = ("population_features", "population_count_field",
+             "population_key_field", "ancillary_raster")
+
+
+#dasy_map arguments of a job
+def job_kwargs(job, defaults = None):
+    '''
+    Return the dasy_map keyword arguments of a job given as a dict of job
+    fields. defaults are dasy_map keyword arguments used by all jobs unless
+    the job sets them. Raises ValueError for unknown or missing fields.
+    '''
+    job = dict(job)
+    fullExtent = job.pop("full_extent", False)
+    unknown = sorted(set(job) - set(JOB_ARGUMENTS))
+    if unknown:
+        raise ValueError("Unknown job fields: " + ", ".join(unknown))
+    kwargs = dict(defaults or {})
+    for field, value in job.items():
+        kwargs[JOB_ARGUMENTS[field]] = value
+    missing = [field for field in _REQUIRED
+               if kwargs.get(JOB_ARGUMENTS[field]) in (None, "")]
+    if missing:
+        raise ValueError("Missing job fields: " + ", ".join(missing))
+    '''
+    Several count fields are given as a list or separated by commas, as on
+    the command line. The service runs the windows of a job in its worker,
+    so jobs are concurrent rather than the windows of a job.
+    '''
+    countFields = kwargs["popCountField"]
+    if isinstance(countFields, str):
+        countFields = countFields.split(',')
+    kwargs["popCountField"] = countFields[0] if len(countFields) == 1 \
+        else list(countFields)
+    if fullExtent:
+        kwargs["extent_pad"] = None
+    kwargs["workers"] = 1
+    return kwargs
+
+#Open the ancillary rasters and presets of a worker
+def _init_service(ancRasters, presets):
+    '''
+    Open the ancillary rasters and load the preset class densities in a
+    worker process, where they are kept for the jobs run by the worker.
+    '''
+    for ancRaster_path in ancRasters:
+        idm._open_raster(ancRaster_path)
+    idm._preset_data(presets)
+
+#Population density array of a raster
+def _read_density(densityRaster_path):
+    '''
+    Return the population density array of a raster (bands, rows, columns
+    for several bands) with its geotransform, projection and NoData value.
+    '''
+    ds = gdal.Open(densityRaster_path)
+    density = {"array": ds.ReadAsArray(),
+               "geotransform": list(ds.GetGeoTransform()),
+               "projection": ds.GetProjection(),
+               "nodata": ds.GetRasterBand(1).GetNoDataValue()}
+    ds = None
+    return density
+
+#Run a job in a worker process
+def _run_job(job):
+    '''
+    Run dasy_map for a job and return its record and, for a job without an
+    output directory, its population density array. Those jobs are run in
+    a temporary directory without intermediate rasters, run report or
+    cache, which is removed once the density raster has been read.
+    '''
+    kwargs = dict(job["kwargs"])
+    record = {"id": job["id"], "status": "Done", "error": "",
+              "output_directory": kwargs.get("out_dir") or None,
+              "seconds": 0.0}
+    density = None
+    tempDir = None
+    start = time.time()
+    try:
+        if not kwargs.get("out_dir"):
+            tempDir = tempfile.mkdtemp(prefix = "idm_job_")
+            kwargs.update(out_dir = tempDir, intermediates = False,
+                          report = False, field_rasters = False)
+        elif not os.path.isdir(kwargs["out_dir"]):
+            os.makedirs(kwargs["out_dir"])
+        idm.dasy_map(**kwargs)
+        if tempDir is not None:
+            density = _read_density(os.path.join(tempDir,
+                                                 "DensityRaster.tif"))
+    except Exception:
+        record["status"] = "Failed"
+        record["error"] = traceback.format_exc().strip().splitlines()[-1]
+    finally:
+        if tempDir is not None:
+            shutil.rmtree(tempDir, ignore_errors = True)
+    record["seconds"] = round(time.time() - start, 4)
+    return record, density
+
+#Pool of workers that run the submitted jobs
+class DasyService(object):
+    '''
+    Run dasy_map jobs in a pool of worker processes that keep the ancillary
+    rasters and the preset class densities open. -workers: The number of \
+    jobs run at the same time; 0 uses all CPUs (default = 1). \
+    -ancRasters: Ancillary rasters opened by every worker when it starts. \
+    -presets: The preset class densities loaded by every worker, as for \
+    dasy_map. -keep: The number of finished jobs whose records and density \
+    arrays are kept (default = 1000). Other keyword arguments are dasy_map \
+    arguments used by all jobs unless a job sets them, e.g. cache_dir.
+    '''
+    def __init__(self, workers = 1, ancRasters = (), presets = None,
+                 keep = 1000, **defaults):
+        if workers < 1:
+            workers = mp.cpu_count()
+        ancRasters = list(ancRasters)
+        #Fail here rather than in the workers when an input is missing
+        for ancRaster_path in ancRasters:
+            idm._open_raster(ancRaster_path)
+        idm._preset_data(presets)
+        self.workers = workers
+        self.keep = keep
+        self.defaults = dict(defaults)
+        if presets is not None:
+            self.defaults.setdefault("presets", presets)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = mp.Pool(workers, _init_service, (ancRasters, presets))
+
+    def submit(self, job):
+        '''
+        Queue a job given as a dict of job fields and return its id.
+        '''
+        kwargs = job_kwargs(job, self.defaults)
+        jobId = uuid.uuid4().hex
+        entry = {"submitted": time.time(), "finished": None}
+        def finished(result):
+            entry["finished"] = time.time()
+        entry["result"] = self.pool.apply_async(
+                _run_job, ({"id": jobId, "kwargs": kwargs},),
+                callback = finished)
+        with self.lock:
+            self.jobs[jobId] = entry
+            self._forget()
+        logger.info("Job {0} submitted".format(jobId))
+        return jobId
+
+    def _forget(self):
+        '''
+        Drop the oldest finished jobs beyond the number of jobs kept.
+        '''
+        finished = [jobId for jobId, entry in self.jobs.items()
+                    if entry["result"].ready()]
+        for jobId in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[jobId]
+
+    def record(self, jobId, wait = False):
+        '''
+        Return the record of a job, waiting for it to finish if wait is True.
+        Raises KeyError for unknown jobs.
+        '''
+        with self.lock:
+            entry = self.jobs[jobId]
+        if wait:
+            entry["result"].wait()
+        if not entry["result"].ready():
+            return {"id": jobId, "status": "Pending",
+                    "latency_seconds": round(time.time() -
+                                             entry["submitted"], 4)}
+        record, density = entry["result"].get()
+        record = dict(record, density = density is not None)
+        '''
+        The time from submission to the end of the job includes the queueing
+        and the transfer of the job and its result between processes, and
+        the difference from seconds is the overhead of the service.
+        '''
+        if entry["finished"] is not None:
+            record["latency_seconds"] = round(entry["finished"] -
+                                              entry["submitted"], 4)
+        return record
+
+    def density(self, jobId):
+        '''
+        Return the population density of a finished job without an output
+        directory as a dict with the array, geotransform, projection and
+        NoData value, or None. Raises KeyError for unknown jobs.
+        '''
+        with self.lock:
+            entry = self.jobs[jobId]
+        if not entry["result"].ready():
+            return None
+        return entry["result"].get()[1]
+
+    def run(self, job):
+        '''
+        Run a job and return its record and population density.
+        '''
+        jobId = self.submit(job)
+        return self.record(jobId, wait = True), self.density(jobId)
+
+    def health(self):
+        '''
+        Return the number of workers and of pending and finished jobs.
+        '''
+        with self.lock:
+            ready = [entry["result"].ready() for entry in self.jobs.values()]
+        return {"workers": self.workers, "pending": ready.count(False),
+                "finished": ready.count(True)}
+
+    def close(self):
+        '''
+        Stop the workers, cancelling the pending jobs.
+        '''
+        self.pool.terminate()
+        self.pool.join()
+
+#HTTP requests to the service
+class _ServiceHandler(BaseHTTPRequestHandler):
+    server_version = "idm_service"
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, body, contentType = "application/json",
+              headers = None):
+        if contentType == "application/json":
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        wait = parse_qs(url.query).get("wait", ["0"])[-1]
+        return ([part for part in url.path.split('/') if part],
+                wait.lower() in ("1", "true", "yes"))
+
+    def do_POST(self):
+        parts, wait = self._route()
+        if parts != ["jobs"]:
+            return self._send(404, {"error": "Not found"})
+        service = self.server.service
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            job = json.loads(body.decode('utf-8'))
+            if not isinstance(job, dict):
+                raise ValueError("A job must be a JSON object")
+            jobId = service.submit(job)
+        except ValueError as e:
+            return self._send(400, {"error": str(e)})
+        if wait:
+            return self._send(200, service.record(jobId, wait = True))
+        self._send(202, {"id": jobId, "status": "Pending"})
+
+    def do_GET(self):
+        parts, wait = self._route()
+        service = self.server.service
+        if parts == ["health"]:
+            return self._send(200, service.health())
+        if len(parts) not in (2, 3) or parts[0] != "jobs" or \
+                parts[2:] not in ([], ["density"]):
+            return self._send(404, {"error": "Not found"})
+        try:
+            record = service.record(parts[1], wait)
+            density = service.density(parts[1]) if parts[2:] else None
+        except KeyError:
+            return self._send(404, {"error": "Unknown job " + parts[1]})
+        if not parts[2:]:
+            return self._send(200, record)
+        if density is None:
+            return self._send(409, {"error": "The job has no population "
+                                    "density array", "record": record})
+        npy = io.BytesIO()
+        np.save(npy, density["array"])
+        self._send(200, npy.getvalue(), "application/octet-stream",
+                   {"X-IDM-GeoTransform": json.dumps(density["geotransform"]),
+                    "X-IDM-Projection": density["projection"],
+                    "X-IDM-NoData": str(density["nodata"])})
+
+    def address_string(self):
+        #Clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("{0} {1}".format(self.address_string(), format % args))
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#Serve the jobs of a service over HTTP
+def serve(service, host = "127.0.0.1", port = 8765, socket_path = None):
+    '''
+    Accept jobs for service over HTTP on host:port, or on the Unix socket
+    socket_path when it is given, until interrupted. The service is closed
+    when the server stops.
+    '''
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _ServiceHandler)
+        address = socket_path
+    else:
+        server = _TCPServer((host, port), _ServiceHandler)
+        address = "http://{0}:{1}".format(host, server.server_address[1])
+    server.service = service
+    logger.info("Serving dasy_map jobs with {0} worker(s) on {1}".format(
+            service.workers, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+#------------------------------------------------------------------------------
+#Get arguments to run the service from command line
+if __name__ == '__main__':
+    #create ArgumentParser
+    parser = ap.ArgumentParser(description='This script runs intelligent \
+                               dasymetric mapping jobs submitted over HTTP \
+                               in worker processes that keep their datasets \
+                               open between jobs.')
+
+    #add arguments
+    parser.add_argument('--host', type = str, nargs='?', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, nargs='?', default = 8765)
+    parser.add_argument('--socket', type = str, nargs='?',
+                        help = "Listen on this Unix socket instead of a port")
+    parser.add_argument('--workers', type = int, nargs='?', default = 1,
+                        help = "The number of jobs run at the same time. \
+                        0 uses all CPUs - default = 1")
+    parser.add_argument('--ancillary_raster', type = str, nargs='*',
+                        default = [],
+                        help = "Ancillary rasters opened by the workers when \
+                        they start. The first is used by jobs without an \
+                        ancillary_raster")
+    parser.add_argument('--presets', type = str, nargs='?',
+                        help = "A JSON file of preset class densities \
+                        - default = config.json next to idm.py")
+    parser.add_argument('--cache_dir', type = str, nargs='?')
+    parser.add_argument('--cache_size', type = float, nargs='?', default = 20)
+    parser.add_argument('--log_level', type = str, nargs='?', default = 'INFO',
+                        choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+
+    #get args
+    args = parser.parse_args()
+    logging.basicConfig(level = args.log_level, format = "%(message)s")
+
+    defaults = {"cache_dir": args.cache_dir,
+                "cache_size": args.cache_size}
+    if args.ancillary_raster:
+        defaults["ancRaster_path"] = args.ancillary_raster[0]
+
+    #run the service
+    serve(DasyService(workers = args.workers,
+                      ancRasters = args.ancillary_raster,
+                      presets = args.presets, **defaults),
+          host = args.host, port = args.port, socket_path = args.socket)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Name: Parameter sweep for the open source Intelligent Dasymetric Mapping script
+
+Description: Evaluates many settings of the sampling parameters of dasy_map
+(popAreaMin, sampleMin and percent) for the same population features and
+ancillary raster. The population raster, the dasymetric raster and the
+polygon by class table are made once (or reused from the cache) and the
+settings are evaluated together: the representative units of each setting are
+a column of a mask matrix, and the class densities, intelligent areal
+weighting and redistribution of a chunk of settings are single passes over
+matrices with a column per setting. A sampling summary table is written for
+every setting, together with a comparison of all settings in
+SweepSummary.csv and SweepClassDensities.csv. Population density rasters are
+only rendered for the settings that are asked for.
+
+Outputs:
+    SweepSummary.csv - One row per setting with its parameters, the number of
+        sampled, preset and IAW classes, the number of representative source
+        units, the redistributed population, the largest difference between
+        the redistributed and the census population of a source polygon, and
+        the differences in density and population from the reference setting.
+    SweepClassDensities.csv - The class density of each ancillary class
+        (rows) for each setting (columns), or for each setting and count
+        field (e.g. 3_POP10) with several count fields.
+    SamplingSummaryTable_<setting>.csv - The sampling summary of a setting
+        (.parquet or .feather with --table_format).
+    DensityRaster_<setting>.tif - The population density raster of a
+        rendered setting.
+"""
+
+import os, itertools, logging
+import numpy as np
+import pandas as pd
+import argparse as ap
+
+import idm
+
+#Progress messages of the sweep
+logger = logging.getLogger("idm.sweep")
+
+
+#Compare the redistribution of one setting with the reference setting
+def _sweep_metrics(classDens_df, repCat, newPop, newDensity, ref, poly,
+                   polyCount, area, popCountField):
+    '''
+    Return the comparison metrics of a setting from its sampling summary 
+    DataFrame, the REP_CAT of each population row and the NEW_POP and 
+    NEWDENSITY of each dasymetric unit, with a column for each count field. 
+    ref holds NEW_POP and NEWDENSITY of the reference setting, or is None 
+    for the reference itself. poly is the polygon segment of each 
+    dasymetric unit and polyCount the population count of each segment.
+    '''
+    methods = classDens_df["METHOD"].value_counts()
+    polyPop = idm._field_sums(poly, newPop, len(polyCount))
+    metrics = {"N_SAMPLED": int(methods.get("Sampled", 0)),
+               "N_PRESET": int(methods.get("Preset", 0)),
+               "N_IAW": int(methods.get("IAW", 0)),
+               "N_REP_UNITS": int((repCat != 0).sum())}
+    if ref is None:
+        densDiff = np.zeros(newDensity.shape)
+        popDiff = np.zeros(newPop.shape)
+    else:
+        densDiff = np.abs(newDensity - ref[1])
+        popDiff = np.abs(newPop - ref[0])
+    '''
+    MEAN_DENS_DIFF is weighted by the area of the dasymetric units, so it is
+    the mean difference per pixel. MOVED_POP is the population that is placed
+    in other dasymetric units than in the reference setting.
+    '''
+    for i, field in enumerate(idm._count_fields(popCountField)):
+        fieldMetrics = [
+                ("NEW_POP", float(newPop[:, i].sum())),
+                ("MAX_POLY_POP_ERR", 
+                 float(np.abs(polyPop[:, i] - polyCount[:, i]).max()) 
+                 if len(polyCount) else 0.0),
+                ("MEAN_DENS_DIFF", float((densDiff[:, i] * area).sum() / 
+                                         max(area.sum(), 1))),
+                ("MAX_DENS_DIFF", float(densDiff[:, i].max()) 
+                 if len(densDiff) else 0.0),
+                ("MOVED_POP", float(popDiff[:, i].sum() / 2))]
+        for name, value in fieldMetrics:
+            metrics[idm._field_column(name, field, popCountField)] = value
+    return metrics
+
+#Sweep function
+def dasy_sweep(popFeat_path, popCountField, popKeyField, ancRaster_path,
+               out_dir, popAreaMins = (1,), sampleMins = (3,),
+               percents = (0.95,), render = (), uninhab_path = False,
+               anc_nd = 0, pop_nd = 0, tile_size = 2048, workers = 1,
+               popFilter = None, cache_dir = None, cache_size = 20,
+               presets = None, profile = 'lzw', table_format = 'csv',
+               chunk_cells = 2**24):
+    '''
+    Evaluate every combination of the sampling parameters for the same
+    inputs. -popAreaMins, -sampleMins, -percents: The values of popAreaMin, \
+    sampleMin and percent to try; every combination is a setting, numbered \
+    in the order of SweepSummary.csv. The first setting is the reference for \
+    the comparison metrics. -render: The numbers of the settings whose \
+    population density rasters are written, with the output profile \
+    profile. -table_format: The format of the sampling summary tables of \
+    the settings. -chunk_cells: The largest number of values of a matrix \
+    with a column for each setting and count field held in memory at once; \
+    the settings are evaluated together in chunks of that size \
+    (default = 2**24). popCountField can be a list of count fields, as for \
+    dasy_map; the metrics and class densities then get a column per field. \
+    Other arguments are as for dasy_map. Returns the summary DataFrame.
+    '''
+    presetData = idm._preset_data(presets)
+    idm._check_table_format(table_format)
+    countFields = idm._count_fields(popCountField)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    settings = list(itertools.product(popAreaMins, sampleMins, percents))
+    for setting in render:
+        if not 0 <= setting < len(settings):
+            raise ValueError("There is no setting {0} to render".format(
+                    setting))
+
+    #Make the rasters and the polygon by class table once for all settings
+    unitCodes, unitCounts, polyKeys, nClasses = idm._cached_units(
+            popFeat_path, popKeyField, ancRaster_path, out_dir, uninhab_path,
+            anc_nd, pop_nd, tile_size, workers, popFilter, cache_dir,
+            cache_size)
+    dasy_df, pop_df = idm._unit_tables(unitCodes, unitCounts, nClasses,
+                                       polyKeys)
+    popCounts = idm._read_pop_counts(popFeat_path, popKeyField,
+                                     popCountField, popFilter)
+    dasy_df, pop_df = idm._prepare_tables(dasy_df, pop_df, popCounts,
+                                          popCountField, presetData)
+    
+    '''
+    The census population of each polygon, summed over the population rows 
+    of duplicate keys, in the order of the polygon segments of the units.
+    '''
+    poly, popPoly, nPolys = idm._polygon_segments(dasy_df, pop_df)
+    polyCount = pop_df.reset_index(drop = True).groupby("Value")[
+            countFields].sum()
+    polyCount = polyCount.reindex(
+            pd.unique(pop_df["Value"].values)).fillna(0).values
+    area = dasy_df["Count"].values
+    densityFields = [idm._field_column("NEWDENSITY", field, popCountField)
+                     for field in countFields]
+
+    records = []
+    classDens = {}
+    ref = None
+    for setting, classDens_df, repCat, newPop, newDensity in \
+            idm._sweep_densities(dasy_df, pop_df, popCountField, presetData,
+                                 settings, chunk_cells):
+        popAreaMin, sampleMin, percent = settings[setting]
+        logger.info("Setting {0}: popAreaMin = {1}, sampleMin = {2}, "
+                    "percent = {3}".format(setting, popAreaMin, sampleMin,
+                                           percent))
+        idm._write_table(classDens_df, os.path.join(
+                out_dir, "SamplingSummaryTable_{0}".format(setting)),
+                table_format)
+
+        record = {"SETTING": setting, "popAreaMin": popAreaMin,
+                  "sampleMin": sampleMin, "percent": percent}
+        record.update(_sweep_metrics(classDens_df, repCat, newPop, 
+                                     newDensity, ref, poly, polyCount, area,
+                                     popCountField))
+        records.append(record)
+        for field in countFields:
+            column = setting if isinstance(popCountField, str) \
+                else "{0}_{1}".format(setting, field)
+            classDens[column] = classDens_df[
+                    idm._field_column("CLASSDENS", field, popCountField)]
+
+        if setting in render:
+            logger.info("Creating population density raster...")
+            setDasy_df = pd.DataFrame(
+                    dict([("Value", dasy_df["Value"].values)] + 
+                         list(zip(densityFields, newDensity.T))),
+                    columns = ["Value"] + densityFields)
+            idm.render_density(
+                    os.path.join(out_dir, "DasyRaster.tif"), setDasy_df,
+                    os.path.join(out_dir,
+                                 "DensityRaster_{0}.tif".format(setting)),
+                    tile_size, workers = workers, profile = profile,
+                    fields = densityFields)
+        if ref is None:
+            ref = (newPop.copy(), newDensity.copy())
+
+    summary = pd.DataFrame(records)
+    summary.to_csv(os.path.join(out_dir, "SweepSummary.csv"), index = False)
+    pd.DataFrame(classDens).rename_axis("ancID").to_csv(
+            os.path.join(out_dir, "SweepClassDensities.csv"), header = True)
+    logger.info("All outputs from this tool can be found in " + out_dir)
+    return summary
+
+#------------------------------------------------------------------------------
+#Get arguments to run dasy_sweep from command line
+if __name__ == '__main__':
+    #create ArgumentParser
+    parser = ap.ArgumentParser(description='This script evaluates many \
+                               settings of the sampling parameters of \
+                               intelligent dasymetric mapping for the same \
+                               population and ancillary datasets.')
+
+    #add arguments
+    parser.add_argument('population_features', type = str,
+                        help = 'The census polygons with unique identifiers \
+                        and a count of the population for each polygon')
+    parser.add_argument('population_count_field', type = str,
+                        help = "The field in the population_features that \
+                        stores the polygon's populations, or several count \
+                        fields separated by commas")
+    parser.add_argument('population_key_field', type = str,
+                        help = "The unique identifier field for each polygon \
+                        in population_features")
+    parser.add_argument('ancillary_raster', type = str,
+                        help = "The land cover raster that is used for \
+                        dasymetric population mapping")
+    parser.add_argument('output_directory', type = str,
+                        help = "The directory where all outputs from the \
+                        script will be saved.")
+    parser.add_argument('--minimum_sampling_area', type = int, nargs='+',
+                        default = [1],
+                        help = "The values of the minimum number of raster \
+                        cells in a representative source polygon to try \
+                        - default = 1")
+    parser.add_argument('--minimum_sample', type = int, nargs='+',
+                        default = [3],
+                        help = "The values of the minimum number of \
+                        representative source units to try - default = 3")
+    parser.add_argument('--percent', type = float, nargs='+',
+                        default = [0.95],
+                        help = "The values of the minimum percent of a source \
+                        polygon's area covered by a class to try \
+                        - default = 0.95")
+    parser.add_argument('--render', type = int, nargs='*', default = [],
+                        help = "The numbers of the settings whose population \
+                        density rasters are written. Settings are numbered \
+                        from 0 in the order of SweepSummary.csv")
+    parser.add_argument('--uninhabited_file', type = str, nargs='?',
+                        help = "An optional feature class containing \
+                        uninhabited areas")
+    parser.add_argument('--pop_nodata', type = int, nargs='?', default = 0)
+    parser.add_argument('--anc_nodata', type = int, nargs='?', default = 0)
+    parser.add_argument('--tile_size', type = int, nargs='?', default = 2048)
+    parser.add_argument('--population_filter', type = str, nargs='?')
+    parser.add_argument('--cache_dir', type = str, nargs='?')
+    parser.add_argument('--cache_size', type = float, nargs='?', default = 20)
+    parser.add_argument('--workers', type = int, nargs='?', default = 1)
+    parser.add_argument('--output_profile', type = str, nargs='?',
+                        default = 'lzw', choices = idm.OUTPUT_PROFILES)
+    parser.add_argument('--table_format', type = str, nargs='?',
+                        default = 'csv', choices = sorted(idm.TABLE_FORMATS))
+    parser.add_argument('--presets', type = str, nargs='?',
+                        help = "A JSON file of preset class densities \
+                        - default = config.json next to idm.py")
+    parser.add_argument('--chunk_cells', type = int, nargs='?', 
+                        default = 2**24,
+                        help = "The largest number of values of a matrix \
+                        with a column for each setting held in memory at \
+                        once - default = 16777216")
+
+    #get args
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+
+    #Several count fields are separated by commas
+    countFields = args.population_count_field.split(',')
+
+    #run function
+    dasy_sweep(
+            popFeat_path = args.population_features,
+            popCountField = countFields[0] if len(countFields) == 1 \
+                else countFields,
+            popKeyField = args.population_key_field,
+            ancRaster_path = args.ancillary_raster,
+            out_dir = args.output_directory,
+            popAreaMins = args.minimum_sampling_area,
+            sampleMins = args.minimum_sample,
+            percents = args.percent,
+            render = args.render,
+            uninhab_path = args.uninhabited_file,
+            anc_nd = args.anc_nodata,
+            pop_nd = args.pop_nodata,
+            tile_size = args.tile_size,
+            workers = args.workers,
+            popFilter = args.population_filter,
+            cache_dir = args.cache_dir,
+            cache_size = args.cache_size,
+            presets = args.presets,
+            profile = args.output_profile,
+            table_format = args.table_format,
+            chunk_cells = args.chunk_cells
+            )